@@ -10,6 +10,18 @@ import requests
 import threading
 import random
 import string
+import heapq
+import hashlib
+from collections import deque, OrderedDict
+import weakref
+import base64
+import json
+import mimetypes
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from threading import Thread, Event, Lock
 from colorama import Fore, Style, init
 
@@ -28,7 +40,12 @@ import os
 import sys
 import uuid
 import requests
-from qiniu import Auth, put_data, put_file
+from qiniu import Auth, BucketManager, put_data, put_file, put_stream
+
+try:
+    from backend.lovart_shrink import shrink_image as _lovart_shrink_image
+except ImportError:
+    from lovart_shrink import shrink_image as _lovart_shrink_image
 
 # BitBrowser Configuration
 BITBROWSER_API_URL = "http://127.0.0.1:54345"
@@ -153,47 +170,334 @@ QINIU_SECRET_KEY = os.getenv('QINIU_SECRET_KEY', 'fiUUq52QQRMBwTJkZfUb1KYcF6d6FF
 QINIU_BUCKET_NAME = os.getenv('QINIU_BUCKET_NAME', 'manga-adu')
 QINIU_CDN_DOMAIN = os.getenv('QINIU_DOMAIN', 'http://cdn2.manfanfan.com').strip()
 
-def upload_image_to_qiniu(image_url: str) -> str:
+# Mirroring runs on its own small thread pool with pooled HTTP connections and a
+# cached bucket-scoped upload token. Images are streamed: small ones go up in one
+# request, large ones through Qiniu's resumable (chunked) upload straight from the
+# download stream.
+_QINIU_TOKEN_TTL = 3600
+_QINIU_STREAM_THRESHOLD = int(os.getenv('QINIU_STREAM_THRESHOLD', 4 * 1024 * 1024)) # Bytes; larger files use resumable upload
+_LOVART_MIRROR_WORKERS = int(os.getenv('LOVART_MIRROR_WORKERS', 8))
+
+_qiniu_auth = Auth(QINIU_ACCESS_KEY, QINIU_SECRET_KEY)
+_qiniu_token_lock = Lock()
+_qiniu_token = {"value": None, "expires": 0}
+_lovart_mirror_executor = ThreadPoolExecutor(max_workers=_LOVART_MIRROR_WORKERS, thread_name_prefix="lovart-mirror")
+_lovart_mirror_http = requests.Session()
+_lovart_mirror_http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=_LOVART_MIRROR_WORKERS))
+_lovart_mirror_http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=_LOVART_MIRROR_WORKERS))
+
+def _qiniu_upload_token() -> str:
+    """
+    Bucket-scoped upload token (valid for any new key), refreshed shortly before it expires.
+    """
+    now = time.time()
+    with _qiniu_token_lock:
+        if _qiniu_token["value"] is None or now > _qiniu_token["expires"] - 300:
+            _qiniu_token["value"] = _qiniu_auth.upload_token(QINIU_BUCKET_NAME, None, _QINIU_TOKEN_TTL)
+            _qiniu_token["expires"] = now + _QINIU_TOKEN_TTL
+        return _qiniu_token["value"]
+
+def _qiniu_guess_ext(image_url: str, content_type: str, default: str = ".png") -> str:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    ext = {
+        "image/jpeg": ".jpg",
+        "image/png": ".png",
+        "image/webp": ".webp",
+        "image/gif": ".gif",
+        "video/mp4": ".mp4",
+    }.get(content_type)
+    if ext:
+        return ext
+    path = image_url.split("?")[0].lower()
+    if path.endswith((".jpg", ".jpeg")):
+        return ".jpg"
+    for candidate in (".webp", ".gif", ".mp4"):
+        if path.endswith(candidate):
+            return candidate
+    return default # 默认为 png
+
+# Artifact map: our Qiniu CDN URL / the original Lovart artifact URL -> Lovart artifact URL.
+# Chained generations pass a previous output back in as a reference; known URLs go
+# straight into input_args.image instead of being downloaded and uploaded again.
+# Persisted as an append-only JSONL file and loaded at startup; the file is rewritten
+# from the in-memory LRU once it grows past twice the map size.
+_LOVART_ARTIFACT_MAP_FILE = os.environ.get("LOVART_ARTIFACT_MAP_FILE", os.path.join("data", "lovart_artifact_map.jsonl"))
+_LOVART_ARTIFACT_MAP_SIZE = int(os.environ.get("LOVART_ARTIFACT_MAP_SIZE", 100000)) # Entries kept in memory (LRU)
+_lovart_artifact_map_lock = Lock()
+_lovart_artifact_map = OrderedDict()
+_lovart_artifact_map_lines = 0 # Lines currently in the file
+
+def _lovart_artifact_key(url: str) -> str:
+    return (url or "").strip().split("?")[0].split("#")[0]
+
+def _lovart_artifact_map_add_locked(url: str, artifact_url: str):
+    key = _lovart_artifact_key(url)
+    if not key:
+        return
+    _lovart_artifact_map[key] = artifact_url
+    _lovart_artifact_map.move_to_end(key)
+    while len(_lovart_artifact_map) > _LOVART_ARTIFACT_MAP_SIZE:
+        _lovart_artifact_map.popitem(last=False)
+
+def _lovart_load_artifact_map():
+    if not _LOVART_ARTIFACT_MAP_FILE or not os.path.exists(_LOVART_ARTIFACT_MAP_FILE):
+        return
+    global _lovart_artifact_map_lines
+    try:
+        with open(_LOVART_ARTIFACT_MAP_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                _lovart_artifact_map_lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # Torn last line
+                artifact_url = _lovart_artifact_key(entry.get("artifact_url"))
+                if not artifact_url:
+                    continue
+                _lovart_artifact_map_add_locked(artifact_url, artifact_url)
+                if entry.get("cdn_url"):
+                    _lovart_artifact_map_add_locked(entry["cdn_url"], artifact_url)
+        print(f"[lovart] Loaded {len(_lovart_artifact_map)} artifact map entries")
+    except Exception as e:
+        print(f"[lovart] Failed to load artifact map: {e}")
+        return
+    if _lovart_artifact_map_lines > 2 * _LOVART_ARTIFACT_MAP_SIZE:
+        _lovart_compact_artifact_map_locked()
+
+def _lovart_compact_artifact_map_locked():
+    """
+    Rewrite the map file from the in-memory LRU (oldest first), dropping evicted and duplicate lines.
+    """
+    global _lovart_artifact_map_lines
+    tmp_path = _LOVART_ARTIFACT_MAP_FILE + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, artifact_url in _lovart_artifact_map.items():
+                cdn_url = key if key != artifact_url else None
+                f.write(json.dumps({"artifact_url": artifact_url, "cdn_url": cdn_url}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, _LOVART_ARTIFACT_MAP_FILE)
+        print(f"[lovart] Compacted artifact map file: {_lovart_artifact_map_lines} -> {len(_lovart_artifact_map)} lines")
+        _lovart_artifact_map_lines = len(_lovart_artifact_map)
+    except Exception as e:
+        print(f"[lovart] Failed to compact artifact map file: {e}")
+
+def lovart_record_artifact(artifact_url: str, cdn_url: str = None):
+    """
+    Remember that cdn_url (and artifact_url itself) refer to this Lovart artifact.
+    """
+    artifact_url = _lovart_artifact_key(artifact_url)
+    if not artifact_url:
+        return
+    if cdn_url and _lovart_artifact_key(cdn_url) == artifact_url:
+        cdn_url = None # Mirroring fell back to the original URL
+    global _lovart_artifact_map_lines
+    with _lovart_artifact_map_lock:
+        if _lovart_artifact_map.get(artifact_url) == artifact_url and (not cdn_url or _lovart_artifact_key(cdn_url) in _lovart_artifact_map):
+            return
+        _lovart_artifact_map_add_locked(artifact_url, artifact_url)
+        if cdn_url:
+            _lovart_artifact_map_add_locked(cdn_url, artifact_url)
+        if _LOVART_ARTIFACT_MAP_FILE:
+            try:
+                map_dir = os.path.dirname(_LOVART_ARTIFACT_MAP_FILE)
+                if map_dir:
+                    os.makedirs(map_dir, exist_ok=True)
+                with open(_LOVART_ARTIFACT_MAP_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"artifact_url": artifact_url, "cdn_url": cdn_url, "ts": time.time()}, ensure_ascii=False) + "\n")
+                _lovart_artifact_map_lines += 1
+            except Exception as e:
+                print(f"[lovart] Failed to persist artifact map entry: {e}")
+                return
+            if _lovart_artifact_map_lines > 2 * _LOVART_ARTIFACT_MAP_SIZE:
+                _lovart_compact_artifact_map_locked()
+
+def lovart_resolve_artifact(url: str):
+    """
+    Lovart artifact URL for one of our previous outputs (CDN or artifact URL), else None.
+    """
+    key = _lovart_artifact_key(url)
+    with _lovart_artifact_map_lock:
+        artifact_url = _lovart_artifact_map.get(key)
+        if artifact_url:
+            _lovart_artifact_map.move_to_end(key)
+        return artifact_url
+
+# Mirror modes (LOVART_MIRROR_MODE):
+# - upload:   download the artifact here and upload it to Qiniu (default)
+# - fetch:    Qiniu pulls the artifact itself (server-side fetch), upload as fallback
+# - deferred: return the CDN URL of a fresh key right away, fetch / upload it in the background
+# Mirrored artifacts are remembered (artifact URL -> CDN URL, LRU of LOVART_MIRROR_CACHE_SIZE)
+# so retries of the same artifact are never mirrored twice.
+_LOVART_MIRROR_MODE = os.getenv('LOVART_MIRROR_MODE', 'upload').strip().lower()
+_LOVART_MIRROR_CACHE_SIZE = int(os.getenv('LOVART_MIRROR_CACHE_SIZE', 10000))
+_qiniu_bucket = BucketManager(_qiniu_auth)
+_lovart_mirror_cache_lock = Lock()
+_lovart_mirror_cache = OrderedDict()
+# deferred: artifact key -> CDN URL handed out while the upload runs; moved to the cache
+# (and the artifact map) only once it succeeded, retried up to LOVART_MIRROR_DEFERRED_RETRIES times
+_LOVART_MIRROR_DEFERRED_RETRIES = int(os.getenv('LOVART_MIRROR_DEFERRED_RETRIES', 3))
+_lovart_mirror_pending = {}
+
+def _lovart_mirror_cache_put_locked(artifact_key: str, cdn_url: str):
+    _lovart_mirror_cache[artifact_key] = cdn_url
+    _lovart_mirror_cache.move_to_end(artifact_key)
+    while len(_lovart_mirror_cache) > _LOVART_MIRROR_CACHE_SIZE:
+        _lovart_mirror_cache.popitem(last=False)
+
+def _qiniu_new_key(image_url: str, content_type: str = "") -> str:
+    # 使用 UUID 防止冲突，保持后缀
+    # Type not known yet (fetch / deferred): no suffix unless the URL has one; the object's
+    # mimeType is set by Qiniu's fetch or passed explicitly on upload
+    return f"agent_images/{uuid.uuid4()}{_qiniu_guess_ext(image_url, content_type, default='' if not content_type else '.png')}"
+
+def upload_image_to_qiniu(image_url: str, key: str = None) -> str:
     """
     下载图片并上传到七牛云，返回 CDN 地址
     """
     try:
-        # 1. 下载图片
+        # 1. 下载图片 (stream)
         print(f"[lovart] Downloading image from: {image_url}")
-        resp = requests.get(image_url, timeout=30)
-        if resp.status_code != 200:
-            print(f"[lovart] Failed to download image: {resp.status_code}")
-            return image_url # Fallback to original URL
-        
-        image_data = resp.content
-        
-        # 2. 构建文件名
-        # 使用 UUID 防止冲突，保持后缀
-        ext = ".png" # 默认为 png
-        if ".jpg" in image_url or ".jpeg" in image_url:
-            ext = ".jpg"
-        
-        key = f"agent_images/{uuid.uuid4()}{ext}"
-        
-        # 3. 上传七牛云
-        print(f"[lovart] Uploading to Qiniu: {key}")
-        q = Auth(QINIU_ACCESS_KEY, QINIU_SECRET_KEY)
-        token = q.upload_token(QINIU_BUCKET_NAME, key, 3600)
-        
-        ret, info = put_data(token, key, image_data)
-        
+        with _lovart_mirror_http.get(image_url, timeout=30, stream=True) as resp:
+            if resp.status_code != 200:
+                print(f"[lovart] Failed to download image: {resp.status_code}")
+                return image_url # Fallback to original URL
+
+            # 2. 构建文件名
+            content_type = resp.headers.get("Content-Type", "")
+            key = key or _qiniu_new_key(image_url, content_type)
+            mime_type = content_type.split(";")[0].strip() or "application/octet-stream"
+            size = resp.headers.get("Content-Length")
+            encoded = resp.headers.get("Content-Encoding", "identity").lower() not in ("", "identity")
+
+            # 3. 上传七牛云
+            print(f"[lovart] Uploading to Qiniu: {key} ({size or '?'} bytes)")
+            token = _qiniu_upload_token()
+            if size and not encoded and int(size) <= _QINIU_STREAM_THRESHOLD:
+                ret, info = put_data(token, key, resp.raw.read(int(size)), mime_type=mime_type)
+            else:
+                # Large or unknown length: spool (memory up to the threshold, then disk);
+                # the resumable uploader needs a seekable stream, resp.raw is not
+                with tempfile.SpooledTemporaryFile(max_size=_QINIU_STREAM_THRESHOLD) as spool:
+                    for chunk in resp.iter_content(chunk_size=256 * 1024):
+                        spool.write(chunk)
+                    length = spool.tell()
+                    spool.seek(0)
+                    if length > _QINIU_STREAM_THRESHOLD:
+                        ret, info = put_stream(token, key, spool, os.path.basename(key), length, mime_type=mime_type)
+                    else:
+                        ret, info = put_data(token, key, spool.read(), mime_type=mime_type)
+
         if info.status_code == 200:
             cdn_url = f"{QINIU_CDN_DOMAIN}/{key}"
             print(f"[lovart] Upload success. CDN URL: {cdn_url}")
+            if mime_type.startswith("image/"):
+                lovart_record_artifact(image_url, cdn_url)
             return cdn_url
         else:
             print(f"[lovart] Qiniu upload failed: {info.text_body}")
+            if info.status_code == 401:
+                with _qiniu_token_lock:
+                    _qiniu_token["value"] = None
             return image_url # Fallback
-            
+
     except Exception as e:
         print(f"[lovart] Upload to Qiniu error: {e}")
         return image_url # Fallback
 
+def fetch_image_to_qiniu(image_url: str, key: str = None) -> str:
+    """
+    七牛云服务端抓取 (图片不经过本服务)，失败时回退到 upload_image_to_qiniu
+    """
+    key = key or _qiniu_new_key(image_url)
+    try:
+        print(f"[lovart] Qiniu fetching {image_url} -> {key}")
+        ret, info = _qiniu_bucket.fetch(image_url, QINIU_BUCKET_NAME, key)
+        if info.status_code == 200 and ret:
+            cdn_url = f"{QINIU_CDN_DOMAIN}/{key}"
+            print(f"[lovart] Fetch success. CDN URL: {cdn_url}")
+            if (ret.get("mimeType") or "").startswith("image/"):
+                lovart_record_artifact(image_url, cdn_url)
+            return cdn_url
+        print(f"[lovart] Qiniu fetch failed: {info.text_body}")
+    except Exception as e:
+        print(f"[lovart] Qiniu fetch error: {e}")
+    return upload_image_to_qiniu(image_url, key)
+
+def _lovart_mirror_deferred(image_url: str, key: str, artifact_key: str, attempt: int = 1):
+    cdn_url = fetch_image_to_qiniu(image_url, key)
+    if cdn_url != image_url:
+        # Only now is the key known to exist; fetch / upload recorded the artifact map entry
+        with _lovart_mirror_cache_lock:
+            _lovart_mirror_pending.pop(artifact_key, None)
+            _lovart_mirror_cache_put_locked(artifact_key, cdn_url)
+        return
+    if attempt < _LOVART_MIRROR_DEFERRED_RETRIES:
+        delay = 5 * 2 ** (attempt - 1)
+        print(f"[lovart] Deferred mirror of {image_url} failed (attempt {attempt}), retrying in {delay}s")
+        retry = threading.Timer(delay, lambda: _lovart_mirror_executor.submit(_lovart_mirror_deferred, image_url, key, artifact_key, attempt + 1))
+        retry.daemon = True
+        retry.start()
+        return
+    # Give up: the returned CDN URL stays empty; the next request for this artifact mirrors again
+    print(f"[lovart] ❌ Deferred mirror of {image_url} failed after {attempt} attempts, {QINIU_CDN_DOMAIN}/{key} stays empty")
+    with _lovart_mirror_cache_lock:
+        _lovart_mirror_pending.pop(artifact_key, None)
+
+def _lovart_mirror(image_url: str) -> str:
+    """
+    Mirror according to LOVART_MIRROR_MODE; blocking unless deferred. Falls back to the original URL.
+    """
+    artifact_key = _lovart_artifact_key(image_url)
+    with _lovart_mirror_cache_lock:
+        cdn_url = _lovart_mirror_cache.get(artifact_key)
+        if cdn_url:
+            _lovart_mirror_cache.move_to_end(artifact_key)
+            print(f"[lovart] Already mirrored: {cdn_url}")
+            return cdn_url
+        if _LOVART_MIRROR_MODE == "deferred":
+            cdn_url = _lovart_mirror_pending.get(artifact_key)
+            if cdn_url:
+                print(f"[lovart] Already mirroring in background: {cdn_url}")
+                return cdn_url
+            key = _qiniu_new_key(image_url)
+            cdn_url = _lovart_mirror_pending[artifact_key] = f"{QINIU_CDN_DOMAIN}/{key}"
+
+    if _LOVART_MIRROR_MODE == "deferred":
+        print(f"[lovart] Mirroring in background: {cdn_url}")
+        _lovart_mirror_executor.submit(_lovart_mirror_deferred, image_url, key, artifact_key)
+        return cdn_url
+
+    if _LOVART_MIRROR_MODE == "fetch":
+        cdn_url = fetch_image_to_qiniu(image_url)
+    else:
+        cdn_url = upload_image_to_qiniu(image_url)
+    if cdn_url and cdn_url != image_url:
+        with _lovart_mirror_cache_lock:
+            _lovart_mirror_cache_put_locked(artifact_key, cdn_url)
+    return cdn_url
+
+def lovart_mirror_image(image_url: str, timeout: float = 300.0) -> str:
+    """
+    Blocking variant for request threads: mirror on the mirror pool after the
+    session has been released. Falls back to the original URL.
+    """
+    if _LOVART_MIRROR_MODE == "deferred":
+        return _lovart_mirror(image_url) # Returns at once, must not queue behind background mirrors
+    try:
+        return _lovart_mirror_executor.submit(_lovart_mirror, image_url).result(timeout=timeout)
+    except Exception as e:
+        print(f"[lovart] Mirror error: {e}")
+        return image_url
+
+async def lovart_mirror_to_qiniu(image_url: str) -> str:
+    """
+    Mirror a Lovart artifact to Qiniu on the mirror pool (never blocks the session loop).
+    """
+    if _LOVART_MIRROR_MODE == "deferred":
+        return _lovart_mirror(image_url)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_lovart_mirror_executor, _lovart_mirror, image_url)
+
 def setup_playwright_env():
     """
     设置Playwright环境变量
@@ -249,35 +553,130 @@ for _ in range(_LOVART_POOL_SIZE):
         "browser": None,
         "context": None,
         "page": None,
-        "busy_lock": Lock(), # Threading lock to mark session as busy
+        "inflight": 0, # Requests currently holding this session
+        "exclusive": False, # Held by a request that drives the page UI (no sharing)
+        "draining": False, # Retired: no new requests, closed when the last holder releases
+        "generation": 0, # Bumped whenever the slot is (re)filled; stale releases are ignored
         "last_active": 0, # Timestamp of last activity
         "bitbrowser_id": None, 
     })
 
+def _lovart_install_slot_locked(index: int, slot: dict):
+    """
+    Put a new session (or an empty slot) into the pool under a new generation.
+    Caller must hold _lovart_sessions_lock.
+    """
+    slot["generation"] = _lovart_sessions[index].get("generation", 0) + 1
+    slot.setdefault("draining", False)
+    _lovart_sessions[index] = slot
+
 _LOVART_VIEWPORT = {"width": 1280, "height": 720}
 
+# Image generation mode: "api" (signed task API only) or "ui" (drive the canvas menus first)
+_LOVART_IMAGE_MODE = os.environ.get("LOVART_IMAGE_MODE", "api")
+
+# Points ledger: each session caches its balance (seeded at login, reconciled in the background)
+_LOVART_POINTS_MAX_AGE = float(os.environ.get("LOVART_POINTS_MAX_AGE", 600)) # Older cached values are re-scraped before a job
+_LOVART_POINTS_REFRESH_INTERVAL = float(os.environ.get("LOVART_POINTS_REFRESH_INTERVAL", 60))
+
+# Pool supervisor: one event loop thread and one Playwright driver shared by every session.
+# Each BitBrowser window is attached with connect_over_cdp on this driver.
+_lovart_supervisor_lock = Lock()
+_lovart_supervisor = {
+    "thread": None,
+    "loop": None,
+    "playwright": None,
+    "playwright_lock": None, # asyncio.Lock, created on the supervisor loop
+}
+
+def lovart_get_supervisor_loop():
+    """
+    Return the pool supervisor loop, starting its thread on first use.
+    """
+    with _lovart_supervisor_lock:
+        thread_obj = _lovart_supervisor["thread"]
+        loop = _lovart_supervisor["loop"]
+        if thread_obj and loop and thread_obj.is_alive() and not loop.is_closed():
+            return loop
+
+        loop = asyncio.new_event_loop()
+        started = Event()
+
+        def run_loop():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(started.set)
+            loop.run_forever()
+
+        thread_obj = Thread(target=run_loop, name="lovart-supervisor", daemon=True)
+        thread_obj.start()
+        started.wait()
+        _lovart_supervisor.update(thread=thread_obj, loop=loop, playwright=None, playwright_lock=None)
+        asyncio.run_coroutine_threadsafe(_lovart_points_refresh_loop(), loop)
+        return loop
+
+def lovart_run_on_supervisor(coro):
+    """
+    Schedule a coroutine on the supervisor loop. Returns a concurrent.futures.Future.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, lovart_get_supervisor_loop())
+
+async def _lovart_get_playwright():
+    # Must run on the supervisor loop
+    if _lovart_supervisor["playwright_lock"] is None:
+        _lovart_supervisor["playwright_lock"] = asyncio.Lock()
+    async with _lovart_supervisor["playwright_lock"]:
+        if _lovart_supervisor["playwright"] is None:
+            print("[lovart] Starting shared Playwright driver...")
+            _lovart_supervisor["playwright"] = await async_playwright().start()
+        return _lovart_supervisor["playwright"]
+
+@asynccontextmanager
+async def _lovart_shared_playwright():
+    """
+    Same shape as `async with async_playwright() as p`, but the driver outlives the block.
+    """
+    yield await _lovart_get_playwright()
+
+# Session scheduler priorities (lower value is served first)
+LOVART_PRIORITY_INTERACTIVE = 0
+LOVART_PRIORITY_BATCH = 10
+
+# Waiters queued in lovart_acquire_session, ordered by (priority, arrival seq).
+# Free sessions are handed to the head waiter directly, so nobody polls.
+_lovart_waiters = []
+_lovart_waiter_seq = 0
+
+# Requests that only use the page as a signing / fetch context (API image mode)
+# can share a session: up to LOVART_SESSION_MAX_TASKS at once, fewer when the
+# cached points cannot pay for them, and one at a time for a while after the
+# account hit a rate limit. Requests that drive the UI still hold it alone.
+_LOVART_SESSION_MAX_TASKS = max(1, int(os.environ.get("LOVART_SESSION_MAX_TASKS", 3)))
+_LOVART_TASK_POINTS = int(os.environ.get("LOVART_TASK_POINTS", 10)) # Points one image task needs
+_LOVART_RATE_LIMIT_COOLDOWN = float(os.environ.get("LOVART_RATE_LIMIT_COOLDOWN", 60))
+
 def lovart_get_pool_size() -> int:
     return _LOVART_POOL_SIZE
 
+def _lovart_session_alive(sess: dict) -> bool:
+    thread_obj = sess.get("thread")
+    loop = sess.get("loop")
+    page = sess.get("page")
+    if not (thread_obj and loop and page and thread_obj.is_alive() and not loop.is_closed()):
+        return False
+    try:
+        return not page.is_closed()
+    except Exception:
+        return True
+
 def lovart_has_session(index: int = None) -> bool:
     with _lovart_sessions_lock:
         if index is not None:
             if 0 <= index < len(_lovart_sessions):
-                sess = _lovart_sessions[index]
-                thread_obj = sess.get("thread")
-                loop = sess.get("loop")
-                page = sess.get("page")
-                return bool(thread_obj and loop and page and thread_obj.is_alive() and not loop.is_closed())
+                return _lovart_session_alive(_lovart_sessions[index])
             return False
         
-        # If index is None, check if ANY session is alive
-        for sess in _lovart_sessions:
-            thread_obj = sess.get("thread")
-            loop = sess.get("loop")
-            page = sess.get("page")
-            if thread_obj and loop and page and thread_obj.is_alive() and not loop.is_closed():
-                return True
-        return False
+        # If index is None, check if ANY session can take requests (draining ones cannot)
+        return any(_lovart_session_usable(sess) for sess in _lovart_sessions)
 
 def lovart_get_session_by_index(index: int):
     with _lovart_sessions_lock:
@@ -286,50 +685,215 @@ def lovart_get_session_by_index(index: int):
             return sess.get("loop"), sess.get("page")
     return None, None
 
-def lovart_acquire_session(timeout: float = 5.0):
+def _lovart_session_capacity(sess: dict) -> int:
     """
-    Find and lock an available session.
-    Returns: (index, loop, page) or (None, None, None)
+    How many shared requests this session may serve at once right now.
     """
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        # 1. Snapshot valid sessions
-        candidates = []
-        with _lovart_sessions_lock:
-            for idx, sess in enumerate(_lovart_sessions):
-                thread_obj = sess.get("thread")
-                loop = sess.get("loop")
-                page = sess.get("page")
-                if thread_obj and loop and page and thread_obj.is_alive() and not loop.is_closed():
-                    candidates.append((idx, sess))
-        
+    capacity = _LOVART_SESSION_MAX_TASKS
+    points = sess.get("points")
+    if points is not None and _LOVART_TASK_POINTS > 0:
+        # Keep at least one so a low balance is still detected and reported
+        capacity = min(capacity, max(1, points // _LOVART_TASK_POINTS))
+    if sess.get("rate_limited_until", 0) > time.time():
+        capacity = 1
+    return capacity
+
+def _lovart_session_usable(sess: dict) -> bool:
+    return _lovart_session_alive(sess) and not sess.get("draining")
+
+def _lovart_session_fits(sess: dict, shared: bool) -> bool:
+    if not _lovart_session_usable(sess) or sess["exclusive"]:
+        return False
+    if not shared:
+        return sess["inflight"] == 0
+    return sess["inflight"] < _lovart_session_capacity(sess)
+
+def _lovart_fail_waiters_locked():
+    """
+    No live session left: wake every waiter without a session, so it fails fast
+    (or relaunches one) instead of sleeping out its timeout.
+    """
+    while _lovart_waiters:
+        _, _, waiter = heapq.heappop(_lovart_waiters)
+        if not waiter["cancelled"]:
+            waiter["event"].set()
+
+def _lovart_dispatch_locked():
+    """
+    Hand free sessions to queued waiters in priority/FIFO order.
+    Caller must hold _lovart_sessions_lock.
+    """
+    while _lovart_waiters:
+        waiter = _lovart_waiters[0][2]
+        if waiter["cancelled"]:
+            heapq.heappop(_lovart_waiters)
+            continue
+
+        # Least loaded session first, so shared requests spread over the pool
+        candidates = [
+            idx for idx, sess in enumerate(_lovart_sessions)
+            if _lovart_session_fits(sess, waiter["shared"])
+        ]
         if not candidates:
-            return None, None, None
-
-        # 2. Try to acquire lock on one of them
-        for idx, sess in candidates:
-            busy_lock = sess.get("busy_lock")
-            if busy_lock.acquire(blocking=False):
-                # Update last active time
-                with _lovart_sessions_lock:
-                     _lovart_sessions[idx]["last_active"] = time.time()
-                return idx, sess.get("loop"), sess.get("page")
-        
-        time.sleep(0.1)
-    
-    return None, None, None
+            if not any(_lovart_session_usable(sess) for sess in _lovart_sessions):
+                _lovart_fail_waiters_locked()
+            return
+        assigned = min(candidates, key=lambda i: _lovart_sessions[i]["inflight"])
+
+        heapq.heappop(_lovart_waiters)
+        sess = _lovart_sessions[assigned]
+        sess["inflight"] += 1
+        sess["exclusive"] = not waiter["shared"]
+        sess["last_active"] = time.time()
+        waiter["index"] = assigned
+        waiter["generation"] = sess["generation"]
+        waiter["event"].set()
+
+def lovart_dispatch_sessions():
+    """
+    Wake waiters after a session became available (registered / released).
+    """
+    with _lovart_sessions_lock:
+        _lovart_dispatch_locked()
+
+def lovart_acquire_session(timeout: float = 5.0, priority: int = LOVART_PRIORITY_INTERACTIVE, shared: bool = False, wake_event: Event = None):
+    """
+    Find and lock an available session.
+    Requests wait in a priority queue (FIFO within the same priority) and are woken
+    by lovart_release_session / session registration instead of polling, or without
+    a session as soon as the last live session is gone.
+    shared=True requests (API image mode) may run next to each other on one session.
+    wake_event: caller-owned event; setting it abandons the wait early (must be unset).
+    Returns: (index, loop, page, generation) or (None, None, None, None); pass the
+    generation back to lovart_release_session / lovart_retire_session.
+    """
+    global _lovart_waiter_seq
+    waiter = {"event": wake_event or Event(), "index": None, "generation": None, "cancelled": False, "shared": shared}
+    with _lovart_sessions_lock:
+        if not any(_lovart_session_usable(sess) for sess in _lovart_sessions):
+            return None, None, None, None
+        _lovart_waiter_seq += 1
+        heapq.heappush(_lovart_waiters, (priority, _lovart_waiter_seq, waiter))
+        _lovart_dispatch_locked()
+
+    waiter["event"].wait(timeout=max(0.0, timeout))
+
+    with _lovart_sessions_lock:
+        idx = waiter["index"]
+        if idx is None:
+            # Timed out: leave the queue (lazily removed by the dispatcher)
+            waiter["cancelled"] = True
+            return None, None, None, None
+        sess = _lovart_sessions[idx]
+        return idx, sess.get("loop"), sess.get("page"), waiter["generation"]
+
+def lovart_get_waiting_count() -> int:
+    with _lovart_sessions_lock:
+        return sum(1 for _, _, w in _lovart_waiters if not w["cancelled"])
+
+def lovart_get_idle_count() -> int:
+    """
+    Number of live sessions that are not currently busy.
+    """
+    with _lovart_sessions_lock:
+        return sum(
+            1 for sess in _lovart_sessions
+            if _lovart_session_alive(sess) and sess["inflight"] == 0
+        )
+
+def lovart_get_spare_capacity(shared: bool = True) -> int:
+    """
+    How many more requests the live sessions can take without queueing.
+    """
+    with _lovart_sessions_lock:
+        spare = 0
+        for sess in _lovart_sessions:
+            if not _lovart_session_fits(sess, shared):
+                continue
+            spare += (_lovart_session_capacity(sess) - sess["inflight"]) if shared else 1
+        return spare
+
+def lovart_get_session_task_limit(shared: bool = True) -> int:
+    return _LOVART_SESSION_MAX_TASKS if shared else 1
+
+def lovart_image_requests_shared() -> bool:
+    """
+    Image requests only use the page for signing / fetch in API mode.
+    """
+    return _LOVART_IMAGE_MODE.strip().lower() == "api"
+
+def lovart_mark_rate_limited(index: int):
+    """
+    Stop sharing this session for a while after Lovart rejected a request as rate limited.
+    """
+    with _lovart_sessions_lock:
+        if 0 <= index < len(_lovart_sessions):
+            _lovart_sessions[index]["rate_limited_until"] = time.time() + _LOVART_RATE_LIMIT_COOLDOWN
+
+def _lovart_close_in_background(index: int, generation: int):
+    threading.Thread(
+        target=lovart_close_session, args=(index,), kwargs={"generation": generation}, daemon=True
+    ).start()
 
-def lovart_release_session(index: int):
+def lovart_release_session(index: int, generation: int = None):
+    """
+    Give back a session from lovart_acquire_session. Releases for an older generation
+    of the slot (the session was closed and replaced meanwhile) are ignored.
+    A draining session is closed once its last holder has released it.
+    """
+    close_generation = None
     with _lovart_sessions_lock:
         if 0 <= index < len(_lovart_sessions):
             sess = _lovart_sessions[index]
-            busy_lock = sess.get("busy_lock")
-            sess["last_active"] = time.time() # Update on release too
-            try:
-                busy_lock.release()
-            except RuntimeError:
-                # Already released
-                pass
+            if generation is not None and generation != sess.get("generation"):
+                print(f"[Session {index}] [lovart] Ignoring release for replaced session (generation {generation})")
+            else:
+                sess["last_active"] = time.time() # Update on release too
+                # Already released / slot reset by lovart_close_session: stay at 0
+                sess["inflight"] = max(0, sess["inflight"] - 1)
+                if sess["inflight"] == 0:
+                    sess["exclusive"] = False
+                    if sess.get("draining") and _lovart_session_alive(sess):
+                        close_generation = sess["generation"]
+        _lovart_dispatch_locked()
+    if close_generation is not None:
+        print(f"[Session {index}] [lovart] Last holder released a draining session, closing it")
+        _lovart_close_in_background(index, close_generation)
+
+def lovart_retire_session(index: int, generation: int = None, reason: str = ""):
+    """
+    Stop dispatching to a session (low points, broken page). Requests still running on
+    it finish; it is closed when the last one releases (right away if nobody holds it).
+    """
+    close_generation = None
+    with _lovart_sessions_lock:
+        if not 0 <= index < len(_lovart_sessions):
+            return
+        sess = _lovart_sessions[index]
+        if generation is not None and generation != sess.get("generation"):
+            return
+        if not sess.get("draining"):
+            print(f"[Session {index}] [lovart] Retiring session ({reason or 'no reason'}), {sess['inflight']} request(s) still on it")
+        sess["draining"] = True
+        if sess["inflight"] == 0 and _lovart_session_alive(sess):
+            close_generation = sess["generation"]
+        # Waiters that can only be served by this session fail fast now
+        _lovart_dispatch_locked()
+    if close_generation is not None:
+        _lovart_close_in_background(index, close_generation)
+
+def lovart_session_error_is_fatal(index: int, error: Exception) -> bool:
+    """
+    Whether an exception during generation means the session itself is broken
+    (page / browser / CDP connection gone) rather than this one request failing.
+    """
+    with _lovart_sessions_lock:
+        if 0 <= index < len(_lovart_sessions) and not _lovart_session_alive(_lovart_sessions[index]):
+            return True
+    message = str(error).lower()
+    return any(marker in message for marker in (
+        "has been closed", "target closed", "connection closed", "browser closed", "disconnected", "event loop is closed",
+    ))
 
 def lovart_cleanup_idle_sessions(max_idle_seconds: float = 600.0):
     """
@@ -345,14 +909,14 @@ def lovart_cleanup_idle_sessions(max_idle_seconds: float = 600.0):
             if thread_obj and loop and not loop.is_closed():
                 last_active = sess.get("last_active", 0)
                 # Ensure we don't close a busy session
-                busy_lock = sess.get("busy_lock")
-                if not busy_lock.locked() and (now - last_active > max_idle_seconds) and last_active > 0:
-                    indices_to_close.append(idx)
+                if sess.get("inflight", 0) == 0 and (now - last_active > max_idle_seconds) and last_active > 0:
+                    indices_to_close.append((idx, sess["generation"]))
     
     if indices_to_close:
-        print(f"[lovart] Cleaning up idle sessions: {indices_to_close}")
-        for idx in indices_to_close:
-            lovart_close_session(idx)
+        print(f"[lovart] Cleaning up idle sessions: {[idx for idx, _ in indices_to_close]}")
+        for idx, generation in indices_to_close:
+            # Drains instead if a request picked the session up in the meantime
+            lovart_retire_session(idx, generation, reason="idle")
 
 async def lovart_ensure_viewport(page: Page, width: int = 1080, height: int = 1920):
     try:
@@ -666,7 +1230,7 @@ async def lovart_handle_security_verification(page: Page, prefix: str = "[lovart
     # 如果还是没消失，返回失败
     return not await modal.is_visible()
 
-async def _lovart_close_session_async(index: int = None):
+async def _lovart_close_session_async(index: int = None, generation: int = None):
     indices_to_close = []
     if index is not None:
         indices_to_close = [index]
@@ -679,6 +1243,9 @@ async def _lovart_close_session_async(index: int = None):
         
         if not sess:
             continue
+        if generation is not None and sess.get("generation") != generation:
+            continue # Already closed and replaced by a newer session
+        generation = sess.get("generation")
 
         browser = sess.get("browser")
         context = sess.get("context")
@@ -686,9 +1253,15 @@ async def _lovart_close_session_async(index: int = None):
 
         # For BitBrowser, we should close via API
         if bitbrowser_id:
-            close_bitbrowser_api(bitbrowser_id)
+            await asyncio.to_thread(close_bitbrowser_api, bitbrowser_id)
             # IMPORTANT: Delete the window to free up the 10-window limit for free users
-            delete_bitbrowser_window(bitbrowser_id)
+            await asyncio.to_thread(delete_bitbrowser_window, bitbrowser_id)
+            # Drop the CDP connection on the shared driver
+            try:
+                if browser:
+                    await browser.close()
+            except:
+                pass
             # Reset the global ID mapping so next time we create a new one
             if idx < len(BITBROWSER_IDS):
                 BITBROWSER_IDS[idx] = None
@@ -707,19 +1280,24 @@ async def _lovart_close_session_async(index: int = None):
                         pass
 
         with _lovart_sessions_lock:
-            # Preserve the lock
-            busy_lock = sess.get("busy_lock")
-            _lovart_sessions[idx] = {
+            if _lovart_sessions[idx].get("generation") != generation:
+                continue
+            # Requests still holding the closed page fail and retry elsewhere; their
+            # releases carry the old generation and are ignored
+            _lovart_install_slot_locked(idx, {
                 "thread": None,
                 "loop": None,
                 "browser": None,
                 "context": None,
                 "page": None,
-                "busy_lock": busy_lock if busy_lock else Lock(),
+                "inflight": 0,
+                "exclusive": False,
                 "bitbrowser_id": None,
-            }
+            })
+            # Other sessions may take the waiters; if none is left they fail fast
+            _lovart_dispatch_locked()
 
-def lovart_close_session(index: int = None, timeout: float = 30.0):
+def lovart_close_session(index: int = None, timeout: float = 30.0, generation: int = None):
     if index is not None:
         loop = None
         with _lovart_sessions_lock:
@@ -729,7 +1307,7 @@ def lovart_close_session(index: int = None, timeout: float = 30.0):
         if not loop or loop.is_closed():
             return
 
-        future = asyncio.run_coroutine_threadsafe(_lovart_close_session_async(index), loop)
+        future = asyncio.run_coroutine_threadsafe(_lovart_close_session_async(index, generation), loop)
         try:
             future.result(timeout=timeout)
         except:
@@ -756,7 +1334,7 @@ async def run_generate_video_on_page(page: Page, duration_label: str, start_fram
     if not page.url.startswith("https://www.lovart.ai/canvas"):
         await page.goto("https://www.lovart.ai/canvas", timeout=60000)
 
-    points = await _lovart_get_points_async(page)
+    points = await _lovart_session_points_async(page, session_index)
     if points < 20:
         return False, "积分低于20", {"points": points, "low_points": True}
 
@@ -878,8 +1456,18 @@ async def run_generate_video_on_page(page: Page, duration_label: str, start_fram
         "matched_json_url": None,
         "matched_json_status": None,
         "network_hits": [],
+        "quote": (None, None),
+        "charged": False,
     }
 
+    def _charge():
+        # Once per task: after the click, as soon as a quote is known (or at the end, stale)
+        if result["charged"]:
+            return
+        result["charged"] = True
+        balance, price = result["quote"]
+        _lovart_charge_points(session_index, price, balance)
+
     def _maybe_add_hit(hit: dict):
         if len(result["network_hits"]) >= 120:
             return
@@ -907,6 +1495,15 @@ async def run_generate_video_on_page(page: Page, duration_label: str, start_fram
 
     async def _on_response(response):
         nonlocal click_ts
+        if (response.url or "").startswith(_LOVART_PRICING_URL):
+            # The canvas quotes the price before generating: balance and price for the ledger
+            try:
+                result["quote"] = _lovart_quote_from_response(await response.json())
+            except Exception:
+                pass
+            if click_ts is not None and result["quote"][1] is not None:
+                _charge()
+            return
         if click_ts is None:
             return
 
@@ -967,6 +1564,8 @@ async def run_generate_video_on_page(page: Page, duration_label: str, start_fram
     click_ts = time.time()
     print(f"[lovart] click generate: {click_ts}")
     await generate_btn.click()
+    if result["quote"][1] is not None:
+        _charge() # Quoted while the form was filled in; otherwise booked when the quote arrives
     try:
         await lovart_handle_security_verification(page, prefix=prefix)
     except Exception:
@@ -983,6 +1582,7 @@ async def run_generate_video_on_page(page: Page, duration_label: str, start_fram
             "network_hits": result["network_hits"],
         }
     finally:
+        _charge() # No quote seen: the ledger is marked stale
         try:
             context.off("request", _on_request)
         except Exception:
@@ -1008,18 +1608,19 @@ async def run_generate_video_on_page(page: Page, duration_label: str, start_fram
         "matched_json_status": result["matched_json_status"],
     }
 
-async def _lovart_get_points_async(page: Page) -> int:
-    try:
-        await page.wait_for_load_state("domcontentloaded", timeout=10000)
-    except Exception:
-        pass
+async def _lovart_get_points_async(page: Page, wait_for_load: bool = True) -> int:
+    if wait_for_load:
+        try:
+            await page.wait_for_load_state("domcontentloaded", timeout=10000)
+        except Exception:
+            pass
 
-    try:
-        await page.wait_for_load_state("networkidle", timeout=10000)
-    except Exception:
-        pass
+        try:
+            await page.wait_for_load_state("networkidle", timeout=10000)
+        except Exception:
+            pass
 
-    await asyncio.sleep(1)
+        await asyncio.sleep(1)
 
     candidates = [
         page.locator('css=div.flex.min-w-10.items-center:has(svg[viewBox="0 0 16 24"]) span').first,
@@ -1051,6 +1652,119 @@ async def _lovart_get_points_async(page: Page) -> int:
         raise ValueError(f"无法解析积分: {last_seen_text}")
     raise ValueError("未找到积分元素")
 
+def _lovart_set_points(index: int, points: int):
+    with _lovart_sessions_lock:
+        if 0 <= index < len(_lovart_sessions):
+            sess = _lovart_sessions[index]
+            sess["points"] = points
+            sess["points_updated"] = time.time()
+            sess["points_stale"] = False
+
+def lovart_get_points(index: int):
+    """
+    Cached points balance of a session (None if unknown).
+    """
+    with _lovart_sessions_lock:
+        if 0 <= index < len(_lovart_sessions):
+            return _lovart_sessions[index].get("points")
+    return None
+
+_LOVART_PRICING_URL = "https://lgw.lovart.ai/v1/generator/pricing"
+
+def _lovart_quote_from_response(obj):
+    """
+    (balance, price) from a /v1/generator/pricing response, None for missing values.
+    Task / poll responses carry no balance; the pricing quote is the only source.
+    """
+    data = obj.get("data") if isinstance(obj, dict) else None
+    if not isinstance(data, dict):
+        return None, None
+    def _number(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value)
+        return None
+    return _number(data.get("balance")), _number(data.get("price"))
+
+def _lovart_charge_points(index: int, price: int = None, balance: int = None) -> bool:
+    """
+    Book a submitted task on the ledger: the lower of (cached balance - price) and
+    (quoted balance - price), so concurrent tasks on a session are all counted.
+    Without a price nothing can be booked: the ledger is marked stale instead.
+    """
+    if index < 0:
+        return False
+    with _lovart_sessions_lock:
+        if not 0 <= index < len(_lovart_sessions):
+            return False
+        sess = _lovart_sessions[index]
+        if price is None:
+            sess["points_stale"] = True
+            return False
+        candidates = []
+        if sess.get("points") is not None and not sess.get("points_stale", True):
+            candidates.append(sess["points"] - price)
+        if balance is not None:
+            candidates.append(balance - price)
+        if not candidates:
+            sess["points_stale"] = True
+            return False
+        sess["points"] = max(0, min(candidates))
+        sess["points_updated"] = time.time()
+        sess["points_stale"] = False
+        return True
+
+async def _lovart_session_points_async(page: Page, session_index: int = -1) -> int:
+    """
+    Pre-job points check: served from the session ledger (booked from pricing quotes
+    by _lovart_charge_points), scraping the DOM only when the ledger is empty, too
+    old, or a task could not be booked.
+    """
+    cached = None
+    if session_index >= 0:
+        with _lovart_sessions_lock:
+            sess = _lovart_sessions[session_index] if session_index < len(_lovart_sessions) else {}
+            cached = sess.get("points")
+            updated = sess.get("points_updated", 0)
+            stale = sess.get("points_stale", True)
+        if cached is not None and time.time() - updated < _LOVART_POINTS_MAX_AGE:
+            if not stale:
+                return cached
+            # A job ran since the last read: a quick DOM read (page is already loaded) is enough
+            try:
+                points = await _lovart_get_points_async(page, wait_for_load=False)
+                _lovart_set_points(session_index, points)
+                return points
+            except Exception:
+                pass
+
+    points = await _lovart_get_points_async(page)
+    if session_index >= 0:
+        _lovart_set_points(session_index, points)
+    return points
+
+async def _lovart_points_refresh_loop():
+    """
+    Background reconciliation of the points ledger (runs on the supervisor loop).
+    Only idle sessions are read, and only the DOM (no load-state waits).
+    """
+    while True:
+        await asyncio.sleep(_LOVART_POINTS_REFRESH_INTERVAL)
+        targets = []
+        now = time.time()
+        with _lovart_sessions_lock:
+            for idx, sess in enumerate(_lovart_sessions):
+                if not _lovart_session_alive(sess) or sess.get("inflight", 0) > 0:
+                    continue
+                if sess.get("points_stale", True) or now - sess.get("points_updated", 0) > _LOVART_POINTS_REFRESH_INTERVAL:
+                    targets.append((idx, sess.get("page")))
+
+        for idx, page in targets:
+            try:
+                points = await _lovart_get_points_async(page, wait_for_load=False)
+                _lovart_set_points(idx, points)
+            except Exception as e:
+                print(f"[Session {idx}] [lovart] Points refresh failed: {e}")
+
 async def _lovart_generate_video_async(index: int, page: Page, duration_label: str, start_frame_image_path: str, prompt: str):
     if not page:
         return False, "没有可用的浏览器会话，请先调用/register登陆", {}
@@ -1062,10 +1776,6 @@ async def _lovart_generate_video_async(index: int, page: Page, duration_label: s
         prompt=prompt,
         session_index=index
     )
-    if not success and data.get("low_points"):
-        await _lovart_close_session_async(index)
-        return success, message, data
-
     return success, message, data
 
 def lovart_generate_video(index: int, duration_label: str, start_frame_image_path: str, prompt: str, timeout: float = 900.0):
@@ -1274,7 +1984,7 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
         # Auto-create if ID is None, placeholder or invalid format (simple heuristic)
         if not browser_id or (isinstance(browser_id, str) and (browser_id.startswith("browser_id_") or "你的窗口ID" in browser_id)):
             print(f"⚠️ Detected invalid or missing ID '{browser_id}'. Attempting to auto-create a new BitBrowser window...")
-            new_id = create_bitbrowser_window(name_prefix=f"Lovart-Sess-{session_index}")
+            new_id = await asyncio.to_thread(create_bitbrowser_window, name_prefix=f"Lovart-Sess-{session_index}")
             if new_id:
                 browser_id = new_id
                 # Update the global list in memory so we reuse this ID for this session index in future retries
@@ -1288,12 +1998,12 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                 continue
 
         # Open BitBrowser
-        ws_endpoint = open_bitbrowser(browser_id)
+        ws_endpoint = await asyncio.to_thread(open_bitbrowser, browser_id)
         if not ws_endpoint:
              print("Failed to open BitBrowser. Retrying...")
              # If open failed, the ID might be deleted or invalid.
              # Try to delete it to ensure we don't leave a zombie record/window if it partially opened
-             delete_bitbrowser_window(browser_id)
+             await asyncio.to_thread(delete_bitbrowser_window, browser_id)
              
              # Clear ID to force creation next time
              if session_index < len(BITBROWSER_IDS):
@@ -1302,9 +2012,10 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
              await asyncio.sleep(5)
              continue
         
-        # Launch Playwright and Connect
-        async with async_playwright() as p:
+        # Connect through the pool's shared Playwright driver
+        async with _lovart_shared_playwright() as p:
             browser = None
+            session_stored = False
             try:
                 browser = await p.chromium.connect_over_cdp(ws_endpoint)
                 
@@ -1349,8 +2060,8 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                             print("Restarting browser session...")
                             retry_count += 1
                             # Close this session attempt properly
-                            close_bitbrowser_api(browser_id)
-                            delete_bitbrowser_window(browser_id) # Free up quota
+                            await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                            await asyncio.to_thread(delete_bitbrowser_window, browser_id) # Free up quota
                             if session_index < len(BITBROWSER_IDS):
                                 BITBROWSER_IDS[session_index] = None # Clear ID to force new creation
                             continue 
@@ -1360,21 +2071,25 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                                 print(f"登陆成功 (Session {session_index})，浏览器保持存活。")
                                 with _lovart_sessions_lock:
                                     if session_index < len(_lovart_sessions):
-                                        sess = _lovart_sessions[session_index]
-                                        busy_lock = sess.get("busy_lock")
-                                        _lovart_sessions[session_index] = {
+                                        _lovart_install_slot_locked(session_index, {
                                             "thread": threading.current_thread(),
                                             "loop": asyncio.get_running_loop(),
                                             "browser": browser,
                                             "context": context,
                                             "page": page,
-                                            "busy_lock": busy_lock if busy_lock else Lock(),
+                                            "inflight": 0,
+                                            "exclusive": False,
                                             "bitbrowser_id": browser_id,
-                                        }
+                                            "points": points,
+                                            "points_updated": time.time(),
+                                            "points_stale": False,
+                                        })
+                                    _lovart_dispatch_locked()
+                                page.on("close", lambda _: lovart_dispatch_sessions())
+                                session_stored = True
                                 if ready_event is not None:
                                     ready_event.set()
-                                while True:
-                                    await asyncio.sleep(3600)
+                            # A stored session lives on the supervisor loop; no need to park this coroutine
                             return True, "Login Reused", {"email": "existing"}
                     
 
@@ -1506,21 +2221,21 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                              except:
                                  print("Could not list buttons.")
                              await page.screenshot(path="debug_final_fail.png")
-                             close_bitbrowser_api(browser_id)
-                             delete_bitbrowser_window(browser_id)
+                             await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                             await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                              return False, "Could not find email input", {}
 
                     try:
                         print("Email input found. Fetching email...")
                         
                         # Get Email NOW (after confirming input exists)
-                        email, token = get_temp_email()
+                        email, token = await asyncio.to_thread(get_temp_email)
                         if not email:
                             print("Could not get email. Retrying...")
                             
                             # Cleanup before retry
-                            close_bitbrowser_api(browser_id)
-                            delete_bitbrowser_window(browser_id)
+                            await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                            await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                             if session_index < len(BITBROWSER_IDS):
                                 BITBROWSER_IDS[session_index] = None
                                 
@@ -1557,8 +2272,8 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                                  buttons = await page.locator('button').all_inner_texts()
                                  print(f"All buttons: {buttons}")
                                  await page.screenshot(path="debug_get_code_fail.png")
-                                 close_bitbrowser_api(browser_id)
-                                 delete_bitbrowser_window(browser_id)
+                                 await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                                 await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                                  return False, "Get Code button not visible", {}
                         else:
                             print("Get Code button not found.")
@@ -1566,8 +2281,8 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                             buttons = await page.locator('button').all_inner_texts()
                             print(f"All buttons: {buttons}")
                             await page.screenshot(path="debug_get_code_fail.png")
-                            close_bitbrowser_api(browser_id)
-                            delete_bitbrowser_window(browser_id)
+                            await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                            await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                             return False, "Get Code button not found", {}
                             
                         # Wait and Poll for Code
@@ -1575,7 +2290,7 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                         verification_code = None
                         for i in range(20): # 60 seconds approx (20 * 3)
                             await asyncio.sleep(3)
-                            verification_code = get_email_code(token)
+                            verification_code = await asyncio.to_thread(get_email_code, token)
                             if verification_code:
                                 print(f"{Fore.GREEN}Code received: {verification_code}{Style.RESET_ALL}")
                                 break
@@ -1612,8 +2327,8 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                                 print(f"{msg}. Retrying...")
                                 
                                 # Cleanup before retry
-                                close_bitbrowser_api(browser_id)
-                                delete_bitbrowser_window(browser_id)
+                                await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                                await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                                 if session_index < len(BITBROWSER_IDS):
                                     BITBROWSER_IDS[session_index] = None
                                     
@@ -1627,23 +2342,33 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
 
                             if keep_alive_after_code:
                                 print(f"登陆成功 (Session {session_index})，浏览器保持存活。")
+                                # Seed the points ledger (page is already on the canvas)
+                                login_points = None
+                                try:
+                                    login_points = await _lovart_get_points_async(page, wait_for_load=False)
+                                except Exception:
+                                    pass
                                 with _lovart_sessions_lock:
                                     if session_index < len(_lovart_sessions):
-                                        sess = _lovart_sessions[session_index]
-                                        busy_lock = sess.get("busy_lock")
-                                        _lovart_sessions[session_index] = {
+                                        _lovart_install_slot_locked(session_index, {
                                             "thread": threading.current_thread(),
                                             "loop": asyncio.get_running_loop(),
                                             "browser": browser,
                                             "context": context,
                                             "page": page,
-                                            "busy_lock": busy_lock if busy_lock else Lock(),
+                                            "inflight": 0,
+                                            "exclusive": False,
                                             "bitbrowser_id": browser_id,
-                                        }
+                                            "points": login_points,
+                                            "points_updated": time.time() if login_points is not None else 0,
+                                            "points_stale": login_points is None,
+                                        })
+                                    _lovart_dispatch_locked()
+                                page.on("close", lambda _: lovart_dispatch_sessions())
+                                session_stored = True
                                 if ready_event is not None:
                                     ready_event.set()
-                                while True:
-                                    await asyncio.sleep(3600)
+                                return True, "登陆成功", {"email": email}
 
                             if ready_event is not None:
                                 ready_event.set()
@@ -1653,14 +2378,14 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                                 
                         else:
                             print("Failed to receive code.")
-                            close_bitbrowser_api(browser_id)
-                            delete_bitbrowser_window(browser_id)
+                            await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                            await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                             return False, "Failed to receive code", {}
                             
                     except Exception as e:
                         print(f"Email input interaction failed: {e}")
-                        close_bitbrowser_api(browser_id)
-                        delete_bitbrowser_window(browser_id)
+                        await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                        await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                         return False, f"Email input interaction failed: {e}", {}
                 except Exception as e:
                      print(f"Inner loop exception: {e}")
@@ -1668,8 +2393,8 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                      traceback.print_exc()
                      
                      # Cleanup before retry
-                     close_bitbrowser_api(browser_id)
-                     delete_bitbrowser_window(browser_id)
+                     await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                     await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                      if session_index < len(BITBROWSER_IDS):
                          BITBROWSER_IDS[session_index] = None
                          
@@ -1682,36 +2407,73 @@ async def register_lovart_account(keep_alive_after_code: bool = False, ready_eve
                 traceback.print_exc()
                 
                 # Cleanup before retry
-                close_bitbrowser_api(browser_id)
-                delete_bitbrowser_window(browser_id)
+                await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                await asyncio.to_thread(delete_bitbrowser_window, browser_id)
                 if session_index < len(BITBROWSER_IDS):
                     BITBROWSER_IDS[session_index] = None
                     
                 retry_count += 1
                 continue
+            finally:
+                # The driver is shared by the whole pool: drop this CDP connection
+                # unless the browser now belongs to a session slot
+                if browser is not None and not session_stored:
+                    try:
+                        await browser.close()
+                    except Exception:
+                        pass
             
             # If we reach here, successful execution usually returns earlier or loop continues
             print("Session ended.")
             # If we are here, we are not keeping alive.
             if not keep_alive_after_code:
-                close_bitbrowser_api(browser_id)
-                delete_bitbrowser_window(browser_id) # Free up quota
+                await asyncio.to_thread(close_bitbrowser_api, browser_id)
+                await asyncio.to_thread(delete_bitbrowser_window, browser_id) # Free up quota
             break
             
     return False, "Max retries exceeded or unknown error", {}
 
-async def run_generate_image_on_page(page: Page, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", session_index: int = -1, image_paths: list = None):
-    prefix = f"[Session {session_index}] [lovart]" if session_index >= 0 else "[lovart]"
-    await lovart_ensure_viewport(page, width=_LOVART_VIEWPORT["width"], height=_LOVART_VIEWPORT["height"])
-    if not page.url.startswith("https://www.lovart.ai/canvas"):
-        await page.goto("https://www.lovart.ai/canvas", timeout=60000)
+# UI steps (navigation, menus, file chooser) must not interleave when several
+# requests share one page
+_lovart_ui_locks = weakref.WeakKeyDictionary()
 
-    points = await _lovart_get_points_async(page)
-    # Check if points are sufficient (assume same requirement as video or similar)
-    if points < 10: # Image generation might be cheaper
-         # Return error if points are too low, similar to video generation
-         return False, "积分低于10", {"points": points, "low_points": True} 
+def _lovart_ui_lock(page: Page) -> asyncio.Lock:
+    lock = _lovart_ui_locks.get(page)
+    if lock is None:
+        lock = asyncio.Lock()
+        _lovart_ui_locks[page] = lock
+    return lock
+
+def _lovart_is_rate_limited(error, response) -> bool:
+    text = f"{error or ''} {json.dumps(response, ensure_ascii=False) if response else ''}".lower()
+    return "http 429" in text or "rate limit" in text or "too many requests" in text
+
+def _lovart_get_project_id(page: Page):
+    import urllib.parse
+    try:
+        parsed = urllib.parse.urlparse(page.url)
+        return urllib.parse.parse_qs(parsed.query).get('projectId', [None])[0]
+    except Exception:
+        return None
+
+async def _lovart_wait_project_id(page: Page, timeout_ms: int = 10000):
+    """
+    The canvas adds ?projectId=... to the URL once the project is created.
+    """
+    project_id = _lovart_get_project_id(page)
+    if project_id:
+        return project_id
+    try:
+        await page.wait_for_url(re.compile(r".*[?&]projectId="), timeout=timeout_ms)
+    except Exception:
+        pass
+    return _lovart_get_project_id(page)
+
+async def _lovart_get_user_token(page: Page):
+    cookies = await page.context.cookies()
+    return next((c['value'] for c in cookies if c['name'] == 'usertoken'), None)
 
+async def _lovart_switch_to_image_mode(page: Page, prefix: str = "[lovart]"):
     # Check for limited-time offer pop-up and skip (User request)
     try:
         skip_btn = page.locator("button:has-text('Skip for now')").first
@@ -1741,195 +2503,1052 @@ async def run_generate_image_on_page(page: Page, start_frame_image_path: str, pr
     await lovart_close_right_bottom_popup(page)
     await lovart_scroll_canvas_up(page, pixels=100)
 
-    # 2. Upload Image(s)
-    # Combine start_frame_image_path into image_paths if not present
-    all_images = []
-    if image_paths:
-        all_images.extend(image_paths)
-    if start_frame_image_path and start_frame_image_path not in all_images:
-        all_images.insert(0, start_frame_image_path)
+
+async def _lovart_upload_images_via_ui(page: Page, all_images: list, prefix: str = "[lovart]") -> list:
+    """
+    Upload reference images through the canvas upload menu and read their URLs back from the DOM.
+    """
+    print(f"{prefix} Uploading {len(all_images)} reference images...")
+    ref_btn = page.get_by_test_id("generator-image-reference-button")
     
-    if all_images:
-        print(f"{prefix} Uploading {len(all_images)} reference images...")
-        ref_btn = page.get_by_test_id("generator-image-reference-button")
+    # Fallback: SVG Path for Upload Button (from user report)
+    if not await ref_btn.is_visible():
+        # Use XPath to find button with specific SVG path
+        # Path fragment: M10.866 8.662
+        # Also check for class 'reset-svg' to ensure it's a button
+        fallback_ref_btn = page.locator('xpath=//button[contains(@class, "reset-svg") and .//path[starts-with(@d, "M10.866 8.662")]]').first
+        if await fallback_ref_btn.is_visible():
+             print(f"{prefix} Using fallback upload button (XPath)...")
+             ref_btn = fallback_ref_btn
+        else:
+            # Try generic SVG path fragment match as last resort
+            upload_path_fragment = "M10.866 8.662"
+            fallback_ref_btn_2 = page.locator(f'button:has(svg path[d*="{upload_path_fragment}"])').first
+            if await fallback_ref_btn_2.is_visible():
+                 print(f"{prefix} Using fallback upload button (Generic SVG)...")
+                 ref_btn = fallback_ref_btn_2
+
+    await expect(ref_btn).to_be_visible(timeout=10000)
+    
+    # Debug: Print what button we are clicking
+    try:
+        btn_html = await ref_btn.evaluate("el => el.outerHTML")
+        print(f"{prefix} Clicking upload button: {btn_html[:300]}...") 
+    except Exception as e:
+        print(f"{prefix} Could not print upload button HTML: {e}")
+
+    # Robust click logic
+    upload_option = None
+    for attempt in range(3):
+        print(f"{prefix} Clicking upload button (attempt {attempt+1})...")
+        try:
+            await ref_btn.hover()
+            await asyncio.sleep(0.2)
+            await ref_btn.click(force=True)
+        except Exception as e:
+            print(f"{prefix} Standard click failed: {e}. Trying JS click.")
+            try:
+                await ref_btn.evaluate("el => el.click()")
+            except Exception as e2:
+                print(f"{prefix} JS click also failed: {e2}")
         
-        # Fallback: SVG Path for Upload Button (from user report)
-        if not await ref_btn.is_visible():
-            # Use XPath to find button with specific SVG path
-            # Path fragment: M10.866 8.662
-            # Also check for class 'reset-svg' to ensure it's a button
-            fallback_ref_btn = page.locator('xpath=//button[contains(@class, "reset-svg") and .//path[starts-with(@d, "M10.866 8.662")]]').first
-            if await fallback_ref_btn.is_visible():
-                 print(f"{prefix} Using fallback upload button (XPath)...")
-                 ref_btn = fallback_ref_btn
-            else:
-                # Try generic SVG path fragment match as last resort
-                upload_path_fragment = "M10.866 8.662"
-                fallback_ref_btn_2 = page.locator(f'button:has(svg path[d*="{upload_path_fragment}"])').first
-                if await fallback_ref_btn_2.is_visible():
-                     print(f"{prefix} Using fallback upload button (Generic SVG)...")
-                     ref_btn = fallback_ref_btn_2
-
-        await expect(ref_btn).to_be_visible(timeout=10000)
+        await asyncio.sleep(1)
+
+        # Check if menu opened
+        opt1 = page.get_by_test_id("generator-image-reference-option-uploadImageFromLocal")
+        if await opt1.is_visible():
+            upload_option = opt1
+            print(f"{prefix} Upload menu opened (found test-id).")
+            break
         
-        # Debug: Print what button we are clicking
+        # Fallback option check
+        opt2 = page.locator('div[role="menuitem"], button[role="menuitem"]').filter(has_text=re.compile(r"上传|Upload")).first
+        if await opt2.is_visible():
+            upload_option = opt2
+            print(f"{prefix} Upload menu opened (found text fallback).")
+            break
+    
+    if not upload_option:
+         print("[lovart] Upload menu did not open after retries.")
+         # Define it anyway so expect() fails with a clear timeout error
+         upload_option = page.get_by_test_id("generator-image-reference-option-uploadImageFromLocal")
+
+    await expect(upload_option).to_be_visible(timeout=5000)
+
+    async with page.expect_file_chooser() as fc_info:
+        await upload_option.hover()
+        await asyncio.sleep(0.2)
+        await upload_option.evaluate("(el) => el.click()")
+    file_chooser = await fc_info.value
+    
+    # Upload multiple files at once if supported, or verify if Lovart supports multiple selection
+    # Assuming set_files supports list for multiple files (paths or in-memory payloads)
+    await file_chooser.set_files([_lovart_file_payload(image) for image in all_images])
+    
+    # Wait for upload to complete (simple delay + network idle check)
+    print(f"{prefix} Waiting for image upload to complete...")
+    await asyncio.sleep(5)
+    try:
+         await page.wait_for_load_state("networkidle", timeout=3000)
+    except:
+         pass
+
+    target_image_url = None
+    print(f"{prefix} Searching for uploaded image URL in DOM...")
+    for _ in range(15):
+         # Look for images in artifacts/user path
+         imgs = await page.locator('img[src*="/artifacts/user/"]').all()
+         if imgs:
+             # Get the last one as it's likely the one we just uploaded
+             target_image_url = await imgs[-1].get_attribute("src")
+             print(f"{prefix} Found uploaded image: {target_image_url}")
+             break
+         await asyncio.sleep(1)
+    return [target_image_url] if target_image_url else []
+
+# Page helpers (request signer + reference uploader), installed once per page
+# (add_init_script + one evaluate for the already loaded document). The webpack
+# require function is stolen lazily on first use and cached in window.__lovartWebpack;
+# it is only re-resolved when the bundle hash (the set of loaded script URLs) changes.
+# Module ids come from common.js:
+#   signer        exports H(timestamp, uuid, "", "")      -> x-client-signature
+#   upload        exports DC(userUuid, file)              -> {file, url} (OSS upload used by the canvas)
+#   userinfo      exports C(force)                        -> {data: {uuid, ...}}
+#   link_artifact exports y(url, type)                    -> /artifacts/user/... URL
+_LOVART_WEBPACK_MODULES = {
+    "signer": int(os.environ.get("LOVART_SIGNER_MODULE_ID", 72736)),
+    "upload": int(os.environ.get("LOVART_UPLOAD_MODULE_ID", 19202)),
+    "userinfo": int(os.environ.get("LOVART_USERINFO_MODULE_ID", 14420)),
+    "link_artifact": int(os.environ.get("LOVART_LINK_ARTIFACT_MODULE_ID", 20269)),
+}
+_LOVART_PAGE_HELPERS_JS = """(() => {
+    if (window.__lovartSign) return;
+    const CHUNK_NAME = 'webpackChunk_shakkerai_web_pro';
+    const MODULES = %s;
+
+    const bundleHash = () => Array.from(document.querySelectorAll('script[src]'))
+        .map((s) => s.src).filter((src) => src.includes('/static/') || src.includes('common.')).sort().join('|');
+
+    // Hook into Webpack to steal the require function
+    const stealRequire = () => new Promise((resolve, reject) => {
+        const chunks = window[CHUNK_NAME];
+        if (!chunks) {
+            reject("Webpack chunk global " + CHUNK_NAME + " not found");
+            return;
+        }
+        chunks.push([[Symbol("stealer")], {}, (r) => resolve(r)]);
+    });
+
+    const getWebpack = async () => {
+        const hash = bundleHash();
+        const cached = window.__lovartWebpack;
+        if (!cached || cached.hash !== hash) {
+            window.__lovartWebpack = { hash, require: await stealRequire(), signer: null };
+        }
+        return window.__lovartWebpack;
+    };
+
+    const resolveSigner = (r) => {
+        try {
+            const mod = r(MODULES.signer);
+            if (mod && typeof mod.H === 'function') return mod.H;
+        } catch (e) {}
+        // Bundle changed: look for the module in the loaded factories (no network)
+        for (const id of Object.keys(r.m || {})) {
+            const src = String(r.m[id]);
+            if (!src.includes('x-client-signature') && !src.includes('.H=')) continue;
+            try {
+                const mod = r(id);
+                if (mod && typeof mod.H === 'function' && mod.H.length >= 2) return mod.H;
+            } catch (e) {}
+        }
+        throw new Error("Signature function H not found in webpack require");
+    };
+
+    window.__lovartSign = async (ts, uuid) => {
+        const wp = await getWebpack();
+        if (!wp.signer) wp.signer = resolveSigner(wp.require);
+        return wp.signer(ts, uuid, "", "");
+    };
+
+    const toFile = (item) => {
+        const bin = atob(item.base64);
+        const bytes = new Uint8Array(bin.length);
+        for (let i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+        return new File([bytes], item.name, { type: item.mimeType });
+    };
+
+    // Logged-in account uuid (null if not logged in)
+    window.__lovartAccount = async () => {
+        const r = (await getWebpack()).require;
+        const userinfo = await r(MODULES.userinfo).C(false);
+        return (userinfo && userinfo.data && userinfo.data.uuid) || null;
+    };
+
+    // Upload [{name, mimeType, base64}] in parallel; resolves to [{url} | {error}] in the same order
+    window.__lovartUpload = async (items, artifactType) => {
+        const r = (await getWebpack()).require;
+        const uploader = r(MODULES.upload);
+        const userUuid = await window.__lovartAccount();
+        if (!userUuid) throw new Error("user uuid not found");
+        let linker = null;
+        try { linker = r(MODULES.link_artifact); } catch (e) {}
+
+        return Promise.all(items.map(async (item) => {
+            try {
+                const res = await uploader.DC(userUuid, toFile(item));
+                let url = res && res.url;
+                if (!url) return { error: (res && res.errorMsg) || "No Upload Result" };
+                if (linker && typeof linker.y === 'function') {
+                    url = await linker.y(url, artifactType || 'image');
+                }
+                return { url };
+            } catch (e) {
+                return { error: String(e) };
+            }
+        }));
+    };
+
+    // Let Lovart fetch public URLs server-side (uploadLinkArtifacts); [{url} | {error}] in order
+    window.__lovartLinkUrls = async (urls, artifactType) => {
+        const r = (await getWebpack()).require;
+        const linker = r(MODULES.link_artifact);
+        if (!linker || typeof linker.y !== 'function') throw new Error("link_artifact module not found");
+
+        return Promise.all(urls.map(async (url) => {
+            try {
+                const linked = await linker.y(url, artifactType || 'image');
+                if (!linked || linked === url) return { error: "No Link Result" };
+                return { url: linked };
+            } catch (e) {
+                return { error: String(e) };
+            }
+        }));
+    };
+})();""" % json.dumps(_LOVART_WEBPACK_MODULES)
+
+_lovart_helper_pages = weakref.WeakSet()
+
+async def _lovart_install_page_helpers(page: Page):
+    if page not in _lovart_helper_pages:
+        # Survives navigations / reloads of this page
+        await page.add_init_script(_LOVART_PAGE_HELPERS_JS)
+        _lovart_helper_pages.add(page)
+    await page.evaluate(_LOVART_PAGE_HELPERS_JS)
+
+def lovart_sniff_image_mime(data: bytes):
+    """
+    Image mime type from magic bytes, None if not a supported image.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+def _lovart_guess_mime(path: str, data: bytes) -> str:
+    return lovart_sniff_image_mime(data) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+# Reference images decoded from requests are kept in memory as Playwright file payloads
+# ({name, mimeType, buffer}). Images above LOVART_SPOOL_THRESHOLD go to a spool directory
+# on tmpfs ({name, mimeType, path}), bounded by LOVART_SPOOL_MAX_BYTES; when the spool is
+# full they stay in memory. image_paths may mix these dicts with plain local paths.
+_LOVART_SPOOL_THRESHOLD = int(os.environ.get("LOVART_SPOOL_THRESHOLD", 8 * 1024 * 1024)) # Bytes
+_LOVART_SPOOL_MAX_BYTES = int(os.environ.get("LOVART_SPOOL_MAX_BYTES", 256 * 1024 * 1024)) # Bytes
+_LOVART_SPOOL_DIR = os.environ.get("LOVART_SPOOL_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "lovart_spool"
+)
+_LOVART_IMAGE_EXTS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/gif": ".gif"}
+_lovart_spool_lock = Lock()
+_lovart_spool_used = 0
+
+def _lovart_spool_reserve(size: int) -> bool:
+    global _lovart_spool_used
+    with _lovart_spool_lock:
+        if _lovart_spool_used + size > _LOVART_SPOOL_MAX_BYTES:
+            return False
+        _lovart_spool_used += size
+        return True
+
+def _lovart_spool_release(size: int):
+    global _lovart_spool_used
+    with _lovart_spool_lock:
+        _lovart_spool_used = max(0, _lovart_spool_used - size)
+
+def _lovart_clean_spool_dir(max_age: float = 3600):
+    """
+    Remove spool files left behind by a previous (crashed) process.
+    """
+    try:
+        now = time.time()
+        for name in os.listdir(_LOVART_SPOOL_DIR):
+            path = os.path.join(_LOVART_SPOOL_DIR, name)
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+    except OSError:
+        pass
+
+_lovart_startup_done = Event()
+
+def lovart_startup():
+    """
+    One-time process startup (called from main.py, never on import): load the artifact
+    map and clear stale spool files. Pool workers and hot-reloaded copies import this
+    module without touching shared files.
+    """
+    if _lovart_startup_done.is_set():
+        return
+    _lovart_startup_done.set()
+    with _lovart_artifact_map_lock:
+        _lovart_load_artifact_map()
+    _lovart_clean_spool_dir()
+
+def lovart_make_image_buffer(data: bytes, name_prefix: str = "lovart_upload") -> dict:
+    """
+    Wrap decoded image bytes as an upload item (mime type from magic bytes).
+    Release it with lovart_release_image_buffer once the request is done.
+    """
+    mime_type = lovart_sniff_image_mime(data) or "image/png"
+    name = f"{name_prefix}_{uuid.uuid4().hex}{_LOVART_IMAGE_EXTS.get(mime_type, '.png')}"
+    if len(data) > _LOVART_SPOOL_THRESHOLD and _lovart_spool_reserve(len(data)):
+        path = os.path.join(_LOVART_SPOOL_DIR, name)
         try:
-            btn_html = await ref_btn.evaluate("el => el.outerHTML")
-            print(f"{prefix} Clicking upload button: {btn_html[:300]}...") 
+            os.makedirs(_LOVART_SPOOL_DIR, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+            return {"name": name, "mimeType": mime_type, "path": path, "size": len(data)}
+        except OSError as e:
+            print(f"[lovart] Spool write failed, keeping {name} in memory: {e}")
+            _lovart_spool_release(len(data))
+    return {"name": name, "mimeType": mime_type, "buffer": data}
+
+def lovart_release_image_buffer(item):
+    if isinstance(item, dict) and item.get("path"):
+        path = item.pop("path")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        _lovart_spool_release(item.get("size", 0))
+
+# Optional reference downscaling (LOVART_REF_DOWNSCALE=1, needs Pillow): staged images of
+# at least LOVART_REF_DOWNSCALE_MIN_BYTES are shrunk to the longest edge the requested
+# resolution uses and re-encoded (LOVART_REF_FORMAT jpeg | webp, LOVART_REF_QUALITY).
+# Images with transparency are always written as WebP. Encoding runs in a process pool
+# (forkserver where available, else spawn; never fork, the server process is threaded)
+# so it never holds the GIL of the request threads. The task lives in lovart_shrink, which
+# the workers import; Pillow is only imported there. A result is used only if it is
+# smaller than the original.
+_LOVART_REF_DOWNSCALE = os.environ.get("LOVART_REF_DOWNSCALE", "0").lower() in ("1", "true", "yes")
+_LOVART_REF_DOWNSCALE_MIN_BYTES = int(os.environ.get("LOVART_REF_DOWNSCALE_MIN_BYTES", 1024 * 1024))
+_LOVART_REF_DOWNSCALE_WORKERS = int(os.environ.get("LOVART_REF_DOWNSCALE_WORKERS", min(4, os.cpu_count() or 1)))
+_LOVART_REF_FORMAT = os.environ.get("LOVART_REF_FORMAT", "jpeg").strip().lower()
+_LOVART_REF_QUALITY = int(os.environ.get("LOVART_REF_QUALITY", 90))
+_LOVART_REF_MAX_EDGE = {"1K": 1024, "2K": 2048, "4K": 4096}
+_lovart_shrink_lock = Lock()
+_lovart_shrink_pool = {"executor": None, "disabled": False}
+
+def _lovart_shrink_executor():
+    with _lovart_shrink_lock:
+        if _lovart_shrink_pool["disabled"]:
+            return None
+        if _lovart_shrink_pool["executor"] is None:
+            if importlib.util.find_spec("PIL") is None:
+                print("[lovart] LOVART_REF_DOWNSCALE is on but Pillow is not installed, references are uploaded as is")
+                _lovart_shrink_pool["disabled"] = True
+                return None
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _lovart_shrink_pool["executor"] = ProcessPoolExecutor(max_workers=_LOVART_REF_DOWNSCALE_WORKERS, mp_context=context)
+        return _lovart_shrink_pool["executor"]
+
+def lovart_shrink_image_buffers(items: list, resolution: str = "2K", timeout: float = 60.0):
+    """
+    Downscale / re-encode staged images (lovart_make_image_buffer) in place, in parallel.
+    No-op unless LOVART_REF_DOWNSCALE is set; failures keep the original image.
+    """
+    if not _LOVART_REF_DOWNSCALE or not items:
+        return
+    executor = _lovart_shrink_executor()
+    if executor is None:
+        return
+    max_edge = _LOVART_REF_MAX_EDGE.get((resolution or "2K").upper(), _LOVART_REF_MAX_EDGE["2K"])
+
+    futures = []
+    for item in items:
+        if not isinstance(item, dict) or item.get("mimeType") == "image/gif":
+            continue
+        size = item.get("size") or len(item.get("buffer") or b"")
+        if size < _LOVART_REF_DOWNSCALE_MIN_BYTES:
+            continue
+        try:
+            data = _lovart_image_bytes(item)
+            futures.append((item, size, executor.submit(_lovart_shrink_image, data, max_edge, _LOVART_REF_FORMAT, _LOVART_REF_QUALITY)))
         except Exception as e:
-            print(f"{prefix} Could not print upload button HTML: {e}")
+            print(f"[lovart] Reference downscale skipped for {item.get('name')}: {e}")
 
-        # Robust click logic
-        upload_option = None
-        for attempt in range(3):
-            print(f"{prefix} Clicking upload button (attempt {attempt+1})...")
-            try:
-                await ref_btn.hover()
-                await asyncio.sleep(0.2)
-                await ref_btn.click(force=True)
-            except Exception as e:
-                print(f"{prefix} Standard click failed: {e}. Trying JS click.")
-                try:
-                    await ref_btn.evaluate("el => el.click()")
-                except Exception as e2:
-                    print(f"{prefix} JS click also failed: {e2}")
-            
-            await asyncio.sleep(1)
+    for item, size, future in futures:
+        try:
+            result = future.result(timeout=timeout)
+        except Exception as e:
+            print(f"[lovart] Reference downscale failed for {item.get('name')}: {e}")
+            continue
+        if not result:
+            continue
+        data, mime_type = result
+        lovart_release_image_buffer(item) # Spooled original is no longer needed
+        item["name"] = os.path.splitext(item["name"])[0] + _LOVART_IMAGE_EXTS[mime_type]
+        item["mimeType"] = mime_type
+        item["buffer"] = data
+        item.pop("size", None)
+        print(f"[lovart] Reference {item['name']} downscaled: {size} -> {len(data)} bytes")
+
+def _lovart_image_bytes(item) -> bytes:
+    if isinstance(item, dict) and item.get("buffer") is not None:
+        return item["buffer"]
+    path = item["path"] if isinstance(item, dict) else item
+    with open(path, "rb") as f:
+        return f.read()
+
+def _lovart_image_name(item) -> str:
+    if isinstance(item, dict):
+        return item.get("name") or ""
+    return os.path.basename(item or "")
+
+def _lovart_image_label(item):
+    """
+    JSON-safe description of an image entry (path / URL, or the buffer's name).
+    """
+    return _lovart_image_name(item) if isinstance(item, dict) else item
 
-            # Check if menu opened
-            opt1 = page.get_by_test_id("generator-image-reference-option-uploadImageFromLocal")
-            if await opt1.is_visible():
-                upload_option = opt1
-                print(f"{prefix} Upload menu opened (found test-id).")
-                break
-            
-            # Fallback option check
-            opt2 = page.locator('div[role="menuitem"], button[role="menuitem"]').filter(has_text=re.compile(r"上传|Upload")).first
-            if await opt2.is_visible():
-                upload_option = opt2
-                print(f"{prefix} Upload menu opened (found text fallback).")
-                break
-        
-        if not upload_option:
-             print("[lovart] Upload menu did not open after retries.")
-             # Define it anyway so expect() fails with a clear timeout error
-             upload_option = page.get_by_test_id("generator-image-reference-option-uploadImageFromLocal")
+def _lovart_file_payload(item):
+    """
+    Argument for FileChooser.set_files: a path or an in-memory {name, mimeType, buffer}.
+    """
+    if isinstance(item, dict):
+        if item.get("buffer") is not None:
+            return {"name": item["name"], "mimeType": item["mimeType"], "buffer": item["buffer"]}
+        return item["path"]
+    return item
+
+def _lovart_read_upload_item(image) -> dict:
+    data = _lovart_image_bytes(image)
+    mime_type = image.get("mimeType") if isinstance(image, dict) else None
+    return {
+        "name": _lovart_image_name(image),
+        "mimeType": mime_type or _lovart_guess_mime(image, data),
+        "base64": base64.b64encode(data).decode("ascii"),
+    }
 
-        await expect(upload_option).to_be_visible(timeout=5000)
+# Uploaded reference cache: (account uuid, sha256 of the image bytes) -> artifact URL.
+# Clients resend the same character / style references; a hit skips the upload.
+_LOVART_REF_CACHE_TTL = int(os.environ.get("LOVART_REF_CACHE_TTL", 24 * 3600)) # Seconds
+_LOVART_REF_CACHE_SIZE = int(os.environ.get("LOVART_REF_CACHE_SIZE", 2048)) # Entries (LRU)
+_lovart_ref_cache_lock = Lock()
+_lovart_ref_cache = OrderedDict()
+_lovart_page_accounts = weakref.WeakKeyDictionary()
+
+def _lovart_image_digest(image) -> str:
+    if isinstance(image, dict) and image.get("buffer") is not None:
+        return hashlib.sha256(image["buffer"]).hexdigest()
+    h = hashlib.sha256()
+    with open(image["path"] if isinstance(image, dict) else image, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def lovart_ref_cache_get(account: str, digest: str):
+    if not account or _LOVART_REF_CACHE_SIZE <= 0:
+        return None
+    key = (account, digest)
+    with _lovart_ref_cache_lock:
+        entry = _lovart_ref_cache.get(key)
+        if entry is None:
+            return None
+        url, expires = entry
+        if time.time() > expires:
+            del _lovart_ref_cache[key]
+            return None
+        _lovart_ref_cache.move_to_end(key)
+        return url
 
-        async with page.expect_file_chooser() as fc_info:
-            await upload_option.hover()
-            await asyncio.sleep(0.2)
-            await upload_option.evaluate("(el) => el.click()")
-        file_chooser = await fc_info.value
-        
-        # Upload multiple files at once if supported, or verify if Lovart supports multiple selection
-        # Assuming set_files supports list for multiple files
-        await file_chooser.set_files(all_images)
-        
-        # Wait for upload to complete (simple delay + network idle check)
-        print(f"{prefix} Waiting for image upload to complete...")
-        await asyncio.sleep(5)
+def lovart_ref_cache_put(account: str, digest: str, url: str):
+    if not account or not url or _LOVART_REF_CACHE_SIZE <= 0:
+        return
+    with _lovart_ref_cache_lock:
+        _lovart_ref_cache[(account, digest)] = (url, time.time() + _LOVART_REF_CACHE_TTL)
+        _lovart_ref_cache.move_to_end((account, digest))
+        while len(_lovart_ref_cache) > _LOVART_REF_CACHE_SIZE:
+            _lovart_ref_cache.popitem(last=False)
+
+async def _lovart_get_account_id(page: Page):
+    """
+    Account uuid of the page's login (cached per page; None disables the reference cache).
+    """
+    account = _lovart_page_accounts.get(page)
+    if account:
+        return account
+    try:
+        if page not in _lovart_helper_pages:
+            await _lovart_install_page_helpers(page)
+        account = await page.evaluate("""async () => {
+            try {
+                return typeof window.__lovartAccount === 'function' ? await window.__lovartAccount() : null;
+            } catch (e) {
+                return null;
+            }
+        }""")
+    except Exception as e:
+        print(f"[lovart] Could not read account id: {e}")
+        account = None
+    if account:
+        _lovart_page_accounts[page] = account
+    return account
+
+def _lovart_is_remote_reference(path: str) -> bool:
+    return isinstance(path, str) and path.startswith(("http://", "https://"))
+
+async def _lovart_lookup_references(page: Page, image_paths: list):
+    """
+    Returns (account, digests, cached_urls); cached_urls[i] is None when image i must be uploaded.
+    Entries that are already Lovart artifact URLs (see lovart_resolve_artifact) are used as is.
+    """
+    if not image_paths:
+        return None, [], []
+    local_paths = [path for path in image_paths if not _lovart_is_remote_reference(path) and not _lovart_is_link_reference(path)]
+    account = None
+    local_digests = []
+    if local_paths:
+        account, local_digests = await asyncio.gather(
+            _lovart_get_account_id(page),
+            asyncio.gather(*[asyncio.to_thread(_lovart_image_digest, path) for path in local_paths]),
+        )
+    local_digests = iter(local_digests)
+    digests, cached_urls = [], []
+    for path in image_paths:
+        if _lovart_is_remote_reference(path):
+            digests.append(None)
+            cached_urls.append(path)
+        elif _lovart_is_link_reference(path):
+            digests.append(None)
+            cached_urls.append(None)
+        else:
+            digest = next(local_digests)
+            digests.append(digest)
+            cached_urls.append(lovart_ref_cache_get(account, digest))
+    return account, digests, cached_urls
+
+def _lovart_merge_references(account: str, digests: list, cached_urls: list, uploaded_urls: list, remember: bool = True) -> list:
+    """
+    Fill the cache misses with freshly uploaded URLs (input order) and remember them.
+    remember=False: URLs scraped from the canvas, which are not reliably matched to their files.
+    """
+    pending = [i for i, url in enumerate(cached_urls) if not url]
+    uploaded_urls = uploaded_urls or []
+    if len(uploaded_urls) != len(pending):
+        # Partial result (e.g. canvas upload found fewer images): don't cache, keep what we have
+        return [url for url in cached_urls if url] + [url for url in uploaded_urls if url]
+    urls = list(cached_urls)
+    for i, url in zip(pending, uploaded_urls):
+        urls[i] = url
+        if remember and digests[i]:
+            lovart_ref_cache_put(account, digests[i], url)
+    return [url for url in urls if url]
+
+async def lovart_upload_references(page: Page, image_paths: list, prefix: str = "[lovart]", artifact_type: str = "image"):
+    """
+    Upload reference images through the page's own OSS uploader (no file chooser,
+    no DOM polling). All images are uploaded in parallel inside one evaluate.
+    Returns the artifact URLs in input order, or None if any upload failed.
+    """
+    if not image_paths:
+        return []
+    items = await asyncio.gather(*[asyncio.to_thread(_lovart_read_upload_item, path) for path in image_paths])
+    if page not in _lovart_helper_pages:
+        await _lovart_install_page_helpers(page)
+
+    upload_js = """async ({items, artifactType}) => {
+        if (typeof window.__lovartUpload !== 'function') {
+            return { helpers_missing: true };
+        }
+        try {
+            return { results: await window.__lovartUpload(items, artifactType) };
+        } catch (e) {
+            return { error: e.toString() };
+        }
+    }"""
+    args = {"items": list(items), "artifactType": artifact_type}
+    started = time.time()
+    res = await page.evaluate(upload_js, args)
+    if res.get("helpers_missing"):
+        await _lovart_install_page_helpers(page)
+        res = await page.evaluate(upload_js, args)
+
+    if res.get("error") or res.get("helpers_missing"):
+        print(f"{prefix} ⚠️ Direct upload failed: {res.get('error') or 'page helpers missing'}")
+        return None
+    urls = []
+    for path, item in zip(image_paths, res.get("results") or []):
+        if not item.get("url"):
+            print(f"{prefix} ⚠️ Direct upload failed for {_lovart_image_name(path)}: {item.get('error')}")
+            return None
+        urls.append(item["url"])
+    if len(urls) != len(image_paths):
+        return None
+    print(f"{prefix} Uploaded {len(urls)} reference image(s) in {time.time() - started:.1f}s: {urls}")
+    return urls
+
+# Link references ({name, url, fetch}): public images Lovart fetches itself, so the bytes pass
+# neither through this server nor through the browser. If linking fails, fetch(url) (the
+# caller's downloader, returns bytes or None) gets the image and it is uploaded like any other.
+def _lovart_is_link_reference(image) -> bool:
+    return isinstance(image, dict) and bool(image.get("url"))
+
+async def _lovart_fetch_link_reference(image: dict, prefix: str = "[lovart]"):
+    fetch = image.get("fetch")
+    if not callable(fetch):
+        print(f"{prefix} ⚠️ Dropping reference {image['url']}: linking failed and no downloader was given")
+        return None
+    try:
+        return await asyncio.to_thread(fetch, image["url"])
+    except Exception as e:
+        print(f"{prefix} ⚠️ Failed to fetch {image['url']}: {e}")
+        return None
+
+async def _lovart_resolve_link_references(page: Page, images: list, prefix: str = "[lovart]") -> list:
+    """
+    Replace link references with Lovart artifact URLs (linked server-side by Lovart),
+    falling back to an in-memory copy from the reference's fetch(). Other entries are kept as is.
+    """
+    link_images = [image for image in images if _lovart_is_link_reference(image)]
+    if not link_images:
+        return images
+    links = [image["url"] for image in link_images]
+
+    linked = [None] * len(links)
+    try:
+        if page not in _lovart_helper_pages:
+            await _lovart_install_page_helpers(page)
+        res = await page.evaluate("""async ({urls, artifactType}) => {
+            if (typeof window.__lovartLinkUrls !== 'function') {
+                return { error: 'page helpers missing' };
+            }
+            try {
+                return { results: await window.__lovartLinkUrls(urls, artifactType) };
+            } catch (e) {
+                return { error: e.toString() };
+            }
+        }""", {"urls": links, "artifactType": "image"})
+        if res.get("error"):
+            print(f"{prefix} ⚠️ Linking reference URLs failed: {res['error']}")
+        for i, item in enumerate((res.get("results") or [])[:len(links)]):
+            linked[i] = item.get("url")
+    except Exception as e:
+        print(f"{prefix} ⚠️ Linking reference URLs failed: {e}")
+
+    missing = [image for image, artifact_url in zip(link_images, linked) if not artifact_url]
+    if missing:
+        print(f"{prefix} Fetching {len(missing)} reference URL(s) locally...")
+    fetched = iter(await asyncio.gather(*[_lovart_fetch_link_reference(image, prefix) for image in missing]))
+
+    resolved = []
+    linked = iter(linked)
+    for image in images:
+        if not _lovart_is_link_reference(image):
+            resolved.append(image)
+            continue
+        artifact_url = next(linked)
+        if artifact_url:
+            print(f"{prefix} Linked {image['url']} -> {artifact_url}")
+            resolved.append(artifact_url)
+            continue
+        data = next(fetched)
+        if data:
+            resolved.append({"name": image.get("name") or "reference", "mimeType": lovart_sniff_image_mime(data), "buffer": data})
+    return resolved
+
+async def _lovart_api_post(page: Page, api_url: str, token: str, payload: dict, prefix: str = "[lovart]"):
+    """
+    Signed POST to lgw.lovart.ai from inside the page.
+    Returns (response_json, error)
+    """
+    if page not in _lovart_helper_pages:
+        await _lovart_install_page_helpers(page)
+
+    fetch_js = """async ({url, payload, token}) => {
+        if (typeof window.__lovartSign !== 'function') {
+            return { signer_missing: true };
+        }
+        try {
+            // Generate UUID without dashes
+            const uuid = (crypto.randomUUID ? crypto.randomUUID() : 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
+                var r = Math.random() * 16 | 0, v = c == 'x' ? r : (r & 0x3 | 0x8);
+                return v.toString(16);
+            })).replace(/-/g, '');
+            const ts = Date.now().toString();
+
+            let signature = "";
+            try {
+                signature = await window.__lovartSign(ts, uuid);
+            } catch(e) {
+                return { error: "Signature generation failed: " + e.toString() };
+            }
+
+            const resp = await fetch(url, {
+                method: 'POST',
+                credentials: 'include', // IMPORTANT: Send cookies
+                headers: {
+                    'Content-Type': 'application/json',
+                    'token': token,
+                    'Accept': 'application/json, text/plain, */*',
+                    'x-req-uuid': uuid,
+                    'x-send-timestamp': ts,
+                    'x-client-signature': signature
+                },
+                body: JSON.stringify(payload)
+            });
+
+            const text = await resp.text();
+            let json = null;
+            try {
+                json = JSON.parse(text);
+            } catch(e) {}
+
+            return {
+                status: resp.status,
+                statusText: resp.statusText,
+                data: json,
+                text: text
+            };
+        } catch (e) {
+            return { error: e.toString() };
+        }
+    }"""
+    args = {"url": api_url, "payload": payload, "token": token}
+    fetch_result = await page.evaluate(fetch_js, args)
+    if fetch_result.get("signer_missing"):
+        # Document was replaced before the init script ran (e.g. about:blank -> canvas)
+        await _lovart_install_page_helpers(page)
+        fetch_result = await page.evaluate(fetch_js, args)
+        if fetch_result.get("signer_missing"):
+            return None, "签名函数安装失败"
+
+    if fetch_result.get("error"):
+        print(f"{prefix} ❌ Fetch Error inside browser: {fetch_result['error']}")
+        return None, fetch_result["error"]
+    if fetch_result.get("status") != 200:
+        print(f"{prefix} ❌ API Request failed: {fetch_result.get('status')} {fetch_result.get('text')}")
+        return fetch_result.get("data"), f"HTTP {fetch_result.get('status')}: {_lovart_truncate(fetch_result.get('text'))}"
+    return fetch_result.get("data") or {}, None
+
+# Prices per (generator, resolution, ratio, reference count): quoted once, then booked
+# without another round-trip until LOVART_PRICE_CACHE_TTL expires
+_LOVART_PRICE_CACHE_TTL = float(os.environ.get("LOVART_PRICE_CACHE_TTL", 600))
+_lovart_price_cache_lock = Lock()
+_lovart_price_cache = {} # key -> (price, ts)
+
+def _lovart_price_key(payload: dict):
+    args = payload.get("input_args") or {}
+    return (payload.get("generator_name"), args.get("resolution"), args.get("aspect_ratio"), len(args.get("image") or []))
+
+def _lovart_cached_price(payload: dict):
+    with _lovart_price_cache_lock:
+        entry = _lovart_price_cache.get(_lovart_price_key(payload))
+    if entry and time.time() - entry[1] < _LOVART_PRICE_CACHE_TTL:
+        return entry[0]
+    return None
+
+async def _lovart_api_quote(page: Page, token: str, payload: dict, prefix: str = "[lovart]"):
+    """
+    Price quote for a task payload: (balance, price), None when unknown.
+    """
+    quote_payload = {"generator_name": payload.get("generator_name"), "input_args": payload.get("input_args")}
+    try:
+        resp_data, error = await _lovart_api_post(page, _LOVART_PRICING_URL, token, quote_payload, prefix=prefix)
+    except Exception as e:
+        error = str(e)
+    if error:
+        print(f"{prefix} ⚠️ Pricing quote failed: {error}")
+        return None, None
+    balance, price = _lovart_quote_from_response(resp_data)
+    if price is not None:
+        with _lovart_price_cache_lock:
+            _lovart_price_cache[_lovart_price_key(payload)] = (price, time.time())
+    return balance, price
+
+async def _lovart_api_create_task(page: Page, token: str, payload: dict, prefix: str = "[lovart]"):
+    """
+    POST lgw.lovart.ai/v1/generator/tasks from inside the page (signed request).
+    Returns (task_id, response_json, error)
+    """
+    api_url = "https://lgw.lovart.ai/v1/generator/tasks"
+    print(f"{prefix} Sending POST to {api_url} via page.evaluate (fetch)...")
+    resp_data, error = await _lovart_api_post(page, api_url, token, payload, prefix=prefix)
+    if error:
+        return None, resp_data, error
+
+    task_id = (resp_data.get("data") or {}).get("generator_task_id")
+    if not task_id:
+        print(f"{prefix} ❌ Failed to get task_id. Response: {resp_data}")
+        return None, resp_data, "未获取到 generator_task_id"
+    return task_id, resp_data, None
+
+# Generator task polling: one poller coroutine per page tracks every outstanding
+# task id and checks all due tasks in a single evaluate. Poll times follow the
+# observed completion latencies: nothing is polled before the fastest recent
+# generations could finish, polling is tight around the usual completion window
+# and backs off after it.
+_LOVART_POLL_MIN_INTERVAL = float(os.environ.get("LOVART_POLL_MIN_INTERVAL", 1))
+_LOVART_POLL_MAX_INTERVAL = float(os.environ.get("LOVART_POLL_MAX_INTERVAL", 6))
+_LOVART_POLL_TIMEOUT = float(os.environ.get("LOVART_POLL_TIMEOUT", 300)) # 5 minutes
+_lovart_task_latencies = deque(maxlen=200) # Seconds from task creation to completion
+_lovart_pollers = weakref.WeakKeyDictionary() # page -> {"tasks": {task_id: task}, "wakeup": asyncio.Event, "runner": asyncio.Task}
+
+def _lovart_latency_quantile(q: float):
+    if len(_lovart_task_latencies) < 5:
+        return None
+    ordered = sorted(_lovart_task_latencies)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def _lovart_next_poll_delay(age: float, polls: int) -> float:
+    """
+    Delay before the next poll of a task created `age` seconds ago.
+    """
+    low = _lovart_latency_quantile(0.1)
+    high = _lovart_latency_quantile(0.9)
+    if low is None or high is None:
+        # No history yet: start fast, back off exponentially
+        return min(_LOVART_POLL_MAX_INTERVAL, _LOVART_POLL_MIN_INTERVAL * (1.5 ** polls))
+    if age < low:
+        # Too early to be done: sleep until the fast end of the distribution
+        return max(_LOVART_POLL_MIN_INTERVAL, low - age)
+    if age <= high:
+        return _LOVART_POLL_MIN_INTERVAL
+    # Slower than usual: back off relative to how late it is
+    overdue = (age - high) / max(high, 1.0)
+    return min(_LOVART_POLL_MAX_INTERVAL, _LOVART_POLL_MIN_INTERVAL * (1 + 4 * overdue))
+
+_LOVART_POLL_JS = """async ({tasks}) => {
+    // tasks: [{id, url, token}] -> {id: response json | null}
+    const out = {};
+    await Promise.all(tasks.map(async (t) => {
+        try {
+            const resp = await fetch(t.url, {
+                credentials: 'include',
+                headers: { 'token': t.token }
+            });
+            out[t.id] = await resp.json();
+        } catch(e) { out[t.id] = null; }
+    }));
+    return out;
+}"""
+
+async def _lovart_poller_loop(page: Page, poller: dict):
+    tasks = poller["tasks"]
+    while tasks:
+        now = time.time()
+        next_due = min(task["due"] for task in tasks.values())
+        if next_due > now:
+            poller["wakeup"].clear()
+            try:
+                await asyncio.wait_for(poller["wakeup"].wait(), timeout=next_due - now)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        due = [task for task in tasks.values() if task["due"] <= now]
         try:
-             await page.wait_for_load_state("networkidle", timeout=3000)
-        except:
-             pass
+            results = await page.evaluate(_LOVART_POLL_JS, {"tasks": [
+                {"id": task["id"], "url": f"https://lgw.lovart.ai/v1/generator/tasks?task_id={task['id']}", "token": task["token"]}
+                for task in due
+            ]})
+        except Exception as e:
+            # Page closed / navigated: fail everything still waiting on this page
+            for task in list(tasks.values()):
+                if not task["future"].done():
+                    task["future"].set_result((None, task["last"], f"轮询失败: {e}"))
+            tasks.clear()
+            break
+
+        now = time.time()
+        for task in due:
+            poll_res = results.get(task["id"])
+            task["polls"] += 1
+            age = now - task["created"]
+            outcome = None
+            if not poll_res:
+                print(f"{task['prefix']} Poll failed (network error?)")
+            else:
+                task["last"] = poll_res
+                status = (poll_res.get("data") or {}).get("status")
+                if status == "completed":
+                    artifacts = (poll_res.get("data") or {}).get("artifacts", [])
+                    _lovart_task_latencies.append(age)
+                    if artifacts:
+                        final_url = artifacts[0].get("content")
+                        print(f"{task['prefix']} ✅ Generation Completed in {age:.0f}s: {final_url}")
+                        outcome = (final_url, poll_res, None)
+                    else:
+                        outcome = (None, poll_res, "任务完成但没有返回图片")
+                elif status == "failed":
+                    print(f"{task['prefix']} ❌ Task Failed: {poll_res}")
+                    outcome = (None, poll_res, "生成任务失败")
+                elif task["polls"] % 5 == 1:
+                    print(f"{task['prefix']} Task status: {status}...")
+
+            if outcome is None and age >= task["timeout"]:
+                outcome = (None, task["last"], "生成任务超时")
+            if outcome is not None:
+                tasks.pop(task["id"], None)
+                if not task["future"].done():
+                    task["future"].set_result(outcome)
+            else:
+                task["due"] = now + _lovart_next_poll_delay(age, task["polls"])
+
+    if _lovart_pollers.get(page) is poller:
+        _lovart_pollers.pop(page, None)
+
+async def _lovart_api_poll_task(page: Page, token: str, task_id: str, prefix: str = "[lovart]", timeout: float = None):
+    """
+    Wait for a generator task through the page's shared poller.
+    Returns (artifact_url, last_response, error)
+    """
+    poller = _lovart_pollers.get(page)
+    if poller is None or poller["runner"].done():
+        poller = {"tasks": {}, "wakeup": asyncio.Event(), "runner": None}
+        _lovart_pollers[page] = poller
+
+    now = time.time()
+    future = asyncio.get_running_loop().create_future()
+    poller["tasks"][task_id] = {
+        "id": task_id,
+        "token": token,
+        "prefix": prefix,
+        "created": now,
+        "due": now + _lovart_next_poll_delay(0, 0),
+        "polls": 0,
+        "timeout": timeout or _LOVART_POLL_TIMEOUT,
+        "last": None,
+        "future": future,
+    }
+    if poller["runner"] is None:
+        poller["runner"] = asyncio.create_task(_lovart_poller_loop(page, poller))
+    else:
+        poller["wakeup"].set()
+
+    try:
+        return await future
+    finally:
+        poller["tasks"].pop(task_id, None)
+
+def _lovart_truncate(value, limit: int = 300):
+    if value is None:
+        return ""
+    value = str(value)
+    return value if len(value) <= limit else value[:limit] + "..."
+
+async def run_generate_image_on_page(page: Page, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", session_index: int = -1, image_paths: list = None, mode: str = None, mirror: bool = True):
+    """
+    mode:
+    - "api": 只用已登陆的页面做签名和 fetch，直接创建 / 轮询生成任务 (不操作画布 UI)
+    - "ui":  先切换画布的图片生成菜单，再走任务 API (旧流程，作为回退)
+    默认取 LOVART_IMAGE_MODE。
+    mirror=False: 返回 Lovart 原始地址，由调用方在释放会话后再上传七牛云 (lovart_mirror_image)。
+    image_paths 中以 http(s) 开头的条目视为 Lovart artifact 地址，直接放入 input_args.image；
+    dict 条目为内存中的图片 (lovart_make_image_buffer)，或 {name, url} 由 Lovart 服务端拉取的公网图片。
+    """
+    prefix = f"[Session {session_index}] [lovart]" if session_index >= 0 else "[lovart]"
+    mode = (mode or _LOVART_IMAGE_MODE).strip().lower()
+    async with _lovart_ui_lock(page):
+        await lovart_ensure_viewport(page, width=_LOVART_VIEWPORT["width"], height=_LOVART_VIEWPORT["height"])
+        if not page.url.startswith("https://www.lovart.ai/canvas"):
+            await page.goto("https://www.lovart.ai/canvas", timeout=60000)
+
+    points = await _lovart_session_points_async(page, session_index)
+    # Check if points are sufficient (assume same requirement as video or similar)
+    if points < 10: # Image generation might be cheaper
+         # Return error if points are too low, similar to video generation
+         return False, "积分低于10", {"points": points, "low_points": True}
+
+    # Combine start_frame_image_path into image_paths if not present
+    all_images = []
+    if image_paths:
+        all_images.extend(image_paths)
+    if start_frame_image_path and start_frame_image_path not in all_images:
+        all_images.insert(0, start_frame_image_path)
+
+    project_id = None
+    if mode == "api":
+        project_id = await _lovart_wait_project_id(page)
+        if not project_id:
+            print(f"{prefix} ⚠️ Project ID not found in URL. Falling back to UI mode...")
+            mode = "ui"
+
+    # Public URLs: let Lovart fetch them server-side
+    all_images = await _lovart_resolve_link_references(page, all_images, prefix=prefix)
+
+    # References this account has already uploaded are reused (content hash cache)
+    ref_account, ref_digests, cached_urls = await _lovart_lookup_references(page, all_images)
+    pending_images = [path for path, url in zip(all_images, cached_urls) if not url]
+    if len(pending_images) < len(all_images):
+        print(f"{prefix} Reusing {len(all_images) - len(pending_images)}/{len(all_images)} uploaded reference image(s)")
+
+    uploaded_urls = None
+    uploaded_via_ui = False
+    if mode == "api" and pending_images:
+        # Upload references directly through the page's uploader
+        uploaded_urls = await lovart_upload_references(page, pending_images, prefix=prefix)
+        if uploaded_urls is None:
+            print(f"{prefix} ⚠️ Falling back to the canvas upload menu...")
+
+    if mode == "ui" or (pending_images and uploaded_urls is None):
+        async with _lovart_ui_lock(page):
+            # 1. Switch to Image Mode
+            await _lovart_switch_to_image_mode(page, prefix=prefix)
+
+            # 2. Upload Image(s)
+            if pending_images and uploaded_urls is None:
+                uploaded_urls = await _lovart_upload_images_via_ui(page, pending_images, prefix=prefix)
+                uploaded_via_ui = True
+                if not uploaded_urls:
+                    print(f"{prefix} ⚠️ Could not find uploaded image URL. Proceeding without reference image (might fail if required).")
+    uploaded_urls = _lovart_merge_references(ref_account, ref_digests, cached_urls, uploaded_urls, remember=not uploaded_via_ui)
 
     # ---------------------------------------------------------
     # NEW: Reverse Engineering API Implementation
     # ---------------------------------------------------------
-    
+
     # Init result container (Same as old code)
     result = {
         "image_url": None,
         "cover_url": None,
         "network_hits": [],
+        "error": None,
     }
-    
+
     print(f"{prefix} [API MODE] Starting direct API generation...")
 
     # 1. Get Project ID
-    import urllib.parse
-    project_id = None
-    try:
-        parsed = urllib.parse.urlparse(page.url)
-        project_id = urllib.parse.parse_qs(parsed.query).get('projectId', [None])[0]
-    except Exception as e:
-        print(f"{prefix} Failed to parse URL for projectId: {e}")
+    if not project_id:
+        project_id = _lovart_get_project_id(page)
 
     # 2. Get Token
-    cookies = await page.context.cookies()
-    token = next((c['value'] for c in cookies if c['name'] == 'usertoken'), None)
-    
+    token = await _lovart_get_user_token(page)
+
     if not project_id:
-        print(f"{prefix} ⚠️ Project ID not found in URL. Attempting to fetch from local storage or wait...")
-        # Fallback: could try to execute script to get it
-    
-    # 3. Get Uploaded Image URL
-    # We uploaded images using UI above. Now we need to find their URLs in the DOM.
-    target_image_url = None
-    if start_frame_image_path or image_paths:
-        print(f"{prefix} Searching for uploaded image URL in DOM...")
-        for _ in range(15):
-             # Look for images in artifacts/user path
-             imgs = await page.locator('img[src*="/artifacts/user/"]').all()
-             if imgs:
-                 # Get the last one as it's likely the one we just uploaded
-                 target_image_url = await imgs[-1].get_attribute("src")
-                 print(f"{prefix} Found uploaded image: {target_image_url}")
-                 break
-             await asyncio.sleep(1)
-        
-        if not target_image_url:
-            print(f"{prefix} ⚠️ Could not find uploaded image URL. Proceeding without reference image (might fail if required).")
+        print(f"{prefix} ⚠️ Project ID not found in URL.")
 
-    # ---------------------------------------------------------
-    # PROBE: Search for Signature Generation Logic
-    # ---------------------------------------------------------
-    print(f"{prefix} Probing for X-Client-Signature logic in loaded scripts...")
-    signature_info = await page.evaluate("""async () => {
-        const scripts = Array.from(document.querySelectorAll('script[src]'));
-        for (const script of scripts) {
-            // Filter for likely candidates
-            if (script.src.includes('lovart') || script.src.includes('index') || script.src.includes('app') || script.src.includes('umi') || script.src.includes('pages')) {
-                try {
-                    const resp = await fetch(script.src);
-                    const text = await resp.text();
-                    // Search for the header string
-                    const idx = text.toLowerCase().indexOf('x-client-signature');
-                    if (idx !== -1) {
-                        const start = Math.max(0, idx - 800);
-                        const end = Math.min(text.length, idx + 1200);
-                        return { src: script.src, snippet: text.substring(start, end) };
-                    }
-                } catch (e) {}
-            }
-        }
-        return null;
-    }""")
-
-    if signature_info:
-        print(f"{prefix} ✅ Found signature code in {signature_info['src']}")
-        # Clean up snippet for printing
-        snippet = signature_info['snippet'].replace('\n', ' ').replace('\r', '')
-        print(f"{prefix} Snippet: {snippet[:2000]}...") # Limit length
-    else:
-        print(f"{prefix} ⚠️ Signature code not found in scripts.")
-    
-    # 4. Send API Request
+    # 3. Send API Request
     if token and project_id:
-        api_url = "https://lgw.lovart.ai/v1/generator/tasks"
-        
-        # Clean the image URL (remove query params like ?x-oss-process...)
-        clean_image_url = None
-        if target_image_url:
-             clean_image_url = target_image_url.split('?')[0]
-             print(f"{prefix} Cleaned image URL: {clean_image_url}")
-
-        api_images_list = []
-        if clean_image_url:
-            api_images_list.append(clean_image_url)
-            
+        # Clean the image URLs (remove query params like ?x-oss-process...)
+        api_images_list = [u.split('?')[0] for u in uploaded_urls if u]
+        if api_images_list:
+            print(f"{prefix} Reference images: {api_images_list}")
+
         payload = {
             "project_id": project_id,
             "generator_name": "vertex/anon-bob",
@@ -1940,159 +3559,39 @@ async def run_generate_image_on_page(page: Page, start_frame_image_path: str, pr
                 "image": api_images_list
             }
         }
-        
-        # Use page.evaluate to execute fetch in the browser context.
 
+        # Use page.evaluate to execute fetch in the browser context.
         # This ensures we share the exact network stack/proxy/cookies of the page.
-        # We also attempt to mock some headers.
         try:
-            print(f"{prefix} Sending POST to {api_url} via page.evaluate (fetch)...")
-            
-            # We inject a small script to perform the fetch
-            # Note: We now inject the signature generation logic via Webpack hook
-            fetch_result = await page.evaluate("""async ({url, payload, token}) => {
-                try {
-                    // 1. Define Helper to get Signature via Webpack Hook
-                    const getSignature = async (timestamp, uuid) => {
-                         return new Promise((resolve, reject) => {
-                            // Find the global webpack chunk array
-                            // Name might vary, but user logs showed 'webpackChunk_shakkerai_web_pro'
-                            const chunkName = 'webpackChunk_shakkerai_web_pro';
-                            if (!window[chunkName]) {
-                                reject("Webpack chunk global " + chunkName + " not found");
-                                return;
-                            }
-                            
-                            // Hook into Webpack to steal the require function
-                            window[chunkName].push([
-                                [Symbol("stealer")], 
-                                {}, 
-                                (r) => {
-                                    try {
-                                        // Module 72736 is the one exporting 'H' (signature function)
-                                        // based on our analysis of common.98186913.js
-                                        const mod = r(72736);
-                                        if (mod && mod.H) {
-                                            // H(timestamp, uuid, param3, param4)
-                                            // param3 and param4 appear to be empty strings in usage
-                                            const sig = mod.H(timestamp, uuid, "", "");
-                                            resolve(sig);
-                                        } else {
-                                            reject("Module 72736 or function H not found in webpack require");
-                                        }
-                                    } catch(e) {
-                                        reject(e);
-                                    }
-                                }
-                            ]);
-                         });
-                    };
-
-                    // 2. Prepare Data
-                    // Generate UUID without dashes
-                    const uuid = (crypto.randomUUID ? crypto.randomUUID() : 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
-                        var r = Math.random() * 16 | 0, v = c == 'x' ? r : (r & 0x3 | 0x8);
-                        return v.toString(16);
-                    })).replace(/-/g, '');
-                    
-                    const ts = Date.now().toString();
-
-                    // 3. Generate Signature
-                    let signature = "";
-                    try {
-                        console.log("[In-Page] Attempting to generate signature...");
-                        signature = await getSignature(ts, uuid);
-                        console.log("[In-Page] Signature generated: " + signature);
-                    } catch(e) {
-                        console.error("[In-Page] Signature generation failed:", e);
-                        return { error: "Signature generation failed: " + e.toString() };
-                    }
-
-                    // 4. Send Request
-                    console.log("[In-Page] Sending fetch request...");
-                    const resp = await fetch(url, {
-                        method: 'POST',
-                        credentials: 'include', // IMPORTANT: Send cookies
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'token': token,
-                            'Accept': 'application/json, text/plain, */*',
-                            'x-req-uuid': uuid,
-                            'x-send-timestamp': ts,
-                            'x-client-signature': signature
-                        },
-                        body: JSON.stringify(payload)
-                    });
-                    
-                    const text = await resp.text();
-                    let json = null;
-                    try {
-                        json = JSON.parse(text);
-                    } catch(e) {}
-                    
-                    return {
-                        status: resp.status,
-                        statusText: resp.statusText,
-                        data: json,
-                        text: text
-                    };
-                } catch (e) {
-                    return { error: e.toString() };
-                }
-            }""", {"url": api_url, "payload": payload, "token": token})
-            
-            if fetch_result.get("error"):
-                 print(f"{prefix} ❌ Fetch Error inside browser: {fetch_result['error']}")
-            elif fetch_result.get("status") == 200:
-                resp_data = fetch_result.get("data", {})
-                task_id = resp_data.get("data", {}).get("generator_task_id")
-                
-                if task_id:
-                    print(f"{prefix} ✅ Task created: {task_id}. Polling for result...")
-                    
-                    # Poll using fetch loop as well to be safe
-                    poll_url = f"https://lgw.lovart.ai/v1/generator/tasks?task_id={task_id}"
-                    
-                    for i in range(100): # 5 minutes
-                        await asyncio.sleep(3)
-                        
-                        poll_res = await page.evaluate("""async ({url, token}) => {
-                             try {
-                                const resp = await fetch(url, {
-                                    credentials: 'include',
-                                    headers: { 'token': token }
-                                });
-                                return await resp.json();
-                             } catch(e) { return null; }
-                        }""", {"url": poll_url, "token": token})
-                        
-                        if poll_res:
-                            status = poll_res.get("data", {}).get("status")
-                            
-                            if status == "completed":
-                                artifacts = poll_res.get("data", {}).get("artifacts", [])
-                                if artifacts:
-                                    final_url = artifacts[0].get("content")
-                                    print(f"{prefix} ✅ Generation Completed: {final_url}")
-                                    result["image_url"] = final_url
-                                    break
-                            elif status == "failed":
-                                print(f"{prefix} ❌ Task Failed: {poll_res}")
-                                break
-                            else:
-                                if i % 5 == 0:
-                                    print(f"{prefix} Task status: {status}...")
-                        else:
-                            print(f"{prefix} Poll failed (network error?)")
-                else:
-                    print(f"{prefix} ❌ Failed to get task_id. Response: {resp_data}")
+            # Known price: book it off the ledger without a quote; otherwise quote next to
+            # the create call (not before it), the balance may then already include this task
+            balance, price = None, _lovart_cached_price(payload)
+            if price is None:
+                (balance, price), (task_id, resp_data, error) = await asyncio.gather(
+                    _lovart_api_quote(page, token, payload, prefix=prefix),
+                    _lovart_api_create_task(page, token, payload, prefix=prefix),
+                )
             else:
-                print(f"{prefix} ❌ API Request failed: {fetch_result.get('status')} {fetch_result.get('text')}")
-                
+                task_id, resp_data, error = await _lovart_api_create_task(page, token, payload, prefix=prefix)
+            if task_id:
+                # Ledger: quoted price off the balance, no DOM read before the next job
+                _lovart_charge_points(session_index, price, balance)
+            if not task_id and session_index >= 0 and _lovart_is_rate_limited(error, resp_data):
+                print(f"{prefix} Rate limited, session will serve one request at a time for {_LOVART_RATE_LIMIT_COOLDOWN:.0f}s")
+                lovart_mark_rate_limited(session_index)
+
+            if task_id:
+                print(f"{prefix} ✅ Task created: {task_id}. Polling for result...")
+                final_url, poll_res, error = await _lovart_api_poll_task(page, token, task_id, prefix=prefix)
+                result["image_url"] = final_url
+            result["error"] = error
+
         except Exception as e:
             print(f"{prefix} API Exception: {e}")
+            result["error"] = str(e)
     else:
         print(f"{prefix} ❌ Cannot use API mode: Missing token or project_id.")
+        result["error"] = "缺少 token 或 projectId"
 
     # ---------------------------------------------------------
     # END API IMPLEMENTATION
@@ -2391,25 +3890,29 @@ async def run_generate_image_on_page(page: Page, start_frame_image_path: str, pr
     """
 
     if not result["image_url"]:
-         # Try to find the latest image on canvas?
-         # This might be complex without specific selectors.
-         pass
+        return False, f"图片生成失败: {result['error'] or '未获取到图片地址'}", {
+            "points": points,
+            "start_frame_image_path": _lovart_image_label(start_frame_image_path),
+        }
     
     # Upload to Qiniu if we have a URL
     final_url = result["image_url"]
-    if final_url:
+    if final_url and mirror:
         print(f"{prefix} Found image URL, uploading to Qiniu...")
-        cdn_url = upload_image_to_qiniu(final_url)
+        cdn_url = await lovart_mirror_to_qiniu(final_url)
         if cdn_url:
             final_url = cdn_url
-            
+    elif final_url:
+        lovart_record_artifact(final_url)
+
     return True, "图片生成完成", {
         "points": points,
-        "start_frame_image_path": start_frame_image_path,
-        "image_url": final_url
+        "start_frame_image_path": _lovart_image_label(start_frame_image_path),
+        "image_url": final_url,
+        "artifact_url": result["image_url"],
     }
 
-async def _lovart_generate_image_async(index: int, page: Page, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", image_paths: list = None):
+async def _lovart_generate_image_async(index: int, page: Page, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", image_paths: list = None, mirror: bool = True):
     if not page:
         return False, "没有可用的浏览器会话，请先调用/register登陆", {}
 
@@ -2420,15 +3923,12 @@ async def _lovart_generate_image_async(index: int, page: Page, start_frame_image
         prompt=prompt,
         resolution=resolution,
         ratio=ratio,
-        session_index=index
+        session_index=index,
+        mirror=mirror
     )
-    if not success and data.get("low_points"):
-        await _lovart_close_session_async(index)
-        return success, message, data
-
     return success, message, data
 
-def lovart_generate_image(index: int, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", timeout: float = 900.0, image_paths: list = None):
+def lovart_generate_image(index: int, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", timeout: float = 900.0, image_paths: list = None, mirror: bool = True):
     loop, page = lovart_get_session_by_index(index)
     if not loop or not page or loop.is_closed():
         return False, "没有可用的浏览器会话，请先调用/register登陆", {}
@@ -2440,7 +3940,8 @@ def lovart_generate_image(index: int, start_frame_image_path: str, prompt: str,
             image_paths=image_paths,
             prompt=prompt,
             resolution=resolution,
-            ratio=ratio
+            ratio=ratio,
+            mirror=mirror
         ),
         loop,
     )
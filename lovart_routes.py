@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, current_app
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import threading
 import os
@@ -8,7 +9,19 @@ import json
 import importlib.util
 import sys
 import re
+import math
+import functools
+import hashlib
+import uuid
+import base64
+import gzip
+import zlib
+import tempfile
+from urllib.parse import urlsplit
+from collections import deque, OrderedDict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Try to import from backend package first, then fallback to local/root import
 try:
@@ -20,9 +33,25 @@ try:
         lovart_close_session, 
         lovart_get_session_by_index,
         lovart_acquire_session,
+        lovart_get_idle_count,
+        lovart_get_spare_capacity,
+        lovart_get_session_task_limit,
+        lovart_image_requests_shared,
+        LOVART_PRIORITY_INTERACTIVE,
+        LOVART_PRIORITY_BATCH,
         lovart_release_session,
+        lovart_retire_session,
+        lovart_session_error_is_fatal,
         lovart_get_pool_size,
-        lovart_cleanup_idle_sessions
+        lovart_cleanup_idle_sessions,
+        lovart_run_on_supervisor,
+        lovart_mirror_image,
+        lovart_resolve_artifact,
+        lovart_make_image_buffer,
+        lovart_release_image_buffer,
+        lovart_shrink_image_buffers,
+        lovart_sniff_image_mime,
+        lovart_startup
     )
     _lovart_login_module_name = "backend.lovart_login"
 except ImportError:
@@ -34,9 +63,25 @@ except ImportError:
         lovart_close_session, 
         lovart_get_session_by_index,
         lovart_acquire_session,
+        lovart_get_idle_count,
+        lovart_get_spare_capacity,
+        lovart_get_session_task_limit,
+        lovart_image_requests_shared,
+        LOVART_PRIORITY_INTERACTIVE,
+        LOVART_PRIORITY_BATCH,
         lovart_release_session,
+        lovart_retire_session,
+        lovart_session_error_is_fatal,
         lovart_get_pool_size,
-        lovart_cleanup_idle_sessions
+        lovart_cleanup_idle_sessions,
+        lovart_run_on_supervisor,
+        lovart_mirror_image,
+        lovart_resolve_artifact,
+        lovart_make_image_buffer,
+        lovart_release_image_buffer,
+        lovart_shrink_image_buffers,
+        lovart_sniff_image_mime,
+        lovart_startup
     )
     _lovart_login_module_name = "lovart_login"
 
@@ -45,19 +90,57 @@ lovart_bp = Blueprint('lovart', __name__, url_prefix='/api/lovart')
 openai_bp = Blueprint('openai', __name__, url_prefix='/v1')
 
 # _lovart_generate_lock removed
-_lovart_init_lock = threading.Lock()
+# Per-slot launch reservations replace the old global init lock, so several slots
+# can run register_lovart_account in parallel.
+_LOVART_MAX_CONCURRENT_LAUNCHES = int(os.environ.get("LOVART_MAX_CONCURRENT_LAUNCHES", 3))
+# Slots with a register_lovart_account launch in flight: index -> {event, payload, started}
+_lovart_launch_cond = threading.Condition()
+_lovart_launching = {}
+_lovart_bootstrap_waiters = 0 # Requests waiting in _ensure_lovart_session
+
+_LOVART_IDLE_MAX_SECONDS = 5*60*60 # Idle sessions are closed after this long
+
+# Async job table (submit/poll mode)
+# 长耗时生成请求可以异步提交，立即返回 job id，由固定大小的线程池执行，避免大量阻塞的请求线程
+_LOVART_JOB_WORKERS = int(os.environ.get("LOVART_JOB_WORKERS", 16))
+_LOVART_JOB_TTL = int(os.environ.get("LOVART_JOB_TTL", 3600)) # Finished jobs are kept this long (seconds)
+_LOVART_MAX_QUEUED_JOBS = int(os.environ.get("LOVART_MAX_QUEUED_JOBS", 256)) # Async submissions beyond this get 503
+# A synchronous request attached to an identical / keyed job waits at most this long
+# (session wait + generation), then gets the 202 job response to poll instead
+_LOVART_ATTACH_TIMEOUT = float(os.environ.get("LOVART_ATTACH_TIMEOUT", 600 + 900))
+
+_lovart_job_executor = ThreadPoolExecutor(max_workers=_LOVART_JOB_WORKERS, thread_name_prefix="lovart-job")
+_lovart_jobs_lock = threading.Lock()
+_lovart_jobs = {}
+
+# Idempotency keys (Idempotency-Key header or "idempotency_key" body field):
+# (route, key) -> job id. Requests carrying a key always run as a job; a retry with the
+# same key attaches to the in-flight job or gets its stored result.
+_LOVART_IDEMPOTENCY_TTL = int(os.environ.get("LOVART_IDEMPOTENCY_TTL", 24 * 3600)) # Seconds a finished keyed job is kept
+_lovart_idempotency_keys = {}
+
+# Request coalescing (optional, LOVART_COALESCE_TTL > 0): requests without a key are
+# matched by payload fingerprint. Concurrent identical requests share one generation and
+# its result is served for LOVART_COALESCE_TTL seconds. (route, fingerprint) -> job id, LRU
+# bounded by entry count and by the size of the stored results.
+_LOVART_COALESCE_TTL = float(os.environ.get("LOVART_COALESCE_TTL", 0)) # Seconds, 0 = disabled
+_LOVART_COALESCE_MAX_ENTRIES = int(os.environ.get("LOVART_COALESCE_MAX_ENTRIES", 256))
+_LOVART_COALESCE_MAX_BYTES = int(os.environ.get("LOVART_COALESCE_MAX_BYTES", 8 * 1024 * 1024))
+_lovart_coalesce_cache = OrderedDict()
 
 # Background cleanup thread
 def _idle_cleanup_loop():
     while True:
         try:
-            lovart_cleanup_idle_sessions(max_idle_seconds=5*60*60)
+            lovart_cleanup_idle_sessions(max_idle_seconds=_LOVART_IDLE_MAX_SECONDS)
         except Exception as e:
             print(f"[lovart] Idle cleanup error: {e}")
+        try:
+            _cleanup_expired_jobs()
+        except Exception as e:
+            print(f"[lovart] Job cleanup error: {e}")
         time.sleep(60)
 
-threading.Thread(target=_idle_cleanup_loop, daemon=True).start()
-
 def _truncate_str(value, limit: int = 200):
     if value is None:
         return None
@@ -127,6 +210,9 @@ def _log_generate_image_request(route_name: str, payload: dict):
             "image_assets_count": len(assets),
             "image_assets_lens": [len(x) for x in assets[:20] if isinstance(x, str)],
         }
+        files = payload.get("image_files")
+        if isinstance(files, list):
+            summarized["image_files_lens"] = [len(x) for x in files[:20] if x]
         summarized = _sanitize_payload(summarized)
 
         print(
@@ -151,6 +237,665 @@ def _normalize_duration_label(duration) -> str:
         return raw
     return str(duration)
 
+def _wants_async(payload: dict) -> bool:
+    """
+    客户端是否请求异步模式:
+    - Body: "async": true
+    - Header: Prefer: respond-async
+    """
+    if isinstance(payload, dict):
+        flag = payload.get("async")
+        if isinstance(flag, str):
+            flag = flag.strip().lower() in ("1", "true", "yes", "on")
+        if flag:
+            return True
+    prefer = request.headers.get("Prefer", "") or ""
+    return "respond-async" in prefer.lower()
+
+def _unpack_response(rv):
+    """
+    Normalize a view return value (Response | (Response, status)) to (body, status).
+    """
+    if isinstance(rv, tuple):
+        resp, status = rv[0], int(rv[1])
+    else:
+        resp, status = rv, rv.status_code
+    if isinstance(resp, dict):
+        return resp, status
+    return resp.get_json(silent=True), status
+
+def _job_view(job: dict) -> dict:
+    return {
+        "id": job["id"],
+        "object": "job",
+        "route": job["route"],
+        "status": job["status"],
+        "created": int(job["created"]),
+        "updated": int(job["updated"]),
+        "http_status": job.get("http_status"),
+        "result": job.get("result"),
+    }
+
+def _new_job_locked(route_name: str) -> dict:
+    now = time.time()
+    job = {
+        "id": f"job_{uuid.uuid4().hex}",
+        "route": route_name,
+        "status": "queued",
+        "created": now,
+        "updated": now,
+        "http_status": None,
+        "result": None,
+        "done_event": threading.Event(),
+        "ttl": _LOVART_JOB_TTL,
+    }
+    _lovart_jobs[job["id"]] = job
+    return job
+
+def _run_job(job: dict, app, handler, payload: dict):
+    """
+    Run handler(payload) for a registered job inside an app context (so it can keep
+    using jsonify) and store its response as the job result.
+    """
+    with _lovart_jobs_lock:
+        job["status"] = "running"
+        job["updated"] = time.time()
+    body, status = None, 500
+    try:
+        with app.app_context():
+            body, status = _unpack_response(handler(payload))
+    except Exception as e:
+        print(f"[lovart_routes] Job {job['id']} failed: {e}")
+        body, status = {"status": "error", "message": str(e), "data": {}}, 500
+    finally:
+        result_size = len(json.dumps(body, ensure_ascii=False, default=str)) if body is not None else 0
+        with _lovart_jobs_lock:
+            job["status"] = "succeeded" if 200 <= int(status) < 300 else "failed"
+            job["http_status"] = status
+            job["result"] = body
+            job["result_size"] = result_size
+            job["updated"] = time.time()
+            if job.get("coalesce_key"):
+                _trim_coalesce_cache_locked()
+        job["done_event"].set()
+
+class _JobQueueFull(Exception):
+    pass
+
+def _submit_job(route_name: str, handler, payload: dict, job: dict = None) -> dict:
+    """
+    Register a job (unless given one) and run handler(payload) on the job pool.
+    Returns a snapshot of the job as submitted; raises _JobQueueFull when
+    LOVART_MAX_QUEUED_JOBS jobs are already waiting for a worker.
+    """
+    app = current_app._get_current_object()
+    with _lovart_jobs_lock:
+        queued = sum(1 for other in _lovart_jobs.values() if other["status"] == "queued" and other is not job)
+        if queued >= _LOVART_MAX_QUEUED_JOBS:
+            print(f"[lovart_routes] {route_name} rejected: {queued} jobs queued")
+            raise _JobQueueFull()
+        if job is None:
+            job = _new_job_locked(route_name)
+
+    if isinstance(payload, dict) and not payload.get("priority"):
+        payload = dict(payload, priority="batch")
+
+    view = _job_view(job)
+    _lovart_job_executor.submit(_run_job, job, app, handler, payload)
+    print(f"[lovart_routes] {route_name} submitted as {job['id']}")
+    return view
+
+def _idempotency_key(payload: dict):
+    key = request.headers.get("Idempotency-Key")
+    if not key and isinstance(payload, dict):
+        key = payload.get("idempotency_key")
+    key = str(key).strip() if key else ""
+    return key[:255] or None
+
+def _fingerprint_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return hashlib.sha256(value).hexdigest() # Uploaded image files
+    return str(value)
+
+def _payload_fingerprint(payload: dict) -> str:
+    """
+    Hash of the request parameters (transport-only fields excluded) to catch key reuse.
+    """
+    if isinstance(payload, dict):
+        payload = {k: v for k, v in payload.items() if k not in ("async", "idempotency_key", "priority")}
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=_fingerprint_default)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _mark_replayed(rv, header: str = "Idempotent-Replayed"):
+    resp = rv[0] if isinstance(rv, tuple) else rv
+    resp.headers[header] = "true"
+    return rv
+
+def _claim_keyed_job_locked(route_name: str, key: str, fingerprint: str):
+    """
+    Returns (job, created); job is None when the key was used with other parameters.
+    """
+    scoped_key = (route_name, key)
+    job = _lovart_jobs.get(_lovart_idempotency_keys.get(scoped_key))
+    # A failed attempt does not hold the key: the retry generates again
+    if job is not None and job["status"] != "failed":
+        return (job, False) if job["fingerprint"] == fingerprint else (None, False)
+    job = _new_job_locked(route_name)
+    job["fingerprint"] = fingerprint
+    job["idempotency_key"] = scoped_key
+    job["ttl"] = max(_LOVART_JOB_TTL, _LOVART_IDEMPOTENCY_TTL)
+    _lovart_idempotency_keys[scoped_key] = job["id"]
+    return job, True
+
+def _coalesce_entry_live(job: dict, now: float) -> bool:
+    if job is None or job["status"] == "failed":
+        return False
+    return job["status"] != "succeeded" or now - job["updated"] <= _LOVART_COALESCE_TTL
+
+def _claim_coalesced_job_locked(route_name: str, fingerprint: str):
+    """
+    Returns (job, created): the in-flight / recently finished identical job, or a new one.
+    """
+    scoped_key = (route_name, fingerprint)
+    job = _lovart_jobs.get(_lovart_coalesce_cache.get(scoped_key))
+    if _coalesce_entry_live(job, time.time()):
+        _lovart_coalesce_cache.move_to_end(scoped_key)
+        return job, False
+    job = _new_job_locked(route_name)
+    job["fingerprint"] = fingerprint
+    job["coalesce_key"] = scoped_key
+    _lovart_coalesce_cache[scoped_key] = job["id"]
+    _lovart_coalesce_cache.move_to_end(scoped_key)
+    _trim_coalesce_cache_locked()
+    return job, True
+
+def _trim_coalesce_cache_locked():
+    now = time.time()
+    for scoped_key, job_id in list(_lovart_coalesce_cache.items()):
+        if not _coalesce_entry_live(_lovart_jobs.get(job_id), now):
+            del _lovart_coalesce_cache[scoped_key]
+    total = sum(_lovart_jobs[job_id].get("result_size", 0) for job_id in _lovart_coalesce_cache.values())
+    while _lovart_coalesce_cache and (len(_lovart_coalesce_cache) > _LOVART_COALESCE_MAX_ENTRIES or total > _LOVART_COALESCE_MAX_BYTES):
+        _, job_id = _lovart_coalesce_cache.popitem(last=False)
+        total -= _lovart_jobs[job_id].get("result_size", 0)
+
+def _reject_job(job: dict, rv):
+    """
+    Finish a claimed job that could not be queued with the busy response, so requests
+    attached to it return and its key / fingerprint can be used again.
+    """
+    body, status = _unpack_response(rv)
+    with _lovart_jobs_lock:
+        job["status"] = "failed"
+        job["http_status"] = status
+        job["result"] = body
+        job["updated"] = time.time()
+    job["done_event"].set()
+
+def _handle_generation(route_name: str, handler, payload: dict, accepted_response, conflict_response, busy_response):
+    """
+    Dispatch a generation request: sync or async (_wants_async), de-duplicated by
+    idempotency key, or by payload fingerprint when coalescing is enabled.
+    accepted_response(job_view) builds the 202 body of the route,
+    conflict_response() the error for a key reused with different parameters,
+    busy_response() the 503 for a full job queue.
+    """
+    key = _idempotency_key(payload)
+    wants_async = _wants_async(payload)
+    if not key and _LOVART_COALESCE_TTL <= 0:
+        if wants_async:
+            try:
+                return accepted_response(_submit_job(route_name, handler, payload))
+            except _JobQueueFull:
+                return busy_response()
+        return handler(payload)
+
+    fingerprint = _payload_fingerprint(payload)
+    with _lovart_jobs_lock:
+        if key:
+            job, created = _claim_keyed_job_locked(route_name, key, fingerprint)
+        else:
+            job, created = _claim_coalesced_job_locked(route_name, fingerprint)
+    if job is None:
+        return conflict_response()
+
+    if created:
+        if wants_async:
+            try:
+                return accepted_response(_submit_job(route_name, handler, payload, job=job))
+            except _JobQueueFull:
+                rv = busy_response()
+                _reject_job(job, rv)
+                return rv
+        _run_job(job, current_app._get_current_object(), handler, payload)
+        return jsonify(job["result"]), job["http_status"]
+
+    if key:
+        print(f"[lovart_routes] {route_name} Idempotency-Key {key!r} matches {job['id']} ({job['status']})")
+        header = "Idempotent-Replayed"
+    else:
+        print(f"[lovart_routes] {route_name} coalesced onto identical {job['id']} ({job['status']})")
+        header = "X-Lovart-Coalesced"
+    if wants_async:
+        return _mark_replayed(accepted_response(_job_view(job)), header)
+    if not job["done_event"].wait(timeout=_LOVART_ATTACH_TIMEOUT):
+        print(f"[lovart_routes] {route_name} still waiting on {job['id']} after {_LOVART_ATTACH_TIMEOUT}s, returning the job")
+        return _mark_replayed(accepted_response(_job_view(job)), header)
+    return _mark_replayed((jsonify(job["result"]), job["http_status"]), header)
+
+def _get_job(job_id: str):
+    with _lovart_jobs_lock:
+        return _lovart_jobs.get(job_id)
+
+def _cleanup_expired_jobs():
+    now = time.time()
+    with _lovart_jobs_lock:
+        expired = [
+            job_id for job_id, job in _lovart_jobs.items()
+            if job["status"] in ("succeeded", "failed") and now - job["updated"] > job.get("ttl", _LOVART_JOB_TTL)
+        ]
+        for job_id in expired:
+            job = _lovart_jobs.pop(job_id, None)
+            scoped_key = job and job.get("idempotency_key")
+            if scoped_key and _lovart_idempotency_keys.get(scoped_key) == job_id:
+                _lovart_idempotency_keys.pop(scoped_key, None)
+        _trim_coalesce_cache_locked()
+    if expired:
+        print(f"[lovart] Removed {len(expired)} expired jobs")
+
+# ---------------------------------------------------------
+# Input preprocessing
+# ---------------------------------------------------------
+# Decoding / downloading reference images runs on the prep pool while the request
+# waits for a session, so the job starts with its inputs already staged.
+_LOVART_PREP_WORKERS = int(os.environ.get("LOVART_PREP_WORKERS", 8))
+_lovart_prep_executor = ThreadPoolExecutor(max_workers=_LOVART_PREP_WORKERS, thread_name_prefix="lovart-prep")
+
+# Request size limits (bytes): whole body after Content-Encoding, and each decoded image
+_LOVART_MAX_REQUEST_BYTES = int(os.environ.get("LOVART_MAX_REQUEST_BYTES", 64 * 1024 * 1024))
+_LOVART_MAX_IMAGE_BYTES = int(os.environ.get("LOVART_MAX_IMAGE_BYTES", 20 * 1024 * 1024))
+
+class _InputError(Exception):
+    """
+    Invalid client input (-> HTTP 400, or status, e.g. 413 for oversized input).
+    """
+    def __init__(self, message: str, param: str = None, status: int = 400):
+        super().__init__(message)
+        self.param = param
+        self.status = status
+
+def _read_json_payload() -> dict:
+    """
+    Read the JSON body from the request stream in chunks, capped at LOVART_MAX_REQUEST_BYTES.
+    gzip / deflate bodies (Content-Encoding) are inflated on the fly and the cap applies to
+    the inflated size. Unlike get_json the raw body is not kept on the request.
+    Invalid JSON gives {} (like get_json(silent=True)).
+    """
+    length = request.content_length
+    if length is not None and length > _LOVART_MAX_REQUEST_BYTES:
+        raise _InputError(f"Request body exceeds {_LOVART_MAX_REQUEST_BYTES} bytes", status=413)
+
+    encoding = (request.headers.get("Content-Encoding") or "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding != "deflate" else zlib.MAX_WBITS)
+    elif encoding == "identity":
+        inflater = None
+    else:
+        raise _InputError(f"Unsupported Content-Encoding: {encoding}", status=415)
+
+    body = bytearray()
+    try:
+        while True:
+            chunk = request.stream.read(256 * 1024)
+            if not chunk:
+                break
+            if inflater is not None:
+                # Bounded output per step guards against decompression bombs
+                chunk = inflater.decompress(chunk, _LOVART_MAX_REQUEST_BYTES + 1 - len(body))
+            body += chunk
+            if len(body) > _LOVART_MAX_REQUEST_BYTES:
+                raise _InputError(f"Request body exceeds {_LOVART_MAX_REQUEST_BYTES} bytes", status=413)
+        if inflater is not None:
+            body += inflater.flush()
+    except zlib.error as e:
+        raise _InputError(f"Invalid {encoding} request body: {e}")
+    if len(body) > _LOVART_MAX_REQUEST_BYTES:
+        # flush() can still emit buffered output past the cap
+        raise _InputError(f"Request body exceeds {_LOVART_MAX_REQUEST_BYTES} bytes", status=413)
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+def _image_too_large(b64_str: str) -> bool:
+    return len(b64_str) * 3 // 4 > _LOVART_MAX_IMAGE_BYTES
+
+class _PrepWake:
+    """
+    Hands out a fresh wake event for each lovart_acquire_session call (the dispatcher
+    sets the event it was given, e.g. when the last session dies, so one event cannot
+    be reused across attempts); a preprocessing failure sets the current one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = None
+        self._failed = False
+
+    def event(self) -> threading.Event:
+        with self._lock:
+            self._event = threading.Event()
+            if self._failed:
+                self._event.set()
+            return self._event
+
+    def fail(self):
+        with self._lock:
+            self._failed = True
+            if self._event is not None:
+                self._event.set()
+
+def _start_preprocessing(prepare):
+    """
+    Run prepare() on the prep pool. Returns (future, wake); wake.event() is passed to
+    lovart_acquire_session and is set when preprocessing fails so the wait ends early.
+    """
+    wake = _PrepWake()
+    future = _lovart_prep_executor.submit(prepare)
+
+    def _on_done(f):
+        if f.exception() is not None:
+            wake.fail()
+
+    future.add_done_callback(_on_done)
+    return future, wake
+
+def _preprocessing_failed(future, wait: bool = False) -> bool:
+    if not wait and not future.done():
+        return False
+    return future.exception() is not None
+
+def _decode_base64_image(b64_str: str) -> bytes:
+    """
+    Decode a base64 / data-URI image. Non-images are rejected from the first bytes,
+    before the rest is decoded.
+    """
+    if "," in b64_str:
+        b64_str = b64_str.split(",", 1)[1]
+    b64_str = b64_str.strip()
+    try:
+        head = base64.b64decode(b64_str[:16])
+    except ValueError:
+        head = None # Line breaks etc. in the first block: sniff after decoding
+    if head is not None and not lovart_sniff_image_mime(head):
+        raise ValueError("not a PNG / JPEG / WebP / GIF image")
+    image_data = base64.b64decode(b64_str)
+    if head is None and not lovart_sniff_image_mime(image_data):
+        raise ValueError("not a PNG / JPEG / WebP / GIF image")
+    return image_data
+
+def _stage_image(image_data: bytes, name_prefix: str, staged_images: list) -> dict:
+    """
+    Keep a decoded image in memory (large ones spooled to tmpfs) for the upload step.
+    """
+    image = lovart_make_image_buffer(image_data, name_prefix)
+    staged_images.append(image)
+    return image
+
+def _release_staged_images(staged_images: list, prep=None):
+    """
+    Drop staged images; if preprocessing is still running, release them once it finishes.
+    """
+    def _release(_=None):
+        for image in list(staged_images):
+            lovart_release_image_buffer(image)
+
+    if prep is not None and not prep.done():
+        prep.add_done_callback(_release)
+    else:
+        _release()
+
+# ---------------------------------------------------------
+# Prompt image downloader
+# ---------------------------------------------------------
+# Reference URLs found in prompts are fetched concurrently through one pooled session
+# (bounded pool + per-host limit), streamed into memory with the per-image size cap.
+# Responses with an ETag are kept in an LRU disk cache keyed by URL + ETag and
+# revalidated with If-None-Match.
+_LOVART_DOWNLOAD_WORKERS = int(os.environ.get("LOVART_DOWNLOAD_WORKERS", 8))
+_LOVART_DOWNLOAD_PER_HOST = int(os.environ.get("LOVART_DOWNLOAD_PER_HOST", 3))
+_LOVART_DOWNLOAD_TIMEOUT = float(os.environ.get("LOVART_DOWNLOAD_TIMEOUT", 60))
+# The cache owns a subdirectory of LOVART_DOWNLOAD_CACHE_DIR; an index file there lets it survive restarts
+_LOVART_DOWNLOAD_CACHE_DIR = os.path.join(os.environ.get("LOVART_DOWNLOAD_CACHE_DIR") or tempfile.gettempdir(), "lovart_download_cache")
+_LOVART_DOWNLOAD_CACHE_INDEX = os.path.join(_LOVART_DOWNLOAD_CACHE_DIR, "index.json")
+_LOVART_DOWNLOAD_CACHE_BYTES = int(os.environ.get("LOVART_DOWNLOAD_CACHE_BYTES", 512 * 1024 * 1024)) # 0 = disabled
+
+_lovart_download_executor = ThreadPoolExecutor(max_workers=_LOVART_DOWNLOAD_WORKERS, thread_name_prefix="lovart-download")
+_lovart_download_http = requests.Session()
+_lovart_download_http.trust_env = False # Bypass proxies
+for _scheme in ("http://", "https://"):
+    _lovart_download_http.mount(_scheme, HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=_LOVART_DOWNLOAD_WORKERS,
+        max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504]),
+    ))
+_lovart_download_hosts_lock = threading.Lock()
+_lovart_download_hosts = {} # host -> BoundedSemaphore
+_lovart_download_cache_lock = threading.Lock()
+_lovart_download_cache = OrderedDict() # url -> {"etag", "path", "size"}
+_lovart_download_cache_size = 0
+
+_lovart_download_index_lock = threading.Lock() # Serializes index rewrites
+_DOWNLOAD_CACHE_NAME = re.compile(r"^[0-9a-f]{64}$") # sha256(url + etag)
+
+def _download_cache_name(url: str, etag: str) -> str:
+    return hashlib.sha256(f"{url}\n{etag}".encode("utf-8")).hexdigest()
+
+def _save_download_cache_index():
+    with _lovart_download_index_lock:
+        with _lovart_download_cache_lock:
+            entries = [{"url": url, "etag": e["etag"], "size": e["size"]} for url, e in _lovart_download_cache.items()]
+        tmp_path = _LOVART_DOWNLOAD_CACHE_INDEX + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, _LOVART_DOWNLOAD_CACHE_INDEX)
+        except OSError as e:
+            print(f"[lovart_routes] Download cache index write failed: {e}")
+
+def _load_download_cache_dir():
+    """
+    Rebuild the LRU from the index (oldest first) and remove cache files it no longer references.
+    """
+    global _lovart_download_cache_size
+    if _LOVART_DOWNLOAD_CACHE_BYTES <= 0 or not os.path.isdir(_LOVART_DOWNLOAD_CACHE_DIR):
+        return
+    try:
+        with open(_LOVART_DOWNLOAD_CACHE_INDEX, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        entries = []
+    for entry in entries:
+        try:
+            url, etag, size = entry["url"], entry["etag"], int(entry["size"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        path = os.path.join(_LOVART_DOWNLOAD_CACHE_DIR, _download_cache_name(url, etag))
+        try:
+            if os.path.getsize(path) != size:
+                continue
+        except OSError:
+            continue
+        _lovart_download_cache[url] = {"etag": etag, "path": path, "size": size}
+        _lovart_download_cache_size += size
+    while _lovart_download_cache_size > _LOVART_DOWNLOAD_CACHE_BYTES and _lovart_download_cache:
+        _, old = _lovart_download_cache.popitem(last=False)
+        _lovart_download_cache_size -= old["size"]
+    live = {os.path.basename(e["path"]) for e in _lovart_download_cache.values()}
+    try:
+        for name in os.listdir(_LOVART_DOWNLOAD_CACHE_DIR):
+            if _DOWNLOAD_CACHE_NAME.match(name) and name not in live:
+                os.remove(os.path.join(_LOVART_DOWNLOAD_CACHE_DIR, name))
+    except OSError:
+        pass
+    if _lovart_download_cache:
+        print(f"[lovart_routes] Download cache: {len(_lovart_download_cache)} entries ({_lovart_download_cache_size} bytes) kept from the last run")
+
+
+def _download_host_slot(url: str):
+    host = urlsplit(url).netloc.lower()
+    with _lovart_download_hosts_lock:
+        sem = _lovart_download_hosts.get(host)
+        if sem is None:
+            sem = _lovart_download_hosts[host] = threading.BoundedSemaphore(_LOVART_DOWNLOAD_PER_HOST)
+        return sem
+
+def _download_cache_get(url: str):
+    with _lovart_download_cache_lock:
+        entry = _lovart_download_cache.get(url)
+        if entry:
+            _lovart_download_cache.move_to_end(url)
+        return entry
+
+def _download_cache_read(url: str, entry: dict):
+    try:
+        with open(entry["path"], "rb") as f:
+            return f.read()
+    except OSError:
+        _download_cache_drop(url)
+        return None
+
+def _download_cache_drop(url: str):
+    global _lovart_download_cache_size
+    with _lovart_download_cache_lock:
+        entry = _lovart_download_cache.pop(url, None)
+        if entry:
+            _lovart_download_cache_size -= entry["size"]
+    if entry:
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
+        _save_download_cache_index()
+
+def _download_cache_put(url: str, etag: str, data: bytes):
+    global _lovart_download_cache_size
+    if _LOVART_DOWNLOAD_CACHE_BYTES <= 0 or not etag or len(data) > _LOVART_DOWNLOAD_CACHE_BYTES:
+        return
+    _download_cache_drop(url)
+    path = os.path.join(_LOVART_DOWNLOAD_CACHE_DIR, _download_cache_name(url, etag))
+    try:
+        os.makedirs(_LOVART_DOWNLOAD_CACHE_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    except OSError as e:
+        print(f"[lovart_routes] Download cache write failed: {e}")
+        return
+    evicted = []
+    with _lovart_download_cache_lock:
+        _lovart_download_cache[url] = {"etag": etag, "path": path, "size": len(data)}
+        _lovart_download_cache_size += len(data)
+        while _lovart_download_cache_size > _LOVART_DOWNLOAD_CACHE_BYTES and len(_lovart_download_cache) > 1:
+            _, old = _lovart_download_cache.popitem(last=False)
+            _lovart_download_cache_size -= old["size"]
+            evicted.append(old["path"])
+    for old_path in evicted:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    _save_download_cache_index()
+
+def _download_image(url: str):
+    """
+    Fetch one image URL into memory. Returns bytes, or None if it failed / is not an image.
+    """
+    cached = _download_cache_get(url)
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    started = time.time()
+    try:
+        with _download_host_slot(url):
+            with _lovart_download_http.get(url, headers=headers, timeout=_LOVART_DOWNLOAD_TIMEOUT, stream=True) as r:
+                if r.status_code == 304 and cached:
+                    data = _download_cache_read(url, cached)
+                    if data is not None:
+                        print(f"[lovart_routes] {url} not modified, served from cache")
+                        return data
+                    return None
+                if r.status_code != 200:
+                    print(f"[lovart_routes] Failed to download {url}: HTTP {r.status_code}")
+                    return None
+                length = _safe_int(r.headers.get("Content-Length"))
+                if length is not None and length > _LOVART_MAX_IMAGE_BYTES:
+                    print(f"[lovart_routes] Skipping {url}: {length} bytes exceeds {_LOVART_MAX_IMAGE_BYTES}")
+                    return None
+                body = bytearray()
+                sniffed = False
+                for chunk in r.iter_content(chunk_size=256 * 1024):
+                    body += chunk
+                    if len(body) > _LOVART_MAX_IMAGE_BYTES:
+                        print(f"[lovart_routes] Skipping {url}: exceeds {_LOVART_MAX_IMAGE_BYTES} bytes")
+                        return None
+                    if not sniffed and len(body) >= 16:
+                        # Reject non-images after the first bytes instead of the whole body
+                        if not lovart_sniff_image_mime(bytes(body[:16])):
+                            break
+                        sniffed = True
+                if not sniffed and not lovart_sniff_image_mime(bytes(body[:16])):
+                    print(f"[lovart_routes] Skipping {url}: not a PNG / JPEG / WebP / GIF image")
+                    return None
+                etag = r.headers.get("ETag")
+        data = bytes(body)
+        _download_cache_put(url, etag, data)
+        print(f"[lovart_routes] Downloaded {url} ({len(data)} bytes) in {time.time() - started:.1f}s")
+        return data
+    except Exception as e:
+        print(f"[lovart_routes] Failed to download {url}: {e}")
+        return None
+
+# Prompt URLs on these hosts (suffix match, "*" = any) go into input_args.image unchanged;
+# other URLs are downloaded here during preprocessing and uploaded (LOVART_URL_FETCH_MODE=
+# download, default) or, opt-in, linked server-side by Lovart (link: a URL Lovart cannot
+# link is only downloaded then, with the session already held).
+_LOVART_URL_PASSTHROUGH_HOSTS = [
+    h.strip().lower() for h in os.environ.get("LOVART_URL_PASSTHROUGH_HOSTS", "lovart.ai").split(",") if h.strip()
+]
+_LOVART_URL_FETCH_MODE = os.environ.get("LOVART_URL_FETCH_MODE", "download").strip().lower()
+
+def _prompt_url_reference(url: str):
+    """
+    Image entry for a prompt URL that is not downloaded here, or None (download it).
+    """
+    host = (urlsplit(url).hostname or "").lower()
+    for allowed in _LOVART_URL_PASSTHROUGH_HOSTS:
+        if allowed == "*" or host == allowed or host.endswith("." + allowed):
+            return url
+    if _LOVART_URL_FETCH_MODE == "link":
+        # Downloaded with _download_image (shared pool, size cap, cache) only if linking fails
+        return {"name": os.path.basename(urlsplit(url).path) or "reference", "url": url, "fetch": _download_image}
+    return None
+
+def _download_images(urls: list) -> list:
+    """
+    Download URLs concurrently on the shared pool; results (bytes | None) in input order.
+    """
+    futures = [_lovart_download_executor.submit(_download_image, url) for url in urls]
+    return [f.result() for f in futures]
+
+def _request_priority(payload: dict, default: int = LOVART_PRIORITY_INTERACTIVE) -> int:
+    """
+    priority: "interactive" | "batch" (异步任务默认为 batch)
+    """
+    raw = payload.get("priority") if isinstance(payload, dict) else None
+    if isinstance(raw, str):
+        raw = raw.strip().lower()
+        if raw == "batch":
+            return LOVART_PRIORITY_BATCH
+        if raw == "interactive":
+            return LOVART_PRIORITY_INTERACTIVE
+    return default
+
 def _is_lovart_hot_reload_enabled() -> bool:
     return os.environ.get('SHUKE_DEV_RELOAD', '').strip().lower() in ('1', 'true', 'yes', 'on')
 
@@ -170,73 +915,130 @@ def _load_lovart_login_dynamic():
     spec.loader.exec_module(mod)
     return mod
 
-def _ensure_lovart_session():
-    # Only ensure at least ONE session is available initially or if all are dead.
-    # The pool will grow on demand if we implement that logic, 
-    # but for now user requested: "Come 1 request -> init 1 session. Come 2 -> init 2."
-    # AND "If not 3 instances, init up to 3".
-    # Actually user said: "Don't init 3 at once. One by one as needed."
-    
-    # Check if we have ANY active session.
-    if lovart_has_session():
+class _LaunchEvent(threading.Event):
+    """
+    ready_event handed to register_lovart_account; wakes bootstrap waiters when set.
+    """
+    def set(self):
+        super().set()
+        with _lovart_launch_cond:
+            _lovart_launch_cond.notify_all()
+
+def _prune_launching_locked():
+    # Caller must hold _lovart_launch_cond
+    now = time.time()
+    for idx, launch in list(_lovart_launching.items()):
+        if launch["event"].is_set() or now - launch["started"] > 600:
+            _lovart_launching.pop(idx, None)
+
+def _reserve_launch_slot_locked():
+    """
+    Reserve an empty slot for a new launch, respecting LOVART_MAX_CONCURRENT_LAUNCHES.
+    Caller must hold _lovart_launch_cond. Returns the slot index or None.
+    """
+    _prune_launching_locked()
+    if len(_lovart_launching) >= _LOVART_MAX_CONCURRENT_LAUNCHES:
         return None
-        
-    # If no session, launch just ONE to start with.
-    # Future requests will trigger more launches if they wait too long? 
-    # Or should we check pool size vs active count?
-    
-    # User requirement: "No init 3 browsers. Init according to situation."
-    # Since this function is called at start of request, if no session exists, we must launch at least one.
-    
-    with _lovart_init_lock:
-        # Double check inside lock
-        if lovart_has_session():
+    for i in range(lovart_get_pool_size()):
+        if i not in _lovart_launching and not lovart_has_session(i):
+            _lovart_launching[i] = {"event": _LaunchEvent(), "payload": {}, "started": time.time()}
+            return i
+    return None
+
+def _start_session_launch(target_idx: int, launch: dict):
+    """
+    Run register_lovart_account for a reserved slot on the pool supervisor loop.
+    launch["payload"]["error"] is set on failure.
+    """
+    ready_event = launch["event"]
+    ready_payload = launch["payload"]
+    future = lovart_run_on_supervisor(
+        register_lovart_account(
+            keep_alive_after_code=True,
+            ready_event=ready_event,
+            ready_payload=ready_payload,
+            session_index=target_idx
+        )
+    )
+    future.add_done_callback(lambda f: _on_login_done(f, ready_event, ready_payload))
+
+def _on_login_done(future, ready_event, ready_payload):
+    try:
+        ok, msg, data = future.result()
+        if not ok:
+            ready_payload["error"] = msg
+    except Exception as e:
+        ready_payload["error"] = str(e)
+    if not ready_event.is_set():
+        ready_event.set()
+
+def _try_launch_session(reason: str):
+    """
+    Reserve a slot and start a launch. Returns the launch record or None if the pool
+    is full or too many launches are already running.
+    """
+    with _lovart_launch_cond:
+        target_idx = _reserve_launch_slot_locked()
+        if target_idx is None:
             return None
-            
-        # Find first empty slot
-        target_idx = -1
-        pool_size = lovart_get_pool_size()
-        for i in range(pool_size):
-            if not lovart_has_session(i):
-                target_idx = i
-                break
-        
-        if target_idx == -1:
-             # Should not happen if lovart_has_session() returned False
-             return None
+        launch = _lovart_launching[target_idx]
+    print(f"[lovart] Initializing session {target_idx} ({reason})...")
+    _start_session_launch(target_idx, launch)
+    return launch
 
-        print(f"[lovart] Initializing session {target_idx} (On Demand)...")
-        
-        ready_event = threading.Event()
-        ready_payload = {}
-        
-        def run_login():
-            try:
-                ok, msg, data = asyncio.run(
-                    register_lovart_account(
-                        keep_alive_after_code=True,
-                        ready_event=ready_event,
-                        ready_payload=ready_payload,
-                        session_index=target_idx
-                    )
-                )
-                if not ok:
-                    ready_payload["error"] = msg
-                    if not ready_event.is_set():
-                        ready_event.set()
-            except Exception as e:
-                ready_payload["error"] = str(e)
-                ready_event.set()
+def _launching_indices() -> set:
+    """
+    Slots with a launch in flight (finished or stale launches are pruned).
+    """
+    with _lovart_launch_cond:
+        _prune_launching_locked()
+        return set(_lovart_launching.keys())
 
-        threading.Thread(target=run_login, daemon=True).start()
-        
-        if not ready_event.wait(timeout=600):
-            return jsonify({"status": "error", "message": "自动登陆超时", "data": {}}), 504
-            
-        if ready_payload.get("error"):
-            return jsonify({"status": "error", "message": ready_payload["error"], "data": {}}), 500
-            
+def _ensure_lovart_session(timeout: float = 600):
+    """
+    Make sure at least one session is alive.
+    Several slots can log in at once (one launch per waiting request, capped by
+    LOVART_MAX_CONCURRENT_LAUNCHES); every waiter returns as soon as ANY launch succeeds.
+    """
+    global _lovart_bootstrap_waiters
+    if lovart_has_session():
+        return None
+
+    deadline = time.time() + timeout
+    my_launches = []
+    with _lovart_launch_cond:
+        _lovart_bootstrap_waiters += 1
+    try:
+        while not lovart_has_session():
+            with _lovart_launch_cond:
+                _prune_launching_locked()
+                in_flight = len(_lovart_launching)
+                wants_launch = not my_launches and in_flight < _lovart_bootstrap_waiters
+
+            # One launch per waiting request, up to the concurrency cap
+            if wants_launch:
+                launch = _try_launch_session("On Demand")
+                if launch is not None:
+                    my_launches.append(launch)
+                    continue
+
+            with _lovart_launch_cond:
+                _prune_launching_locked()
+                if not _lovart_launching and not lovart_has_session():
+                    # Nothing in flight and nothing alive: report the failure of our own launch
+                    if not my_launches:
+                        return jsonify({"status": "error", "message": "没有可用的会话槽位", "data": {}}), 500
+                    errors = [l["payload"].get("error") for l in my_launches if l["payload"].get("error")]
+                    return jsonify({"status": "error", "message": errors[-1] if errors else "自动登陆失败", "data": {}}), 500
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return jsonify({"status": "error", "message": "自动登陆超时", "data": {}}), 504
+                _lovart_launch_cond.wait(timeout=remaining)
         return None
+    finally:
+        with _lovart_launch_cond:
+            _lovart_bootstrap_waiters -= 1
 
 def _ensure_more_sessions_if_needed():
     """
@@ -266,99 +1068,146 @@ def _ensure_more_sessions_if_needed():
     # So we should modify _ensure_lovart_session to be "Ensure we have capacity".
     pass
 
-def _ensure_capacity():
+def _ensure_capacity(shared: bool = False):
     """
-    Ensures there is at least one available (not busy) session, OR launches a new one if possible.
+    Make sure a new session is on its way if every active session is busy.
+    Scale-up runs in the background (autoscaler); the request itself waits in
+    lovart_acquire_session and is woken when the new session registers.
+    shared=True: the request can also run next to others on a partly used session.
     """
-    pool_size = lovart_get_pool_size()
-    
-    # 1. Check current state
-    active_indices = []
-    busy_indices = []
-    empty_indices = []
-    
-    for i in range(pool_size):
-        if lovart_has_session(i):
-            active_indices.append(i)
-            # Check if busy (this is a bit hacky, accessing private lock, but we need it)
-            # Or we add a helper in lovart_login
-            # For now, let's assume if we can't acquire immediately, it might be busy.
-        else:
-            empty_indices.append(i)
-            
-    if not empty_indices:
-        return # Max capacity reached
-        
-    # If we have empty slots, we should check if we need to launch.
-    # User logic: "Come 2 requests -> Init 2".
-    # This implies if current active sessions are likely to be busy, launch a new one.
-    # Since we are about to process a request, we effectively need 1 slot.
-    # If all active slots are busy, we launch a new one.
-    
-    # We need a way to know if active sessions are busy.
-    # Let's try to acquire non-blocking on all active sessions.
-    # If we find one free, good. If not, launch new.
-    
-    idx, loop, page = lovart_acquire_session(timeout=0.1)
-    if idx is not None:
-        # We found a free one! Release it immediately.
-        lovart_release_session(idx)
+    if lovart_get_spare_capacity(shared) > 0:
         return # We have capacity
-        
-    # If we reached here, all active sessions are busy (or there are none).
-    # And we know we have empty_indices.
-    # So Launch one!
-    
-    target_idx = empty_indices[0]
-    
-    # Check lock to avoid race condition where another thread is already launching this index
-    # We use _lovart_init_lock for launching.
-    
-    # We launch asynchronously to not block the current request too much?
-    # No, the current request needs a session. If we launch async, it will wait in acquire().
-    # So we should launch and wait for it.
-    
-    print(f"[lovart] All active sessions busy. Scaling up: Initializing session {target_idx}...")
-    
-    with _lovart_init_lock:
-        # Re-check inside lock
-        if lovart_has_session(target_idx):
-            return
-            
-        ready_event = threading.Event()
-        ready_payload = {}
-        
-        def run_login():
-            try:
-                ok, msg, data = asyncio.run(
-                    register_lovart_account(
-                        keep_alive_after_code=True,
-                        ready_event=ready_event,
-                        ready_payload=ready_payload,
-                        session_index=target_idx
-                    )
-                )
-                if not ok:
-                    ready_payload["error"] = msg
-                    if not ready_event.is_set():
-                        ready_event.set()
-            except Exception as e:
-                ready_payload["error"] = str(e)
-                ready_event.set()
 
-        threading.Thread(target=run_login, daemon=True).start()
-        
-        if not ready_event.wait(timeout=600):
-             print(f"[lovart] Scale up failed for session {target_idx}: Timeout")
-             return
-            
-        if ready_payload.get("error"):
-             print(f"[lovart] Scale up failed for session {target_idx}: {ready_payload['error']}")
-             return
-             
-    return
+    print("[lovart] All active sessions busy. Requesting scale up...")
+    if _LOVART_AUTOSCALE_ENABLED:
+        _autoscaler_wakeup.set()
+    else:
+        _try_launch_session("Scale Up")
+
+# ---------------------------------------------------------
+# Predictive autoscaler
+# ---------------------------------------------------------
+# Keeps enough logged-in sessions for the observed load (arrival rate x generation latency,
+# Little's law) plus LOVART_WARM_STANDBY idle sessions, bounded by LOVART_POOL_SIZE.
+# Requests that can share a session count as 1/LOVART_SESSION_MAX_TASKS of one.
+_LOVART_AUTOSCALE_ENABLED = os.environ.get("LOVART_AUTOSCALE", "1").strip().lower() in ("1", "true", "yes", "on")
+_LOVART_WARM_STANDBY = int(os.environ.get("LOVART_WARM_STANDBY", 1))
+_LOVART_AUTOSCALE_INTERVAL = float(os.environ.get("LOVART_AUTOSCALE_INTERVAL", 5))
+_LOVART_AUTOSCALE_WINDOW = float(os.environ.get("LOVART_AUTOSCALE_WINDOW", 300)) # Arrival rate window (seconds)
+_LOVART_DEFAULT_LATENCY = 120.0 # Assumed generation latency before we have samples
+
+_autoscaler_wakeup = threading.Event()
+_lovart_demand_lock = threading.Lock()
+_lovart_demand = {
+    "arrivals": deque(maxlen=10000),
+    "latencies": deque(maxlen=200),
+    "inflight": 0,
+    "last_arrival": 0,
+}
+
+def _record_request_start(weight: float = 1.0):
+    now = time.time()
+    with _lovart_demand_lock:
+        _lovart_demand["arrivals"].append((now, weight))
+        _lovart_demand["last_arrival"] = now
+        _lovart_demand["inflight"] += weight
+
+def _record_request_end(weight: float = 1.0):
+    with _lovart_demand_lock:
+        _lovart_demand["inflight"] = max(0, _lovart_demand["inflight"] - weight)
+
+def _record_generation_latency(seconds: float):
+    with _lovart_demand_lock:
+        _lovart_demand["latencies"].append(seconds)
+
+def _track_demand(fn=None, *, shared: bool = False):
+    """
+    Count a generation request as in flight for the autoscaler while fn runs.
+    shared=True: image requests, which share sessions in API mode.
+    """
+    if fn is None:
+        return functools.partial(_track_demand, shared=shared)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        weight = 1.0
+        if shared and lovart_image_requests_shared():
+            weight = 1.0 / lovart_get_session_task_limit()
+        _record_request_start(weight)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _record_request_end(weight)
+    return wrapper
+
+def _autoscale_target() -> int:
+    now = time.time()
+    with _lovart_demand_lock:
+        arrivals = _lovart_demand["arrivals"]
+        while arrivals and now - arrivals[0][0] > _LOVART_AUTOSCALE_WINDOW:
+            arrivals.popleft()
+        rate = sum(weight for _, weight in arrivals) / _LOVART_AUTOSCALE_WINDOW
+        latencies = _lovart_demand["latencies"]
+        latency = (sum(latencies) / len(latencies)) if latencies else _LOVART_DEFAULT_LATENCY
+        inflight = _lovart_demand["inflight"]
+        last_arrival = _lovart_demand["last_arrival"]
+
+    # No traffic for a long time: let idle cleanup shrink the pool
+    if not last_arrival or now - last_arrival > _LOVART_IDLE_MAX_SECONDS:
+        return 0
+
+    expected = math.ceil(rate * latency)
+    return min(lovart_get_pool_size(), max(expected, math.ceil(inflight)) + _LOVART_WARM_STANDBY)
+
+def _autoscale_tick():
+    target = _autoscale_target()
+    pool_size = lovart_get_pool_size()
+    launching = _launching_indices()
+    alive = [i for i in range(pool_size) if lovart_has_session(i)]
+    deficit = target - len(alive) - len(launching)
+    if deficit <= 0:
+        return
+
+    print(f"[lovart] Autoscaler: target={target} alive={len(alive)} launching={len(launching)}. Launching {deficit} session(s)...")
+    for _ in range(deficit):
+        # Stops at the pool size / LOVART_MAX_CONCURRENT_LAUNCHES cap
+        if _try_launch_session("Autoscale") is None:
+            break
+
+def _autoscaler_loop():
+    while True:
+        _autoscaler_wakeup.wait(timeout=_LOVART_AUTOSCALE_INTERVAL)
+        _autoscaler_wakeup.clear()
+        try:
+            _autoscale_tick()
+        except Exception as e:
+            print(f"[lovart] Autoscaler error: {e}")
+
+_lovart_services_started = threading.Event()
+
+def start_lovart_services():
+    """
+    Start background work for the server process (called from main.py at startup, never
+    on import, so shrink-pool workers that re-import the app stay inert): lovart_login
+    startup, the download cache index, job cleanup and the autoscaler.
+    """
+    if _lovart_services_started.is_set():
+        return
+    _lovart_services_started.set()
+    lovart_startup()
+    _load_download_cache_dir()
+    threading.Thread(target=_idle_cleanup_loop, daemon=True).start()
+    if _LOVART_AUTOSCALE_ENABLED:
+        threading.Thread(target=_autoscaler_loop, daemon=True).start()
 
 def _run_generate_video(index: int, duration_label: str, start_frame_image_path: str, prompt: str):
+    started = time.time()
+    try:
+        return _run_generate_video_on_session(index, duration_label, start_frame_image_path, prompt)
+    finally:
+        _record_generation_latency(time.time() - started)
+
+def _run_generate_video_on_session(index: int, duration_label: str, start_frame_image_path: str, prompt: str):
     if _is_lovart_hot_reload_enabled():
         loop, page = lovart_get_session_by_index(index)
         if not loop or not page:
@@ -389,6 +1238,25 @@ def _run_generate_video(index: int, duration_label: str, start_frame_image_path:
     )
 
 def _run_generate_image(index: int, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", image_paths: list = None):
+    """
+    Generate on a session and return the raw Lovart artifact URL; CDN mirroring
+    is left to _mirror_image_data so the session can be released first.
+    """
+    started = time.time()
+    try:
+        return _run_generate_image_on_session(index, start_frame_image_path, prompt, resolution, ratio, image_paths)
+    finally:
+        _record_generation_latency(time.time() - started)
+
+def _mirror_image_data(data: dict) -> dict:
+    """
+    Mirror the generated image to Qiniu (runs after lovart_release_session).
+    """
+    if isinstance(data, dict) and data.get("image_url"):
+        data["image_url"] = lovart_mirror_image(data["image_url"])
+    return data
+
+def _run_generate_image_on_session(index: int, start_frame_image_path: str, prompt: str, resolution: str = "2K", ratio: str = "16:9", image_paths: list = None):
     if _is_lovart_hot_reload_enabled():
         loop, page = lovart_get_session_by_index(index)
         if not loop or not page:
@@ -407,7 +1275,8 @@ def _run_generate_image(index: int, start_frame_image_path: str, prompt: str, re
                 prompt=prompt,
                 resolution=resolution,
                 ratio=ratio,
-                session_index=index
+                session_index=index,
+                mirror=False
             ),
             loop,
         )
@@ -419,7 +1288,8 @@ def _run_generate_image(index: int, start_frame_image_path: str, prompt: str, re
         prompt=prompt,
         resolution=resolution,
         ratio=ratio,
-        image_paths=image_paths
+        image_paths=image_paths,
+        mirror=False
     )
 
 @lovart_bp.route('/register', methods=['POST'])
@@ -428,24 +1298,14 @@ def api_register_lovart():
         ready_event = threading.Event()
         ready_payload = {}
 
-        def run_login():
-            try:
-                ok, msg, data = asyncio.run(
-                    register_lovart_account(
-                        keep_alive_after_code=True,
-                        ready_event=ready_event,
-                        ready_payload=ready_payload,
-                    )
-                )
-                if not ok:
-                    ready_payload["error"] = msg
-                    if not ready_event.is_set():
-                        ready_event.set()
-            except Exception as e:
-                ready_payload["error"] = str(e)
-                ready_event.set()
-
-        threading.Thread(target=run_login, daemon=True).start()
+        future = lovart_run_on_supervisor(
+            register_lovart_account(
+                keep_alive_after_code=True,
+                ready_event=ready_event,
+                ready_payload=ready_payload,
+            )
+        )
+        future.add_done_callback(lambda f: _on_login_done(f, ready_event, ready_payload))
 
         if not ready_event.wait(timeout=600):
             return jsonify({"status": "error", "message": "等待验证码输入超时", "data": {}}), 504
@@ -457,11 +1317,51 @@ def api_register_lovart():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@lovart_bp.route('/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    job = _get_job(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "任务不存在或已过期", "data": {}}), 404
+    return jsonify({"status": "success", "message": "ok", "data": _job_view(job)}), 200
+
+def _lovart_job_accepted(job: dict):
+    return jsonify({
+        "status": "success",
+        "message": "任务已提交",
+        "data": {"job_id": job["id"], "status": job["status"], "status_url": f"/api/lovart/jobs/{job['id']}"}
+    }), 202
+
+def _lovart_idempotency_conflict():
+    return jsonify({"status": "error", "message": "Idempotency-Key 已用于参数不同的请求", "data": {}}), 422
+
+def _lovart_queue_full():
+    resp = jsonify({"status": "error", "message": "任务队列已满，请稍后重试", "data": {}})
+    resp.headers["Retry-After"] = "30"
+    return resp, 503
+
+def _handle_lovart_generation(route_name: str, handler, payload: dict):
+    return _handle_generation(route_name, handler, payload, _lovart_job_accepted, _lovart_idempotency_conflict, _lovart_queue_full)
+
+def _lovart_read_payload():
+    """
+    Returns (payload, error_response) for the lovart_bp generation routes.
+    """
+    try:
+        return _read_json_payload(), None
+    except _InputError as e:
+        return None, (jsonify({"status": "error", "message": str(e), "data": {}}), e.status)
+
 @lovart_bp.route('/generate_video', methods=['POST'])
 def api_generate_video():
+    payload, err = _lovart_read_payload()
+    if err:
+        return err
+    return _handle_lovart_generation("/api/lovart/generate_video", _generate_video_impl, payload)
+
+@_track_demand
+def _generate_video_impl(payload: dict):
     try:
         # with _lovart_generate_lock: # Removed global lock
-        payload = request.get_json(silent=True) or {}
         duration_label = _normalize_duration_label(payload.get("duration"))
         start_frame_image_path = (payload.get("start_frame_image_path") or "").strip()
         prompt = (payload.get("prompt") or "").strip()
@@ -489,9 +1389,12 @@ def api_generate_video():
         
         for attempt in range(max_retries):
             # 1. Acquire Session
-            idx, loop, page = lovart_acquire_session(timeout=600)
+            idx, loop, page, lease = lovart_acquire_session(timeout=600, priority=_request_priority(payload))
             if idx is None:
                  if not lovart_has_session():
+                     # The last session went away while we waited: relaunch one and retry
+                     if attempt < max_retries - 1 and _ensure_lovart_session() is None:
+                         continue
                      return jsonify({"status": "error", "message": "会话已断开，请重试"}), 500
                  if attempt < max_retries - 1:
                      continue
@@ -507,9 +1410,10 @@ def api_generate_video():
                 )
                 
                 if (not success) and isinstance(data, dict) and data.get("low_points"):
-                    # Session is already closed inside _run_generate_video if low points
-                    # Release lock on this dead session slot
-                    lovart_release_session(idx)
+                    # Out of points: no new requests go to this session, it is closed once
+                    # the other requests on it have finished
+                    lovart_retire_session(idx, lease, reason="low points")
+                    lovart_release_session(idx, lease)
                     idx = None
                     
                     # Try to replenish pool (restart dead session)
@@ -536,8 +1440,11 @@ def api_generate_video():
 
             except Exception as e:
                 print(f"[lovart_routes] Exception during generation (Session {idx}): {e}")
+                if idx is not None and lovart_session_error_is_fatal(idx, e):
+                    # Closed right away if this was its only request, else once the others finish
+                    lovart_retire_session(idx, lease, reason=f"error: {e}")
                 if idx is not None:
-                    lovart_close_session(idx)
+                    lovart_release_session(idx, lease)
                     idx = None
                 
                 # Try to recover session pool for next attempt
@@ -552,7 +1459,7 @@ def api_generate_video():
 
             finally:
                 if idx is not None:
-                    lovart_release_session(idx)
+                    lovart_release_session(idx, lease)
                     idx = None
 
         return jsonify({"status": "error", "message": "重试多次失败 (积分不足或系统繁忙)", "data": {}}), 500
@@ -562,11 +1469,18 @@ def api_generate_video():
 
 @lovart_bp.route('/generate_image', methods=['POST'])
 def api_generate_image():
-    temp_file_paths = []
+    payload, err = _lovart_read_payload()
+    if err:
+        return err
+    _log_generate_image_request("/api/lovart/generate_image", payload)
+    return _handle_lovart_generation("/api/lovart/generate_image", _generate_image_impl, payload)
+
+@_track_demand(shared=True)
+def _generate_image_impl(payload: dict):
+    staged_images = []
+    prep = None
     try:
         # with _lovart_generate_lock: # Removed global lock
-        payload = request.get_json(silent=True) or {}
-        _log_generate_image_request("/api/lovart/generate_image", payload)
         start_frame_image_path = (payload.get("start_frame_image_path") or "").strip()
         start_frame_image_base64 = (payload.get("start_frame_image_base64") or "").strip()
         image_assets = payload.get("image_assets") or []
@@ -584,57 +1498,57 @@ def api_generate_image():
         # Handle Images
         # Priority: image_assets > start_frame_image_base64 > start_frame_image_path
         # We consolidate everything into final_image_paths list
-        
-        final_image_paths = []
-        
-        # 1. start_frame_image_path (Legacy, local path)
-        if start_frame_image_path:
-             final_image_paths.append(start_frame_image_path)
-
-        import base64
-        import tempfile
-        import uuid
-        temp_dir = tempfile.gettempdir()
-
-        # 2. start_frame_image_base64 (Single)
-        if start_frame_image_base64:
-             try:
-                 if "," in start_frame_image_base64:
-                     start_frame_image_base64 = start_frame_image_base64.split(",", 1)[1]
-                 image_data = base64.b64decode(start_frame_image_base64)
-                 temp_filename = f"lovart_upload_legacy_{uuid.uuid4()}.png"
-                 t_path = os.path.join(temp_dir, temp_filename)
-                 with open(t_path, "wb") as f:
-                     f.write(image_data)
-                 temp_file_paths.append(t_path)
-                 final_image_paths.append(t_path)
-             except Exception as e:
-                 return jsonify({"status": "error", "message": f"Base64解码失败: {str(e)}", "data": {}}), 400
-
-        # 3. image_assets (Multiple Base64)
-        if image_assets and isinstance(image_assets, list):
-            for i, b64_str in enumerate(image_assets):
-                if not b64_str or not isinstance(b64_str, str):
-                    continue
+        # (decoded on the prep pool while we wait for a session)
+        def prepare():
+            final_image_paths = []
+
+            # 1. start_frame_image_path (Legacy, local path)
+            if start_frame_image_path:
+                final_image_paths.append(start_frame_image_path)
+
+            # 2. start_frame_image_base64 (Single)
+            if start_frame_image_base64:
+                if _image_too_large(start_frame_image_base64):
+                    raise _InputError(f"start_frame_image_base64 超过单张图片大小上限 ({_LOVART_MAX_IMAGE_BYTES} 字节)", status=413)
                 try:
-                    if "," in b64_str:
-                        b64_str = b64_str.split(",", 1)[1]
-                    image_data = base64.b64decode(b64_str)
-                    temp_filename = f"lovart_upload_asset_{uuid.uuid4()}_{i}.png"
-                    t_path = os.path.join(temp_dir, temp_filename)
-                    with open(t_path, "wb") as f:
-                        f.write(image_data)
-                    temp_file_paths.append(t_path)
-                    final_image_paths.append(t_path)
+                    image_data = _decode_base64_image(start_frame_image_base64)
+                    final_image_paths.append(_stage_image(image_data, "lovart_upload_legacy", staged_images))
                 except Exception as e:
-                    return jsonify({"status": "error", "message": f"image_assets[{i}] Base64解码失败: {str(e)}", "data": {}}), 400
-        
+                    raise _InputError(f"Base64解码失败: {str(e)}")
+
+            # 3. image_assets (Multiple Base64)
+            if image_assets and isinstance(image_assets, list):
+                for i, b64_str in enumerate(image_assets):
+                    if not b64_str or not isinstance(b64_str, str):
+                        continue
+                    if _image_too_large(b64_str):
+                        raise _InputError(f"image_assets[{i}] 超过单张图片大小上限 ({_LOVART_MAX_IMAGE_BYTES} 字节)", status=413)
+                    try:
+                        image_data = _decode_base64_image(b64_str)
+                        image_assets[i] = None # Drop the base64 text as soon as it is decoded
+                        final_image_paths.append(_stage_image(image_data, f"lovart_upload_asset_{i}", staged_images))
+                    except Exception as e:
+                        raise _InputError(f"image_assets[{i}] Base64解码失败: {str(e)}")
+
+            # Optional: shrink references to what the resolution uses (LOVART_REF_DOWNSCALE)
+            lovart_shrink_image_buffers(staged_images, resolution)
+            return final_image_paths
+
+        def input_error():
+            err = prep.exception()
+            return jsonify({"status": "error", "message": str(err), "data": {}}), err.status if isinstance(err, _InputError) else 500
+
+        prep, prep_wake = _start_preprocessing(prepare)
+        final_image_paths = None
+
         ensure_err = _ensure_lovart_session()
+        if _preprocessing_failed(prep):
+            return input_error()
         if ensure_err:
             return ensure_err
 
         # Ensure capacity (Scale up if needed)
-        _ensure_capacity()
+        _ensure_capacity(shared=lovart_image_requests_shared())
         
         # Retry loop for low points
         max_retries = 3
@@ -642,14 +1556,30 @@ def api_generate_image():
         
         for attempt in range(max_retries):
             # 1. Acquire Session
-            idx, loop, page = lovart_acquire_session(timeout=600)
+            idx, loop, page, lease = lovart_acquire_session(
+                timeout=600,
+                priority=_request_priority(payload),
+                shared=lovart_image_requests_shared(),
+                wake_event=prep_wake.event() if final_image_paths is None else None,
+            )
+            # Inputs were staged while we waited; a session is useless if that failed
+            if final_image_paths is None and _preprocessing_failed(prep, wait=idx is not None):
+                if idx is not None:
+                    lovart_release_session(idx, lease)
+                    idx = None
+                return input_error()
             if idx is None:
                  if not lovart_has_session():
+                     # The last session went away while we waited: relaunch one and retry
+                     if attempt < max_retries - 1 and _ensure_lovart_session() is None:
+                         continue
                      return jsonify({"status": "error", "message": "会话已断开，请重试"}), 500
                  if attempt < max_retries - 1:
                      continue
                  return jsonify({"status": "error", "message": "系统繁忙，请稍后再试"}), 503
-            
+            if final_image_paths is None:
+                final_image_paths = prep.result()
+
             # 2. Run Generation
             try:
                 success, message, data = _run_generate_image(
@@ -662,9 +1592,10 @@ def api_generate_image():
                 )
                 
                 if (not success) and isinstance(data, dict) and data.get("low_points"):
-                    # Session is already closed inside _run_generate_image if low points
-                    # Release lock on this dead session slot
-                    lovart_release_session(idx)
+                    # Out of points: no new requests go to this session, it is closed once
+                    # the other requests on it have finished
+                    lovart_retire_session(idx, lease, reason="low points")
+                    lovart_release_session(idx, lease)
                     idx = None
 
                     # Try to replenish pool (restart dead session)
@@ -677,6 +1608,10 @@ def api_generate_image():
                     continue
 
                 if success:
+                    # The browser is done once the artifact URL is known: free the session before mirroring
+                    lovart_release_session(idx, lease)
+                    idx = None
+                    data = _mirror_image_data(data)
                     if isinstance(data, dict) and data.get("low_points"):
                         data.pop("low_points", None)
                     return jsonify({"status": "success", "message": message, "data": data}), 200
@@ -688,8 +1623,11 @@ def api_generate_image():
 
             except Exception as e:
                 print(f"[lovart_routes] Exception during generation (Session {idx}): {e}")
+                if idx is not None and lovart_session_error_is_fatal(idx, e):
+                    # Closed right away if this was its only request, else once the others finish
+                    lovart_retire_session(idx, lease, reason=f"error: {e}")
                 if idx is not None:
-                    lovart_close_session(idx)
+                    lovart_release_session(idx, lease)
                     idx = None
                 
                 # Try to recover session pool for next attempt
@@ -704,7 +1642,7 @@ def api_generate_image():
 
             finally:
                 if idx is not None:
-                    lovart_release_session(idx)
+                    lovart_release_session(idx, lease)
                     idx = None
                     
         return jsonify({"status": "error", "message": "重试多次失败 (积分不足或系统繁忙)", "data": {}}), 500
@@ -712,13 +1650,22 @@ def api_generate_image():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
     finally:
-        # Cleanup temp file
-        for p in temp_file_paths:
-            if p and os.path.exists(p):
-                try:
-                    os.remove(p)
-                except:
-                    pass
+        # Release staged images
+        _release_staged_images(staged_images, prep)
+
+@openai_bp.route('/jobs/<job_id>', methods=['GET'])
+def api_get_job_openai(job_id):
+    job = _get_job(job_id)
+    if not job:
+        return jsonify({
+            "error": {
+                "code": "not_found",
+                "message": f"No job found with id {job_id}",
+                "type": "invalid_request_error",
+                "param": "job_id"
+            }
+        }), 404
+    return jsonify(_job_view(job)), 200
 
 @openai_bp.route('/images/generations', methods=['POST'])
 def api_generate_image_openai():
@@ -729,12 +1676,117 @@ def api_generate_image_openai():
     - size -> ratio (1024x1024->1:1, 1792x1024->16:9, 1024x1792->9:16)
     - n -> 忽略，默认生成1张
     - response_format -> 仅支持 url
+    - async / Prefer: respond-async -> 立即返回 job，通过 GET /v1/jobs/{id} 轮询结果
+    - Idempotency-Key / idempotency_key -> 重复请求复用同一个任务 / 结果
     """
-    temp_file_paths = []
     try:
-        payload = request.get_json(silent=True) or {}
-        _log_generate_image_request("/v1/images/generations", payload)
-        
+        payload = _read_json_payload()
+    except _InputError as e:
+        return _openai_input_error(e)
+    _log_generate_image_request("/v1/images/generations", payload)
+    return _handle_generation(
+        "/v1/images/generations",
+        _generate_image_openai_impl,
+        payload,
+        _openai_job_accepted,
+        _openai_idempotency_conflict,
+        _openai_queue_full,
+    )
+
+@openai_bp.route('/images/edits', methods=['POST'])
+def api_edit_image_openai():
+    """
+    OpenAI 兼容的图片编辑接口 (multipart/form-data)
+    - image / image[] -> 参考图文件 (可多张，二进制上传，无需 Base64)
+    - prompt / size / quality / user / async 与 /v1/images/generations 相同
+    - mask -> 不支持，忽略
+    """
+    try:
+        payload = _read_multipart_payload()
+    except _InputError as e:
+        return _openai_input_error(e)
+    _log_generate_image_request("/v1/images/edits", payload)
+    return _handle_generation(
+        "/v1/images/edits",
+        _generate_image_openai_impl,
+        payload,
+        _openai_job_accepted,
+        _openai_idempotency_conflict,
+        _openai_queue_full,
+    )
+
+def _read_multipart_payload() -> dict:
+    """
+    Form fields become the payload; image / image[] parts are read (size-capped,
+    magic-sniffed) into payload["image_files"] as raw bytes.
+    """
+    length = request.content_length
+    if length is not None and length > _LOVART_MAX_REQUEST_BYTES:
+        raise _InputError(f"Request body exceeds {_LOVART_MAX_REQUEST_BYTES} bytes", status=413)
+    if not request.mimetype.startswith("multipart/form-data"):
+        raise _InputError("Content-Type must be multipart/form-data", param="image")
+
+    payload = {key: value for key, value in request.form.items() if key not in ("image", "image[]")}
+    image_files = []
+    for i, part in enumerate(request.files.getlist("image[]") + request.files.getlist("image")):
+        head = part.stream.read(16)
+        if not lovart_sniff_image_mime(head):
+            raise _InputError(f"Image {i} ({part.filename}) is not a PNG / JPEG / WebP / GIF image", param="image")
+        data = head + part.stream.read(_LOVART_MAX_IMAGE_BYTES + 1 - len(head))
+        if len(data) > _LOVART_MAX_IMAGE_BYTES:
+            raise _InputError(f"Image {i} exceeds the per-image limit of {_LOVART_MAX_IMAGE_BYTES} bytes", param="image", status=413)
+        image_files.append(data)
+        part.close()
+    if not image_files:
+        raise _InputError("Missing required parameter: image", param="image")
+    payload["image_files"] = image_files
+    return payload
+
+def _openai_input_error(e: _InputError):
+    return jsonify({
+        "error": {
+            "code": "request_too_large" if e.status == 413 else "invalid_request",
+            "message": str(e),
+            "type": "invalid_request_error",
+            "param": e.param
+        }
+    }), e.status
+
+def _openai_job_accepted(job: dict):
+    return jsonify({
+        "id": job["id"],
+        "object": "job",
+        "status": job["status"],
+        "created": int(job["created"]),
+    }), 202
+
+def _openai_idempotency_conflict():
+    return jsonify({
+        "error": {
+            "code": "idempotency_key_reused",
+            "message": "Idempotency-Key was already used with different request parameters",
+            "type": "invalid_request_error",
+            "param": "idempotency_key"
+        }
+    }), 422
+
+def _openai_queue_full():
+    resp = jsonify({
+        "error": {
+            "code": "queue_full",
+            "message": "Too many queued jobs, retry later",
+            "type": "server_error",
+            "param": None
+        }
+    })
+    resp.headers["Retry-After"] = "30"
+    return resp, 503
+
+@_track_demand(shared=True)
+def _generate_image_openai_impl(payload: dict):
+    staged_images = []
+    prep = None
+    try:
         # 1. 解析 OpenAI 参数
         prompt = (payload.get("prompt") or "").strip()
         size = (payload.get("size") or "1024x1024").strip()
@@ -744,6 +1796,7 @@ def api_generate_image_openai():
         # 兼容 start_frame_image_base64 (单图) 和 image_assets (多图数组)
         start_frame_image_base64 = (payload.get("start_frame_image_base64") or "").strip()
         image_assets = payload.get("image_assets") or []
+        image_files = payload.get("image_files") or [] # /v1/images/edits: raw bytes from multipart
         user_field = payload.get("user")
         
         # 如果提供了单图字段，且没有提供数组，则将其放入数组
@@ -805,102 +1858,96 @@ def api_generate_image_openai():
             }), 400
 
         # Handle Base64 Images (Multiple)
-        import base64
-        import tempfile
-        import uuid
-        
-        final_image_paths = []
-
-        # 0. Check for images in prompt
-        if not image_assets and not start_frame_image_base64 and prompt:
-             urls = re.findall(r'`?(https?://[^`\s]+)`?', prompt)
-             if urls:
-                 print(f"[lovart_routes] Extracted {len(urls)} URLs from prompt: {urls}")
-                 
-                 # Clean prompt by removing URLs and their surrounding backticks
-                 cleaned_prompt = prompt
-                 for url in urls:
-                     # Escape url for regex and handle optional backticks
-                     escaped_url = re.escape(url)
-                     # Replace `url` or url with empty string
-                     cleaned_prompt = re.sub(r'`?' + escaped_url + r'`?', '', cleaned_prompt)
-                 
-                 # Clean up extra spaces
-                 cleaned_prompt = re.sub(r'\s+', ' ', cleaned_prompt).strip()
-                 print(f"[lovart_routes] Cleaned prompt: {cleaned_prompt}")
-                 prompt = cleaned_prompt
-                 
-                 temp_dir = tempfile.gettempdir()
-                 
-                 # Configure retry strategy
-                 from requests.adapters import HTTPAdapter
-                 from urllib3.util.retry import Retry
-                 
-                 session = requests.Session()
-                 retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-                 adapter = HTTPAdapter(max_retries=retry)
-                 session.mount('http://', adapter)
-                 session.mount('https://', adapter)
-                 
-                 # Bypass proxies
-                 proxies = {
-                     "http": None,
-                     "https": None,
-                 }
-
-                 for url in urls:
-                     try:
-                         url = url.strip()
-                         if not url: continue
-                         print(f"[lovart_routes] Downloading image from prompt: {url}")
-                         r = session.get(url, timeout=60, proxies=proxies)
-                         if r.status_code == 200:
-                             ext = ".png"
-                             ct = r.headers.get("Content-Type", "").lower()
-                             if "jpeg" in ct or "jpg" in ct:
-                                 ext = ".jpg"
-                             elif ".jpg" in url or ".jpeg" in url:
-                                 ext = ".jpg"
-                             
-                             temp_filename = f"lovart_prompt_img_{uuid.uuid4()}{ext}"
-                             t_path = os.path.join(temp_dir, temp_filename)
-                             with open(t_path, "wb") as f:
-                                 f.write(r.content)
-                             temp_file_paths.append(t_path)
-                             final_image_paths.append(t_path)
-                     except Exception as e:
-                         print(f"[lovart_routes] Failed to download {url}: {e}")
-        
-        if image_assets:
-            temp_dir = tempfile.gettempdir()
-            for i, b64_str in enumerate(image_assets):
-                if not b64_str or not isinstance(b64_str, str):
-                    continue
-                try:
-                    if "," in b64_str:
-                        b64_str = b64_str.split(",", 1)[1]
-                    
-                    image_data = base64.b64decode(b64_str)
-                    
-                    temp_filename = f"lovart_upload_openai_{uuid.uuid4()}_{i}.png"
-                    t_path = os.path.join(temp_dir, temp_filename)
-                    
-                    with open(t_path, "wb") as f:
-                        f.write(image_data)
-                    
-                    temp_file_paths.append(t_path)
-                    final_image_paths.append(t_path)
-                except Exception as e:
-                    return jsonify({
-                        "error": {
-                            "code": "invalid_parameter",
-                            "message": f"Base64 decode failed for image {i}: {str(e)}",
-                            "type": "invalid_request_error",
-                            "param": "image_assets"
-                        }
-                    }), 400
+        # Decoding / prompt URL downloads run on the prep pool while we wait for a session
+        def prepare():
+            prompt_text = prompt
+            final_image_paths = []
+
+            # 0. Check for images in prompt
+            if not image_assets and not image_files and not start_frame_image_base64 and prompt_text:
+                 urls = re.findall(r'`?(https?://[^`\s]+)`?', prompt_text)
+                 if urls:
+                     print(f"[lovart_routes] Extracted {len(urls)} URLs from prompt: {urls}")
+
+                     # Clean prompt by removing URLs and their surrounding backticks
+                     cleaned_prompt = prompt_text
+                     for url in urls:
+                         # Escape url for regex and handle optional backticks
+                         escaped_url = re.escape(url)
+                         # Replace `url` or url with empty string
+                         cleaned_prompt = re.sub(r'`?' + escaped_url + r'`?', '', cleaned_prompt)
+
+                     # Clean up extra spaces
+                     cleaned_prompt = re.sub(r'\s+', ' ', cleaned_prompt).strip()
+                     print(f"[lovart_routes] Cleaned prompt: {cleaned_prompt}")
+                     prompt_text = cleaned_prompt
+
+                     # One of our previous outputs: hand the Lovart artifact over directly;
+                     # eligible URLs are forwarded / linked by Lovart, the rest is downloaded
+                     # concurrently (order is kept)
+                     urls = [url.strip() for url in urls if url.strip()]
+                     references = [lovart_resolve_artifact(url) or _prompt_url_reference(url) for url in urls]
+                     to_download = [url for url, reference in zip(urls, references) if not reference]
+                     if to_download:
+                         print(f"[lovart_routes] Downloading {len(to_download)} image(s) from prompt")
+                     downloaded = iter(_download_images(to_download))
+                     for url, reference in zip(urls, references):
+                         if reference:
+                             print(f"[lovart_routes] Forwarding {url} without download: {reference}")
+                             final_image_paths.append(reference)
+                             continue
+                         image_data = next(downloaded)
+                         if image_data:
+                             final_image_paths.append(_stage_image(image_data, "lovart_prompt_img", staged_images))
+
+            if image_assets:
+                for i, b64_str in enumerate(image_assets):
+                    if not b64_str or not isinstance(b64_str, str):
+                        continue
+                    if _image_too_large(b64_str):
+                        raise _InputError(f"Image {i} exceeds the per-image limit of {_LOVART_MAX_IMAGE_BYTES} bytes", param="image_assets", status=413)
+                    try:
+                        image_data = _decode_base64_image(b64_str)
+                        image_assets[i] = None # Drop the base64 text as soon as it is decoded
+                        final_image_paths.append(_stage_image(image_data, f"lovart_upload_openai_{i}", staged_images))
+                    except Exception as e:
+                        raise _InputError(f"Base64 decode failed for image {i}: {str(e)}", param="image_assets")
+
+            for i, image_data in enumerate(image_files):
+                if image_data:
+                    image_files[i] = None # The staged copy is the only one we keep
+                    final_image_paths.append(_stage_image(image_data, f"lovart_upload_edit_{i}", staged_images))
+
+            # Optional: shrink references to what the resolution uses (LOVART_REF_DOWNSCALE)
+            lovart_shrink_image_buffers(staged_images, resolution)
+            return prompt_text, final_image_paths
+
+        def input_error():
+            err = prep.exception()
+            if isinstance(err, _InputError):
+                return jsonify({
+                    "error": {
+                        "code": "request_too_large" if err.status == 413 else "invalid_parameter",
+                        "message": str(err),
+                        "type": "invalid_request_error",
+                        "param": err.param
+                    }
+                }), err.status
+            return jsonify({
+                "error": {
+                    "code": "internal_error",
+                    "message": str(err),
+                    "type": "server_error",
+                    "param": None
+                }
+            }), 500
+
+        prep, prep_wake = _start_preprocessing(prepare)
+        final_image_paths = None
 
         ensure_err = _ensure_lovart_session()
+        if _preprocessing_failed(prep):
+            return input_error()
         if ensure_err:
              # _ensure_lovart_session returns (response, status_code)
              resp, _ = ensure_err
@@ -922,15 +1969,29 @@ def api_generate_image_openai():
                 }
             }), 500
 
-        _ensure_capacity()
+        _ensure_capacity(shared=lovart_image_requests_shared())
         
         max_retries = 3
         idx = None
         
         for attempt in range(max_retries):
-            idx, loop, page = lovart_acquire_session(timeout=600)
+            idx, loop, page, lease = lovart_acquire_session(
+                timeout=600,
+                priority=_request_priority(payload),
+                shared=lovart_image_requests_shared(),
+                wake_event=prep_wake.event() if final_image_paths is None else None,
+            )
+            # Inputs were staged while we waited; a session is useless if that failed
+            if final_image_paths is None and _preprocessing_failed(prep, wait=idx is not None):
+                if idx is not None:
+                    lovart_release_session(idx, lease)
+                    idx = None
+                return input_error()
             if idx is None:
                  if not lovart_has_session():
+                     # The last session went away while we waited: relaunch one and retry
+                     if attempt < max_retries - 1 and _ensure_lovart_session() is None:
+                         continue
                      return jsonify({
                         "error": {
                             "code": "server_error",
@@ -949,7 +2010,9 @@ def api_generate_image_openai():
                         "param": None
                     }
                 }), 503
-            
+            if final_image_paths is None:
+                prompt, final_image_paths = prep.result()
+
             try:
                 success, message, data = _run_generate_image(
                     index=idx,
@@ -961,7 +2024,8 @@ def api_generate_image_openai():
                 )
                 
                 if (not success) and isinstance(data, dict) and data.get("low_points"):
-                    lovart_release_session(idx)
+                    lovart_retire_session(idx, lease, reason="low points")
+                    lovart_release_session(idx, lease)
                     idx = None
                     ensure_err = _ensure_lovart_session()
                     if ensure_err:
@@ -976,6 +2040,10 @@ def api_generate_image_openai():
                     continue
 
                 if success:
+                    # The browser is done once the artifact URL is known: free the session before mirroring
+                    lovart_release_session(idx, lease)
+                    idx = None
+                    data = _mirror_image_data(data)
                     image_url = data.get("image_url")
                     return jsonify({
                         "created": int(time.time()),
@@ -998,8 +2066,11 @@ def api_generate_image_openai():
 
             except Exception as e:
                 print(f"[lovart_routes] Exception during generation (Session {idx}): {e}")
+                if idx is not None and lovart_session_error_is_fatal(idx, e):
+                    # Closed right away if this was its only request, else once the others finish
+                    lovart_retire_session(idx, lease, reason=f"error: {e}")
                 if idx is not None:
-                    lovart_close_session(idx)
+                    lovart_release_session(idx, lease)
                     idx = None
                 
                 # Try to recover session pool for next attempt
@@ -1014,7 +2085,7 @@ def api_generate_image_openai():
 
             finally:
                 if idx is not None:
-                    lovart_release_session(idx)
+                    lovart_release_session(idx, lease)
                     idx = None
                     
         return jsonify({
@@ -1038,10 +2109,5 @@ def api_generate_image_openai():
             }
         }), 500
     finally:
-        # Cleanup temp files
-        for p in temp_file_paths:
-            if p and os.path.exists(p):
-                try:
-                    os.remove(p)
-                except:
-                    pass
+        # Release staged images
+        _release_staged_images(staged_images, prep)
@@ -0,0 +1,31 @@
+"""
+Reference image downscaling, run inside the LOVART_REF_DOWNSCALE process pool.
+
+Kept free of import-time side effects: pool workers (forkserver / spawn) import this
+module to unpickle the task. Pillow is only imported when a task runs.
+"""
+import io
+
+
+def shrink_image(data: bytes, max_edge: int, fmt: str, quality: int):
+    """
+    (bytes, mime type), or None if the image is left as is (animated, or not smaller).
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        if getattr(img, "is_animated", False):
+            return None
+        img = ImageOps.exif_transpose(img) # Orientation is lost on re-encode otherwise
+        if max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        out = io.BytesIO()
+        if has_alpha or fmt == "webp":
+            img.convert("RGBA" if has_alpha else "RGB").save(out, "WEBP", quality=quality, method=4)
+            mime_type = "image/webp"
+        else:
+            img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+    result = out.getvalue()
+    return (result, mime_type) if len(result) < len(data) else None
@@ -1,5 +1,5 @@
 from flask import Flask
-from lovart_routes import lovart_bp, openai_bp
+from lovart_routes import lovart_bp, openai_bp, start_lovart_services
 
 app = Flask(__name__)
 
@@ -14,5 +14,7 @@ if __name__ == '__main__':
     # 默认关闭 Debug 模式以用于生产环境，除非环境变量显式开启
     debug = os.environ.get('DEBUG', 'False').lower() in ('true', '1', 'yes')
     
+    # 后台任务（清理、自动扩缩容、缓存加载）只在服务进程中启动，不在导入时启动
+    start_lovart_services()
     print(f"Starting server on {host}:{port} (Debug: {debug})")
     app.run(host=host, port=port, debug=debug)
\ No newline at end of file